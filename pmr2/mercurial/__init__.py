@@ -2,11 +2,12 @@ from mercurial import demandimport
 demandimport.disable()
 
 from pmr2.mercurial.backend import FixedRevWebStorage, WebStorage, Storage
-from pmr2.mercurial.backend import Sandbox
+from pmr2.mercurial.backend import Sandbox, Changeset
 
 __all__ = [
     'FixedRevWebStorage',
     'WebStorage',
     'Storage',
     'Sandbox',
+    'Changeset',
 ]
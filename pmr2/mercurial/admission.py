@@ -0,0 +1,209 @@
+"""\
+Admission control for expensive storage operations.
+
+Each class of operation has its own limiter, which admits a number of
+concurrent operations, queues a bounded number of further requests for
+up to a timeout, and rejects the rest with `OperationRejectedError`.
+The classes are:
+
+archive
+    archive generation (`MercurialStorage.hg_archive`).
+clone
+    bundle generating protocol commands (getbundle, changegroup,
+    changegroupsubset, stream_out).
+push
+    the unbundle protocol command.
+sync
+    pulls done by `MercurialStorageUtility.syncIdentifier` and the
+    queued sync jobs (`pmr2.mercurial.jobs`).
+
+No limits apply by default.  They are configured with `configure()` or
+the `PMR2_MERCURIAL_ADMISSION` environment variable, which holds a comma
+separated list of `class=concurrency:queue:timeout` entries, e.g.::
+
+    PMR2_MERCURIAL_ADMISSION=archive=2:4:30,clone=4:16:60,sync=1:8:120
+"""
+
+import os
+import threading
+from time import time
+from contextlib import contextmanager
+
+from pmr2.mercurial import instrument
+
+__all__ = [
+    'OperationRejectedError',
+    'Limiter',
+    'configure',
+    'limiter',
+    'command_class',
+    'limit',
+    'stats',
+]
+
+_command_classes = {
+    'getbundle': 'clone',
+    'changegroup': 'clone',
+    'changegroupsubset': 'clone',
+    'stream_out': 'clone',
+    'unbundle': 'push',
+}
+
+
+class OperationRejectedError(Exception):
+    """\
+    The operation was not admitted as too many of its class are already
+    running or waiting.
+    """
+
+
+class Limiter(object):
+    """\
+    Concurrency limiter with a bounded wait queue.
+
+    concurrency -
+        number of operations that may run at the same time.
+    queue -
+        number of operations that may wait for a slot; any more are
+        rejected immediately.
+    timeout -
+        seconds an operation may wait in the queue before it is
+        rejected.  None waits indefinitely.
+    """
+
+    def __init__(self, name, concurrency, queue=0, timeout=None):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue = queue
+        self.timeout = timeout
+        self._cond = threading.Condition()
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timedout = 0
+        self.wait_seconds = 0.0
+
+    def _reject(self, reason, waited):
+        if instrument.enabled():
+            instrument.registry.record('admission.%s.rejected' % self.name,
+                                       waited, error=True)
+        raise OperationRejectedError('%s operation rejected: %s' % (
+            self.name, reason))
+
+    def acquire(self):
+        start = time()
+        self._cond.acquire()
+        try:
+            if self.active >= self.concurrency:
+                if self.waiting >= self.queue:
+                    self.rejected += 1
+                    self._reject('too many pending operations', 0.0)
+                self.waiting += 1
+                try:
+                    while self.active >= self.concurrency:
+                        remaining = None
+                        if self.timeout is not None:
+                            remaining = start + self.timeout - time()
+                            if remaining <= 0:
+                                self.timedout += 1
+                                self._reject('timed out waiting for a slot',
+                                             time() - start)
+                        self._cond.wait(remaining)
+                finally:
+                    self.waiting -= 1
+            self.active += 1
+            self.admitted += 1
+            waited = time() - start
+            self.wait_seconds += waited
+        finally:
+            self._cond.release()
+        if instrument.enabled():
+            instrument.registry.record('admission.%s.wait' % self.name,
+                                       waited)
+
+    def release(self):
+        self._cond.acquire()
+        try:
+            self.active -= 1
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def stats(self):
+        self._cond.acquire()
+        try:
+            return {
+                'concurrency': self.concurrency,
+                'queue': self.queue,
+                'timeout': self.timeout,
+                'active': self.active,
+                'waiting': self.waiting,
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+                'timedout': self.timedout,
+                'wait_seconds': self.wait_seconds,
+            }
+        finally:
+            self._cond.release()
+
+
+_limiters = {}
+
+
+def configure(name, concurrency=None, queue=0, timeout=None):
+    """\
+    Set the limits for the operation class `name`; a `concurrency` of
+    None removes the limits.
+    """
+
+    if concurrency is None:
+        _limiters.pop(name, None)
+    else:
+        _limiters[name] = Limiter(name, concurrency, queue, timeout)
+
+def _configure_from_environ(environ=os.environ):
+    for entry in environ.get('PMR2_MERCURIAL_ADMISSION', '').split(','):
+        if not entry.strip():
+            continue
+        name, values = entry.split('=', 1)
+        values = values.split(':') + [None, None]
+        concurrency, queue, timeout = values[:3]
+        configure(name.strip(), int(concurrency), int(queue or 0),
+                  timeout and float(timeout) or None)
+
+def limiter(name):
+    """\
+    Return the limiter for the operation class, or None if unlimited.
+    """
+
+    return _limiters.get(name)
+
+def command_class(cmd):
+    """\
+    Return the operation class of a protocol command, if any.
+    """
+
+    return _command_classes.get(cmd)
+
+def stats():
+    return dict((k, v.stats()) for k, v in _limiters.items())
+
+@contextmanager
+def limit(name):
+    """\
+    Run the enclosed block once admitted for the operation class
+    `name`; raises OperationRejectedError if not admitted.
+    """
+
+    l = _limiters.get(name)
+    if l is None:
+        yield
+        return
+    l.acquire()
+    try:
+        yield
+    finally:
+        l.release()
+
+_configure_from_environ()
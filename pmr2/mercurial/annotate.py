@@ -0,0 +1,163 @@
+"""\
+Annotation of file revisions, cached on disk.
+
+The annotation of a file revision, i.e. the changeset that last changed
+each of its lines, is kept within the cache directory of the repository
+by path and filenode, as file revisions are immutable.  A revision that
+is not in the cache is annotated from the annotations of its parents, so
+only the revisions added since a file was last annotated are examined,
+rather than its whole history.
+"""
+
+import json
+import hashlib
+from logging import getLogger
+
+from mercurial import mdiff
+from mercurial.node import hex
+
+from pmr2.mercurial.records import AnnotateLine
+
+__all__ = [
+    'AnnotateCache',
+    'annotate',
+    'lines',
+]
+
+logger = getLogger('pmr2.mercurial.annotate')
+
+_cachedir = 'cache/pmr2-annotate'
+
+
+class AnnotateCache(object):
+    """\
+    The cached annotations of the file revisions within repo.
+    """
+
+    def __init__(self, repo):
+        self.repo = repo
+
+    def _name(self, path, filenode):
+        return '%s/%s' % (_cachedir,
+                          hashlib.sha1(path + '\0' + filenode).hexdigest())
+
+    def get(self, path, filenode):
+        """\
+        Returns the changeset nodes (hex) by line of the file revision,
+        or None if it is not cached.
+        """
+
+        try:
+            data = json.loads(self.repo.opener.read(
+                self._name(path, filenode)))
+            nodes = data['nodes']
+            return [str(nodes[i]) for i in data['lines']]
+        except (IOError, ValueError, KeyError, IndexError, TypeError):
+            return None
+
+    def set(self, path, filenode, annotation):
+        index = {}
+        nodes = []
+        lines = []
+        for node in annotation:
+            if node not in index:
+                index[node] = len(nodes)
+                nodes.append(node)
+            lines.append(index[node])
+        try:
+            f = self.repo.opener(self._name(path, filenode), 'w',
+                                 atomictemp=True)
+            try:
+                f.write(json.dumps({'nodes': nodes, 'lines': lines}))
+            except:
+                f.discard()
+                raise
+            f.close()
+        except (IOError, OSError):
+            # the annotation is computed again next time.
+            logger.warning('cannot cache the annotation of %s', path,
+                           exc_info=1)
+
+
+def annotate(fctx, cache=None):
+    """\
+    Returns the changeset node (hex) that last changed each line of the
+    file revision fctx, following copies and renames, as annotated by
+    `filectx.annotate`.
+    """
+
+    if cache is None:
+        cache = AnnotateCache(fctx._repo)
+    changelog = fctx._repo.changelog
+
+    def key(f):
+        return f.path(), f.filenode()
+
+    # An iterative depth-first search as in filectx.annotate, except
+    # that it stops at the revisions already cached, and each revision
+    # annotated is cached.
+    base = key(fctx)
+    visit = [fctx]
+    hist = {}
+    pcache = {}
+    needed = {base: 1}
+    while visit:
+        f = visit[-1]
+        k = key(f)
+        if k in hist:
+            visit.pop()
+            continue
+        if k not in pcache:
+            annotation = cache.get(*k)
+            if annotation is not None:
+                hist[k] = annotation
+                visit.pop()
+                continue
+            pcache[k] = f.parents()
+            for p in pcache[k]:
+                needed[key(p)] = needed.get(key(p), 0) + 1
+
+        pl = pcache[k]
+        pending = [p for p in pl if key(p) not in hist]
+        if pending:
+            visit.extend(pending)
+            continue
+
+        visit.pop()
+        text = f.data()
+        curr = [hex(changelog.node(f.linkrev()))] * len(text.splitlines())
+        for p in pl:
+            pk = key(p)
+            blocks = mdiff.allblocks(p.data(), text, refine=True)
+            for (a1, a2, b1, b2), t in blocks:
+                # changed blocks or blocks of blank lines belong to the
+                # child.
+                if t == '=':
+                    curr[b1:b2] = hist[pk][a1:a2]
+            needed[pk] -= 1
+            if not needed[pk]:
+                del hist[pk]
+        del pcache[k]
+        cache.set(k[0], k[1], curr)
+        hist[k] = curr
+
+    return hist[base]
+
+def lines(fctx, cache=None):
+    """\
+    Returns the `AnnotateLine` records of the lines of the file revision
+    fctx, with the changeset (rev), author and date of the change that
+    last changed each line.
+    """
+
+    repo = fctx._repo
+    ctxs = {}
+    result = []
+    text = fctx.data().splitlines(True)
+    for node, line in zip(annotate(fctx, cache), text):
+        ctx = ctxs.get(node)
+        if ctx is None:
+            ctx = ctxs[node] = repo[node]
+        result.append(AnnotateLine(rev=node, author=ctx.user(),
+                                   date=ctx.date(), line=line))
+    return result
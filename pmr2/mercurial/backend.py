@@ -1,8 +1,17 @@
 import os
 import re
+import sys
+import stat
+import errno
+import struct
+import shutil
+import tempfile
+import threading
 import cgi
 import ConfigParser
 from cStringIO import StringIO
+from collections import defaultdict
+from logging import getLogger
 from mercurial import ui
 from mercurial import hg
 from mercurial import revlog
@@ -11,12 +20,19 @@ from mercurial import cmdutil
 from mercurial import scmutil
 from mercurial import util
 from mercurial import context
+from mercurial import discovery
+from mercurial import mdiff
+from mercurial import patch
+from mercurial import phases
+from mercurial import match as matchmod
 from mercurial.i18n import _
+from mercurial.node import nullid
 
 from mercurial.hgweb.hgweb_mod import hgweb, perms
 
 # Mercurial exceptions to catch
-from mercurial.error import RepoError, LookupError, LockHeld
+from mercurial.error import RepoError, RepoLookupError, LookupError
+from mercurial.error import LockHeld
 from mercurial.util import Abort
 from mercurial.hgweb.common import ErrorResponse, HTTP_NOT_FOUND
 import mercurial.hgweb.protocol
@@ -25,7 +41,10 @@ from mercurial.hgweb import webcommands
 
 from pmr2.app.workspace.exceptions import *
 
-from pmr2.mercurial import utils, ext
+from pmr2.mercurial import utils, ext, instrument, admission, coalesce
+from pmr2.mercurial import annotate, grep, search
+from pmr2.mercurial.records import LogEntry
+from pmr2.mercurial import watcher
 from ext import hg_copy, hg_rename
 
 demandimport.disable()
@@ -35,8 +54,11 @@ __all__ = [
     'WebStorage',
     'FixedRevWebStorage',
     'Sandbox',
+    'Changeset',
 ]
 
+logger = getLogger('pmr2.mercurial.backend')
+
 _t = utils.tmpl
 
 class pmr2ui(ui.ui):
@@ -69,6 +91,276 @@ class _cwd:
     """ placeholder value for current working dir """
 
 
+def _request_cmd(storage, request):
+    """\
+    Return the protocol command of the request, for instrumentation.
+    """
+
+    qs = request.environ.get('QUERY_STRING', '')
+    cmd = cgi.parse_qs(qs).get('cmd', [''])[0]
+    if not cmd:
+        cmd = getattr(request, 'form', {}).get('cmd', '')
+    return cmd or 'none'
+
+# read only protocol commands that respond with a generated stream, and
+# so can be shared by identical concurrent requests.
+_coalesced_commands = (
+    'getbundle',
+    'changegroup',
+    'changegroupsubset',
+    'stream_out',
+)
+
+
+def _mode_flags(mode):
+    if stat.S_ISLNK(mode):
+        return 'l'
+    if mode & 0100:
+        return 'x'
+    return ''
+
+
+# hooks run when a changegroup is added, which a local transfer would
+# bypass.
+_transfer_hooks = (
+    'prechangegroup',
+    'pretxnchangegroup',
+    'changegroup',
+    'incoming',
+)
+
+
+class _NoTransfer(Exception):
+    """\
+    The changesets cannot be transferred directly.
+    """
+
+
+def _transferable(src, dst):
+    if set(src.requirements) != set(dst.requirements):
+        return False
+    # the transferred changesets become public.
+    if not src.ui.configbool('phases', 'publish', True) or \
+            not dst.ui.configbool('phases', 'publish', True):
+        return False
+    if src.obsstore or dst.obsstore:
+        return False
+    if src._phasecache.phaseroots[phases.secret]:
+        return False
+    if _has_transfer_hooks(dst):
+        return False
+    return True
+
+def _has_transfer_hooks(repo):
+    for name, value in repo.ui.configitems('hooks'):
+        if value and name.split('.', 1)[0] in _transfer_hooks:
+            return True
+    return False
+
+def _is_prefix(srl, drl):
+    """\
+    Whether the revlog drl holds the first revisions of srl, stored at
+    the same offsets.
+    """
+
+    n = len(drl)
+    if n > len(srl) or (n and srl.version != drl.version):
+        return False
+    sindex, dindex = srl.index, drl.index
+    for i in xrange(n):
+        if sindex[i] != dindex[i]:
+            return False
+    return True
+
+def _append_revlog(src, dst, tr, indexfile, hardlink):
+    """\
+    Append the revisions of the revlog at indexfile in src missing from
+    the one in dst, returns whether anything was hardlinked.
+    """
+
+    srl = revlog.revlog(src.sopener, indexfile)
+    drl = revlog.revlog(dst.sopener, indexfile)
+    if not _is_prefix(srl, drl):
+        raise _NoTransfer(indexfile)
+    n = len(drl)
+    if n == len(srl):
+        return False
+
+    files = [indexfile]
+    if not srl._inline:
+        files.append(srl.datafile)
+    if not n and hardlink:
+        # new to dst; hardlinked files are copied by the opener before
+        # either repository appends to them.
+        for f in files:
+            target = dst.sjoin(f)
+            util.makedirs(os.path.dirname(target))
+            util.oslink(src.sjoin(f), target)
+            tr.add(f, 0)
+            fncache = getattr(dst.store, 'fncache', None)
+            if fncache is not None and f.startswith('data/'):
+                fncache.add(f)
+        return True
+
+    end = n and drl.end(n - 1) or 0
+    offsets = {
+        indexfile: (srl._inline and end or 0) + n * srl._io.size,
+        srl.datafile: end,
+    }
+    for f in files:
+        offset = offsets[f]
+        size = 0
+        if os.path.exists(dst.sjoin(f)):
+            size = os.path.getsize(dst.sjoin(f))
+        if size != offset:
+            raise _NoTransfer(f)
+        tr.add(f, offset)
+        fp = src.sopener(f)
+        try:
+            fp.seek(offset)
+            out = dst.sopener(f, 'a')
+            try:
+                for chunk in util.filechunkiter(fp):
+                    out.write(chunk)
+            finally:
+                out.close()
+        finally:
+            fp.close()
+    return False
+
+def _local_transfer(src, dst, nodes=None):
+    """\
+    Transfer the changesets missing from the local repository dst from
+    the local repository src by appending the missing revlog data of src
+    to the revlogs of dst, hardlinking the revlogs new to dst if both
+    are on the same file system, without generating a bundle.  The
+    changesets transferred become public in dst.
+
+    This is only possible if each revlog of dst holds the first
+    revisions of the one in src, and if given, the changesets missing
+    from dst are exactly nodes.  Returns the nodes added, or None if a
+    normal pull or push is required.
+    """
+
+    src = src.unfiltered()
+    dst = dst.unfiltered()
+    if not _transferable(src, dst):
+        return None
+    hardlink = os.stat(src.spath).st_dev == os.stat(dst.spath).st_dev
+
+    # lock in a consistent order, as the workspaces may be syncing from
+    # each other.
+    locks = []
+    try:
+        for repo in sorted((src, dst), key=lambda r: r.root):
+            locks.append(repo.lock())
+
+        scl, dcl = src.changelog, dst.changelog
+        start, end = len(dcl), len(scl)
+        if not _is_prefix(scl, dcl):
+            return None
+        added = [scl.node(r) for r in xrange(start, end)]
+        if nodes is not None and set(nodes) != set(added):
+            return None
+        if not added:
+            return []
+
+        tr = dst.transaction('pull\n' + util.hidepassword(src.url()))
+        try:
+            revlogs = []
+            for name, encoded, size in src.store.datafiles():
+                if name is None:
+                    return None
+                if not name.endswith('.i'):
+                    continue
+                target = dst.sjoin(name)
+                if not os.path.exists(target) or \
+                        os.path.getsize(target) != size:
+                    revlogs.append(name)
+            # the changelog last, so the new changesets only appear once
+            # everything they refer to is in place.
+            revlogs.extend(['00manifest.i', '00changelog.i'])
+            linked = False
+            for name in revlogs:
+                linked = _append_revlog(src, dst, tr, name, hardlink) or \
+                    linked
+            tr.close()
+        except _NoTransfer, e:
+            dst.ui.debug('cannot transfer %s directly\n' % e)
+            return None
+        finally:
+            tr.release()
+        dst.invalidate()
+        phases.advanceboundary(dst, phases.public, added)
+        dst.ui.status('added %d changesets%s\n' % (len(added),
+            linked and ' (hardlinked)' or ''))
+    finally:
+        for l in reversed(locks):
+            l.release()
+    return added
+
+def _modheads(repo, oldheads):
+    """\
+    The change in the number of heads, as returned by addchangegroup.
+    """
+
+    heads = repo.heads()
+    dh = len(heads) - len(oldheads)
+    for h in heads:
+        if h not in oldheads and repo[h].closesbranch():
+            dh -= 1
+    if dh < 0:
+        return dh - 1
+    return dh + 1
+
+_diffopts = mdiff.diffopts(git=True)
+
+# diffstats of changesets by node.
+_diffstats = util.lrucachedict(1024)
+_diffstats_lock = threading.Lock()
+
+def _manifest_lines(text):
+    """\
+    Parse manifest lines into a dict of path to (hex node, flags).
+    """
+
+    result = {}
+    for line in text.splitlines():
+        path, n = line.split('\0')
+        result[path] = (n[:40], n[40:])
+    return result
+
+def _manifest_changes(mf, ra, rb):
+    """\
+    Returns the manifest lines removed and added from revision ra to rb
+    of the manifest revlog mf, read from the stored delta of rb where
+    it is against ra and otherwise from a delta of the two texts, or
+    None if the delta does not consist of whole lines.
+    """
+
+    delta = mf.revdiff(ra, rb)
+    removed = []
+    added = []
+    texta = None
+    pos = 0
+    while pos < len(delta):
+        start, end, l = struct.unpack('>lll', delta[pos:pos + 12])
+        pos += 12
+        content = delta[pos:pos + l]
+        pos += l
+        if content and content[-1] != '\n':
+            return None
+        if start < end:
+            if texta is None:
+                texta = mf.revision(ra)
+            if (start and texta[start - 1] != '\n') or \
+                    texta[end - 1] != '\n':
+                return None
+            removed.append(texta[start:end])
+        added.append(content)
+    return ''.join(removed), ''.join(added)
+
+
 class Storage(object):
     """\ 
     Encapsulates a mercurial repository object.
@@ -81,6 +373,7 @@ class Storage(object):
     hgweb_mod.
     """
 
+    @instrument.timed('Storage.open')
     def __init__(self, rpath, ctx=None):
         """\
         Creates the object wrapper for the repository object.
@@ -194,14 +487,10 @@ class Storage(object):
     def branches(self):
         return self._repo.branchtags()
 
-    def clone(self, dest, rev=None, update=True):
+    def _destination(self, dest):
         """\
-        Clones this repository to target destination `dest'.
-
-        dest -
-            the destination.
-        rev -
-            specifies specific revisions to clone.
+        validates and returns the destination for a new repository,
+        creating the parent directory if needed.
         """
 
         if not isinstance(dest, basestring):
@@ -223,6 +512,19 @@ class Storage(object):
             except:
                 raise PathInvalidError(
                         'cannot create directory with specified path')
+        return dest
+
+    def clone(self, dest, rev=None, update=True):
+        """\
+        Clones this repository to target destination `dest'.
+
+        dest -
+            the destination.
+        rev -
+            specifies specific revisions to clone.
+        """
+
+        dest = self._destination(dest)
 
         if rev:
             try:
@@ -236,6 +538,60 @@ class Storage(object):
         # since it did get reinitialized.
         self._repo = repo.local()  # the self reference is always a local
 
+    def share(self, dest, rev=None, update=True):
+        """\
+        Creates a repository at `dest' sharing the store of this
+        repository, so only the working directory is created.
+        Changesets committed in either are immediately available in the
+        other.  As they do not pass through the changegroup hooks of
+        this repository, a repository with any of those hooks configured
+        cannot be shared (UnsupportedCommandError).
+
+        dest -
+            the destination.
+        rev -
+            the revision to check out; default is the tip of the
+            default branch.
+        update -
+            if False, nothing is checked out.
+        """
+
+        if _has_transfer_hooks(self._repo):
+            raise UnsupportedCommandError('cannot share a repository with '
+                                          'changegroup hooks')
+        dest = self._destination(dest)
+
+        node = None
+        if rev:
+            try:
+                node = self._repo.lookup(rev)
+            except (RepoLookupError, LookupError):
+                raise RevisionNotFoundError('revision %s not found' % rev)
+
+        # hold the store lock so the store is not being changed while
+        # it is being shared.
+        lock = self._repo.lock()
+        try:
+            hg.share(self._ui, self._rpath, dest, update=False)
+        finally:
+            lock.release()
+
+        repo = hg.repository(self._ui, dest)
+        fp = repo.opener('hgrc', 'w', text=True)
+        fp.write('[paths]\ndefault = %s\n' % self._rpath)
+        fp.close()
+
+        if update:
+            if node is None:
+                for test in ('default', 'tip'):
+                    try:
+                        node = repo.lookup(test)
+                        break
+                    except RepoError:
+                        continue
+            hg.update(repo, node)
+        return repo.sharedpath
+
     def log(self, rev=None, branch=None, shortlog=False, 
             datefmt=None, maxchanges=None, *a, **kw):
         """\
@@ -256,12 +612,16 @@ class Storage(object):
 
         # XXX maybe move this into the hgweb_ext
         def changelist(entries, **x):
+            getdate = utils.memoized_filter(datefmt)
+            email = utils.memoized_filter('email')
+            firstline = utils.memoized_filter('firstline')
+            person = utils.memoized_filter('person')
             for i in entries():
                 i['date'] = getdate(i['date'])
-                i['email'] = utils.filter(i['author'], 'email')
+                i['email'] = email(i['author'])
                 if shortlog:
-                    i['desc'] = utils.filter(i['desc'], 'firstline')
-                    i['author'] = utils.filter(i['author'], 'person')
+                    i['desc'] = firstline(i['desc'])
+                    i['author'] = person(i['author'])
                 yield i
 
         hw = hgweb(self._repo)
@@ -276,8 +636,6 @@ class Storage(object):
         elif datefmt is None:
             datefmt = 'isodate'
 
-        getdate = lambda i: utils.filter(i, datefmt)
-
         # only looking, not changing.
         ctx = self._getctx(rev)
         result = ext.changelog(hw, ctx, _t, shortlog)
@@ -286,6 +644,25 @@ class Storage(object):
             i['entries'] = lambda **x: changelist(i['orig_entries'], **x)
             yield i
 
+    def search_log(self, query, limit=20, cursor=None):
+        """\
+        Returns the changesets matching every word of the query, newest
+        first, as `LogEntry` records with the rev, node, author, desc,
+        date and files, and the cursor for the next page (see
+        `search.LogIndex.search`).
+        """
+
+        index = search.LogIndex(self._repo)
+        index.update()
+        revs, cursor = index.search(query, limit, cursor)
+        entries = []
+        for rev in revs:
+            ctx = self._repo[rev]
+            entries.append(LogEntry(rev=rev, node=ctx.hex(),
+                author=ctx.user(), desc=ctx.description(), date=ctx.date(),
+                files=ctx.files()))
+        return entries, cursor
+
     def raw_manifest(self, rev=None):
         """\
         Returns raw manifest.
@@ -296,6 +673,95 @@ class Storage(object):
         ctx = self._changectx(rev)
         return ctx.manifest()
 
+    def changed_files(self, rev_a, rev_b=None):
+        """\
+        Returns the files added, removed and modified from rev_a to
+        rev_b, as a dict of sorted lists of (path, flags), with the flags
+        of removed files taken from rev_a.
+
+        Only the manifest lines that differ are examined, taken from the
+        stored manifest delta where rev_b is stored against rev_a.
+        """
+
+        ctxa = self._getctx(rev_a)
+        ctxb = self._getctx(rev_b)
+        mf = self._repo.manifest
+        ra = mf.rev(ctxa.manifestnode())
+        rb = mf.rev(ctxb.manifestnode())
+        result = {'added': [], 'removed': [], 'modified': []}
+        if ra == rb:
+            return result
+
+        changes = _manifest_changes(mf, ra, rb)
+        if changes is None:
+            old, new = [dict((f, (n, m.flags(f))) for f, n in m.iteritems())
+                        for m in (ctxa.manifest(), ctxb.manifest())]
+        else:
+            old, new = [_manifest_lines(text) for text in changes]
+
+        for path, entry in new.iteritems():
+            if path not in old:
+                result['added'].append((path, entry[1]))
+            elif old[path] != entry:
+                result['modified'].append((path, entry[1]))
+        for path, entry in old.iteritems():
+            if path not in new:
+                result['removed'].append((path, entry[1]))
+        for v in result.values():
+            v.sort()
+        return result
+
+    def diff(self, rev=None, path=None):
+        """\
+        Yields the chunks of the unified diff (in git format) of the
+        changeset rev against its first parent, as they are generated,
+        optionally of the files within path only.
+        """
+
+        ctx = self._getctx(rev)
+        match = None
+        if path:
+            # always a literal path, rather than a pattern (or a list
+            # file on the server) should path start with a kind.
+            match = matchmod.match(self._repo.root, '', ['path:' + path])
+        return patch.diff(self._repo, ctx.p1().node(), ctx.node(),
+                          match=match, opts=_diffopts)
+
+    def diffstat(self, rev=None):
+        """\
+        Returns the lines added and removed by the changeset rev against
+        its first parent, as a dict with the totals and a list of the
+        changed files.  Diffstats are cached by node, as changesets are
+        immutable.
+        """
+
+        node = self._getctx(rev).node()
+        stats = None
+        _diffstats_lock.acquire()
+        try:
+            if node in _diffstats:
+                stats = _diffstats[node]
+        finally:
+            _diffstats_lock.release()
+
+        if stats is None:
+            def build():
+                return tuple(patch.diffstatdata(
+                    util.iterlines(self.diff(node))))
+            stats = coalesce.do((self._rpath, node, 'diffstat'), build)
+            _diffstats_lock.acquire()
+            try:
+                _diffstats[node] = stats
+            finally:
+                _diffstats_lock.release()
+
+        return {
+            'added': sum(s[1] for s in stats),
+            'removed': sum(s[2] for s in stats),
+            'files': [{'file': f, 'added': a, 'removed': r, 'binary': b}
+                      for f, a, r, b in stats],
+        }
+
     def _filectx(self, rev=None, path=None):
         """\
         Returns contents of file.
@@ -319,6 +785,28 @@ class Storage(object):
         fctx = self._filectx(rev, path)
         return webcommands._filerevision(hw, _t, fctx)
 
+    def annotate(self, rev=None, path=None):
+        """\
+        Returns the changeset (rev), author and date of the change that
+        last changed each line of the file, with the line, from the
+        annotations cached within the repository.
+        """
+
+        fctx = self._filectx(rev, path)
+        return annotate.lines(fctx)
+
+    def grep(self, pattern, rev=None, path_prefix=None):
+        """\
+        Yields the lines of the text files of the changeset rev matching
+        the regular expression pattern as `GrepMatch` records, optionally
+        of the files within path_prefix only.  Raises ValueError for an
+        invalid pattern.
+        """
+
+        ctx = self._getctx(rev)
+        return grep.lines(self._repo, ctx, pattern, path_prefix,
+                          grep.get(self._repo))
+
     def tags(self):
         return self._repo.tags()
 
@@ -327,6 +815,14 @@ class Storage(object):
         if self._ctx:
             return self._ctx.node().encode('hex')
 
+    @property
+    def shared(self):
+        """\
+        Whether this repository shares the store of another.
+        """
+
+        return self._repo.sharedpath != self._repo.path
+
 
 class WebStorage(hgweb, Storage):
     """\
@@ -339,6 +835,10 @@ class WebStorage(hgweb, Storage):
         Storage.__init__(self, rpath, ctx)
         hgweb.__init__(self, self._repo)
 
+    @instrument.timed('WebStorage.refresh')
+    def refresh(self, *a, **kw):
+        return hgweb.refresh(self, *a, **kw)
+
     def structure(self, request, datefmt='isodate'):
         """\
         This method is implemented as a wrapper around webcommands.file
@@ -352,18 +852,38 @@ class WebStorage(hgweb, Storage):
             return utils.add_aentries(it, datefmt)
         except LookupError:
             if self.path:
-                result = utils.match_subrepo(self.ctx.substate, self.path)
+                result = utils.match_subrepo(utils.subrepo_trie(self.ctx),
+                                             self.path)
                 if result:
                     return result
                 raise PathNotFoundError("path '%s' not found" % self.path)
             else:
                 raise RepoEmptyError('repository is empty')
 
+    @instrument.timed('WebStorage.process_request', key=_request_cmd)
     def process_request(self, request):
         """
         Process the request object and returns output.
+
+        Protocol commands that generate or apply bundles are subject to
+        the limits of their admission class; requests that are not
+        admitted get a 503 response.  Identical concurrent requests for
+        generated bundles share a single admitted computation.
         """
 
+        cmd = _request_cmd(self, request)
+        try:
+            if cmd in _coalesced_commands:
+                # admitted in _coalesced_call, once per computation.
+                return self._process_request(request)
+            with admission.limit(admission.command_class(cmd)):
+                return self._process_request(request)
+        except admission.OperationRejectedError, e:
+            request.response.setStatus(503)
+            return '%s\n' % e
+
+    def _process_request(self, request):
+
         protocol = mercurial.hgweb.protocol
         request.stdin.seek(0)
         env = dict(request.environ)
@@ -463,7 +983,10 @@ class WebStorage(hgweb, Storage):
                         if cmd == 'unbundle':
                             req.drain()
                         raise
-                content = protocol.call(self.repo, req, cmd)
+                if cmd in _coalesced_commands:
+                    content = self._coalesced_call(req, cmd)
+                else:
+                    content = protocol.call(self.repo, req, cmd)
             except ErrorResponse, inst:
                 req.respond(inst, protocol.HGTYPE)
                 # XXX doing write here because the other methods expect
@@ -490,6 +1013,50 @@ class WebStorage(hgweb, Storage):
 
         return out.getvalue()
 
+    def _coalesced_call(self, req, cmd):
+        """\
+        Call the protocol command, sharing the generated stream with
+        identical requests that are in flight.
+        """
+
+        protocol = mercurial.hgweb.protocol
+        args = tuple(sorted((k, tuple(v)) for k, v in req.form.iteritems()))
+        hgargs = tuple(sorted((k, v) for k, v in req.env.iteritems()
+                              if k.startswith('HTTP_X_HGARG_')))
+        key = (self._rpath, self.repo.changelog.tip(), cmd, args, hgargs)
+
+        def call():
+            # the response is captured rather than made, so it can be
+            # replayed to every request sharing it.
+            capture = _ResponseCapture(req)
+            with admission.limit(admission.command_class(cmd)):
+                chunks = list(protocol.call(self.repo, capture, cmd))
+            return capture.response, chunks
+
+        (response, chunks), shared = coalesce.flights.do(key, call)
+        status, type, body = response
+        # a plain string response (e.g. stream_out when streaming is
+        # not allowed) is written as the body, with no chunks.
+        req.respond(status, type, body=body)
+        return chunks
+
+
+class _ResponseCapture(object):
+    """\
+    Request wrapper recording the response made by a protocol call
+    instead of making it.
+    """
+
+    def __init__(self, req):
+        self._req = req
+        self.response = None
+
+    def __getattr__(self, name):
+        return getattr(self._req, name)
+
+    def respond(self, status, type, filename=None, body=None):
+        self.response = (status, type, body)
+
 
 class FixedRevWebStorage(WebStorage):
     """\
@@ -538,6 +1105,136 @@ class FixedRevWebStorage(WebStorage):
         fctx = self._filectx(path)
         return webcommands._filerevision(self, _t, fctx)
 
+    def annotate(self, path=None):
+        fctx = self._filectx(path)
+        return annotate.lines(fctx)
+
+
+class Changeset(object):
+    """\
+    Builds a changeset in memory and commits it directly into the store,
+    without writing to the working directory or walking it.  This works
+    on repositories without a checkout.
+
+    Acquire one through `Sandbox.changeset`.
+    """
+
+    def __init__(self, sandbox, parent=None, branch=None):
+        self.sandbox = sandbox
+        repo = sandbox._repo
+        if parent is None:
+            parent = repo['.']
+            if parent.node() == nullid:
+                # nothing checked out, so build on top of the tip.
+                parent = repo['tip']
+        else:
+            parent = sandbox._getctx(parent)
+        self.parent = parent
+        self.branch = branch or parent.branch()
+        # path -> (content, flags), or None for removal.
+        self._files = {}
+
+    def __len__(self):
+        return len(self._files)
+
+    def add_file_content(self, name, content, flags=None):
+        """\
+        Set the content of a file.
+
+        flags -
+            a combination of 'x' (executable) and 'l' (symlink).  None
+            keeps the flags of the existing file.
+        """
+
+        path = self.sandbox._canonpath(name)
+        if flags is None:
+            flags = path in self.parent and self.parent[path].flags() or ''
+        self._files[path] = (content, flags)
+
+    def remove(self, name):
+        """\
+        Remove a file.
+        """
+
+        path = self.sandbox._canonpath(name)
+        if path in self.parent:
+            self._files[path] = None
+        elif self._files.pop(path, None) is None:
+            raise PathNotFoundError("path '%s' not found" % name)
+
+    def _changed(self):
+        result = []
+        for path, entry in self._files.iteritems():
+            if entry is not None and path in self.parent:
+                fctx = self.parent[path]
+                content, flags = entry
+                if (fctx.flags() == flags and fctx.size() == len(content)
+                        and fctx.data() == content):
+                    continue
+            result.append(path)
+        return sorted(result)
+
+    def _check_paths(self, files):
+        # a path cannot be both a file and a directory.
+        added = [p for p in files if self._files[p] is not None]
+        if not added:
+            return
+        removed = set(p for p in files if self._files[p] is None)
+        manifest = set(self.parent.manifest()) - removed
+        manifest.update(added)
+        dirs = set()
+        for f in manifest:
+            for d in scmutil.finddirs(f):
+                dirs.add(d)
+        for path in added:
+            if path in dirs:
+                raise PathExistsError(
+                    "path '%s' already exists as a directory" % path)
+            for d in scmutil.finddirs(path):
+                if d in manifest:
+                    raise PathExistsError(
+                        "path '%s' already exists as a file" % d)
+
+    def commit(self, message, user, date=None, update=False):
+        """\
+        Commits the changes, returns the id of the new changeset or None
+        if nothing was changed.
+
+        update -
+            if True, the working directory is updated to the new
+            changeset.
+        """
+
+        if not message:
+            raise ValueError('message cannot be empty')
+        if not user:
+            raise ValueError('user cannot be empty')
+
+        repo = self.sandbox._repo
+        files = self._changed()
+        if not files and self.branch == self.parent.branch():
+            return None
+        self._check_paths(files)
+
+        def filectxfn(repo, memctx, path):
+            entry = self._files[path]
+            if entry is None:
+                raise IOError(errno.ENOENT, '%s is removed' % path)
+            content, flags = entry
+            return context.memfilectx(path, content, 'l' in flags,
+                                      'x' in flags)
+
+        ctx = context.memctx(repo, (self.parent.node(), None), message,
+                             files, filectxfn, user, date,
+                             {'branch': self.branch})
+        node = repo.commitctx(ctx)
+        self.sandbox._changectx(node)
+        if update:
+            hg.update(repo, node)
+        self.parent = repo[node]
+        self._files = {}
+        return node
+
 
 class Sandbox(Storage):
     """\
@@ -580,6 +1277,20 @@ class Sandbox(Storage):
             raise PathInvalidError('supplied path is outside repository')
         return fn
 
+    def _canonpath(self, name):
+        """\
+        validates and returns the name provided relative to the root of
+        this repository.
+        """
+
+        try:
+            path = scmutil.canonpath(self._repo.root, self._repo.root, name)
+        except Abort:
+            path = None
+        if not path:
+            raise PathInvalidError('supplied path is outside repository')
+        return path
+
     def _filter_paths(self, paths):
         # filter out paths using fullpath.
         # assumes files in manifest/status exist on filesystem
@@ -648,6 +1359,288 @@ class Sandbox(Storage):
             self._changectx(result)
         return result
 
+    def _plan_operations(self, operations, force):
+        """\
+        Plans the operations against the tracked files, returns the
+        errors, the final mapping of files to the file their content
+        comes from, and the tracked files.
+        """
+
+        repo = self._repo
+        dmap = repo.dirstate._map
+        tracked = set(f for f, e in dmap.iteritems() if e[0] != 'r')
+        # the files after each operation, to the file providing the
+        # content.
+        present = {}
+        # number of files within each directory.
+        dircount = defaultdict(int)
+        errors = []
+
+        def add(f, source):
+            present[f] = source
+            for d in scmutil.finddirs(f):
+                dircount[d] += 1
+
+        def discard(f):
+            source = present.pop(f)
+            for d in scmutil.finddirs(f):
+                dircount[d] -= 1
+            return source
+
+        for f in tracked:
+            add(f, f)
+
+        def select(path):
+            prefix = path + '/'
+            return sorted(f for f in present
+                          if f == path or f.startswith(prefix))
+
+        def isdir(path):
+            if dircount.get(path):
+                return True
+            return path not in present and os.path.isdir(repo.wjoin(path))
+
+        def conflict(target):
+            if target in present or isdir(target):
+                return 'destination exists'
+            for d in scmutil.finddirs(target):
+                if d in present:
+                    return "'%s' is a file" % d
+                # tracked files there are moved away before writing.
+                path = repo.wjoin(d)
+                if (d not in tracked and os.path.lexists(path)
+                        and not os.path.isdir(path)):
+                    return "untracked file '%s' is in the way" % d
+            if (not force and target not in tracked
+                    and os.path.lexists(repo.wjoin(target))):
+                return 'untracked file exists at destination'
+
+        for op in operations:
+            try:
+                action = op[0]
+                paths = [self._canonpath(p) for p in op[1:]]
+                if (action, len(paths)) not in (('remove', 1),
+                        ('rename', 2), ('copy', 2)):
+                    raise ValueError('invalid operation')
+            except (PathInvalidError, ValueError, IndexError), e:
+                errors.append((op, str(e)))
+                continue
+
+            files = select(paths[0])
+            if not files:
+                errors.append((op, 'no tracked files at source'))
+                continue
+            if action == 'remove':
+                for f in files:
+                    discard(f)
+                continue
+
+            source, dest = paths
+            missing = [f for f in files
+                       if not os.path.lexists(repo.wjoin(present[f]))]
+            if missing:
+                errors.append((op, "'%s' is missing" % missing[0]))
+                continue
+            if files == [source] and not isdir(dest):
+                targets = [(source, dest)]
+            else:
+                if isdir(dest):
+                    dest = dest + '/' + source.split('/')[-1]
+                targets = [(f, dest + f[len(source):]) for f in files]
+
+            if action == 'rename':
+                moved = dict((f, discard(f)) for f in files)
+            else:
+                moved = dict((f, present[f]) for f in files)
+            reasons = [(t, conflict(t)) for f, t in targets]
+            reasons = [(t, r) for t, r in reasons if r]
+            if reasons:
+                if action == 'rename':
+                    for f in files:
+                        add(f, moved[f])
+                errors.append((op, "'%s': %s" % reasons[0]))
+                continue
+            for f, t in targets:
+                add(t, moved[f])
+
+        return errors, present, tracked
+
+    def apply_operations(self, operations, dry_run=False, force=False):
+        """\
+        Applies a batch of file operations to the working directory,
+        after planning and validating them together.  The dirstate is
+        written once for the whole batch.
+
+        operations -
+            list of ('remove', path), ('rename', source, dest) and
+            ('copy', source, dest) tuples, applied in order.  Paths may
+            be directories, and the destination may be an existing
+            directory to move or copy into.
+        dry_run -
+            only plan the operations.
+        force -
+            overwrite untracked files at the destinations.
+
+        There are two return values.
+        First value is a list of tuples of the operations that are
+        invalid and the reason.  Nothing is applied if there are any.
+        Second value is the plan; a list of ('remove', path),
+        ('move', source, dest) and ('copy', source, dest) tuples.
+        """
+
+        repo = self._repo
+        wlock = None
+        if not dry_run:
+            wlock = repo.wlock()
+        try:
+            errors, present, tracked = self._plan_operations(operations,
+                                                             force)
+            removed = sorted(f for f in tracked if present.get(f) != f)
+            targets = sorted((t, f) for t, f in present.iteritems()
+                             if t != f)
+            # the last target of a removed file has it moved into place.
+            last = dict((f, t) for t, f in targets)
+            removing = set(removed)
+
+            plan = [('remove', f) for f in removed if f not in last]
+            for t, f in targets:
+                if f in removing and last[f] == t:
+                    plan.append(('move', f, t))
+                else:
+                    plan.append(('copy', f, t))
+
+            if errors or dry_run:
+                return errors, plan
+
+            self._apply_plan(removed, targets, last)
+            return errors, plan
+        finally:
+            if wlock is not None:
+                wlock.release()
+
+    def _apply_plan(self, removed, targets, last):
+        repo = self._repo
+        dirstate = repo.dirstate
+        origins = dict((f, dirstate.copied(f) or f) for t, f in targets)
+
+        # the removed files and whatever is at the destinations are moved
+        # aside first, so the removed files can be moved to destinations
+        # that are also being removed, and everything can be put back if
+        # the plan cannot be completed.
+        staging = tempfile.mkdtemp(dir=repo.join(''))
+        # the paths moved aside, with where they are within staging.
+        aside = []
+        staged = {}
+        # the destinations written, with the source moved there if any.
+        written = []
+        try:
+            try:
+                for f in removed:
+                    if os.path.lexists(repo.wjoin(f)):
+                        staged[f] = os.path.join(staging, str(len(aside)))
+                        os.rename(repo.wjoin(f), staged[f])
+                        aside.append((f, staged[f]))
+                for t, f in targets:
+                    dest = repo.wjoin(t)
+                    if t not in staged and os.path.lexists(dest):
+                        path = os.path.join(staging, str(len(aside)))
+                        os.rename(dest, path)
+                        aside.append((t, path))
+
+                for t, f in targets:
+                    dest = repo.wjoin(t)
+                    util.makedirs(os.path.dirname(dest))
+                    source = staged.get(f, repo.wjoin(f))
+                    if last.get(f) == t and f in staged:
+                        os.rename(source, dest)
+                        written.append((t, source))
+                    else:
+                        util.copyfile(source, dest)
+                        written.append((t, None))
+            except:
+                exc_info = sys.exc_info()
+                # undo the destinations written, then put everything
+                # moved aside back rather than losing it with the
+                # staging directory.
+                for t, source in reversed(written):
+                    try:
+                        if source is None:
+                            os.unlink(repo.wjoin(t))
+                        else:
+                            os.rename(repo.wjoin(t), source)
+                    except OSError:
+                        logger.error('cannot undo the write of %s', t,
+                                     exc_info=1)
+                    try:
+                        os.removedirs(os.path.dirname(repo.wjoin(t)))
+                    except OSError:
+                        pass
+                for f, path in reversed(aside):
+                    try:
+                        util.makedirs(os.path.dirname(repo.wjoin(f)))
+                        os.rename(path, repo.wjoin(f))
+                    except OSError:
+                        logger.error('cannot restore %s from %s', f, path,
+                                     exc_info=1)
+                raise exc_info[0], exc_info[1], exc_info[2]
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+        replaced = set(t for t, f in targets)
+        for f in removed:
+            if f in replaced:
+                continue
+            if dirstate[f] == 'a':
+                dirstate.drop(f)
+            else:
+                dirstate.remove(f)
+            dirname = os.path.dirname(repo.wjoin(f))
+            try:
+                os.removedirs(dirname)
+            except OSError:
+                pass
+        for t, f in targets:
+            origin = origins[f]
+            state = dirstate[t]
+            if state == '?':
+                dirstate.add(t)
+            elif state in 'nmr':
+                # the file is in the parent.
+                dirstate.normallookup(t)
+            if origin != t and dirstate[origin] in 'mnr':
+                dirstate.copy(origin, t)
+
+    def changeset(self, parent=None, branch=None):
+        """\
+        Returns a `Changeset` for building a new changeset in memory on
+        top of `parent`, which defaults to the working directory parent,
+        or the tip if nothing is checked out.
+        """
+
+        return Changeset(self, parent, branch)
+
+    def commit_files(self, operations, message, user, date=None,
+                     parent=None, branch=None, update=False):
+        """\
+        Commits a batch of file operations directly into the store,
+        returns the id of the new commit.
+
+        operations -
+            list of (path, content) or (path, content, flags) tuples.
+            A content of None removes the file.
+
+        See `Changeset` for the remaining parameters.
+        """
+
+        changeset = self.changeset(parent, branch)
+        for op in operations:
+            path, content, flags = (tuple(op) + (None,))[:3]
+            if content is None:
+                changeset.remove(path)
+            else:
+                changeset.add_file_content(path, content, flags)
+        return changeset.commit(message, user, date, update)
+
     def current_branch(self):
         return self._repo.dirstate.branch()
 
@@ -672,6 +1665,84 @@ class Sandbox(Storage):
         hw = hgweb(self._repo)
         return ext.filerevision(hw, _t, fctx)
 
+    def import_archive(self, fileobj, dest='', kind=None, strip=0,
+                       progress=None):
+        """\
+        Extracts the files in a zip or tar archive into the working
+        directory and adds them, ready to be committed.  The archive is
+        read entry by entry and the files are written out in chunks.
+
+        fileobj -
+            file object of the archive.
+        dest -
+            directory to extract the files into.
+        kind -
+            'zip' or 'tar'; detected from the content if None.
+        strip -
+            number of leading path components to remove from the names
+            of the entries; entries without enough components are
+            skipped.
+        progress -
+            callable that is called with the number of entries read and
+            the name of the current entry.
+
+        There are two return values.
+        First value is a list of tuples of entry names and the reason
+        they were not imported.
+        Second value is a list of files that were imported.
+        """
+
+        errors = []
+        imported = []
+        count = 0
+        for name, mode, src in utils.archive_entries(fileobj, kind):
+            count += 1
+            if progress is not None:
+                progress(count, name)
+            self._ui.progress('importing', count, item=name, unit='files')
+
+            parts = name.split('/')[strip:]
+            if not parts:
+                continue
+            if src is None:
+                errors.append((name, 'unsupported entry type'))
+                continue
+            try:
+                path = self._canonpath(os.path.join(dest, *parts))
+                fn = self._repo.wjoin(path)
+                # writing through a symlink would write to its target,
+                # which may be outside of the working directory.
+                if os.path.islink(fn):
+                    raise PathExistsError('path is a symbolic link')
+                if os.path.isdir(fn):
+                    raise PathExistsError('path is a directory')
+                dirname = os.path.dirname(fn)
+                if not os.path.isdir(dirname):
+                    self.mkdir(dirname)
+                fp = os.fdopen(os.open(fn, os.O_WRONLY | os.O_CREAT |
+                    os.O_TRUNC | getattr(os, 'O_NOFOLLOW', 0), 0644), 'wb')
+                try:
+                    shutil.copyfileobj(src, fp, 65536)
+                finally:
+                    fp.close()
+                os.chmod(fn, mode & 0100 and 0755 or 0644)
+            except (PathInvalidError, PathExistsError, IOError, OSError), e:
+                errors.append((name, str(e)))
+                continue
+            if path not in imported:
+                imported.append(path)
+        self._ui.progress('importing', None)
+
+        # a single dirstate update for all the new files.
+        dirstate = self._repo.dirstate
+        added = [f for f in imported if f not in dirstate]
+        if added:
+            rejected = self._repo[None].add(added)
+            for f in rejected:
+                errors.append((f, 'cannot be added'))
+                imported.remove(f)
+        return errors, imported
+
     def mkdir(self, dirname):
         """\
         Creates a dir with dirname.  Currently provided as helper.
@@ -693,7 +1764,7 @@ class Sandbox(Storage):
                                     'path already exists')
         return True
 
-    def pull(self, source='default', update=True):
+    def pull(self, source='default', update=True, other=None):
         """\
         Pull new revisions from source.
 
@@ -705,6 +1776,9 @@ class Sandbox(Storage):
         update -
             if True, this sandbox will be updated to the latest data
             that was pulled, if possible.
+        other -
+            an already opened peer for source, which is used instead of
+            opening source again.
 
         return value is a number of total heads generated from the pull.
 
@@ -726,9 +1800,22 @@ class Sandbox(Storage):
         if source == 'default':
             raise RepoNotFoundError('no suitable repository found')
 
-        other = hg.peer(self._repo, {}, source)
+        if other is None:
+            other = hg.peer(self._repo, {}, source)
         self._ui.status('pulling from %s\n' % (source))
-        modheads = self._repo.pull(other, revs)
+        modheads = None
+        if other.local() is not None and not revs:
+            # another repository on this machine.
+            repo = self._repo.unfiltered()
+            oldheads = repo.heads()
+            added = _local_transfer(other.local(), repo)
+            if added == []:
+                self._ui.status(_("no changes found\n"))
+                modheads = 0
+            elif added:
+                modheads = _modheads(repo, oldheads)
+        if modheads is None:
+            modheads = self._repo.pull(other, revs)
 
         if update:
             if modheads <= 1 or checkout:
@@ -753,6 +1840,8 @@ class Sandbox(Storage):
         it may not be desirable.
 
         By default, no remote branch will be created.
+
+        Returns whether the pushed revisions are present on destination.
         """
 
         # find parents
@@ -775,17 +1864,47 @@ class Sandbox(Storage):
         self._ui.status('pushing to %s\n' % (dest))
         if revs:
             revs = [self._repo.lookup(rev) for rev in revs]
+        pushed = None
         try:
-            r = self._repo.push(other, force, revs=revs)
+            if other.local() is not None:
+                pushed = self._local_push(other, revs, force)
+            if pushed is None:
+                self._repo.push(other, force, revs=revs)
         except Abort:
             raise ProtocolError()
-        # check to see if this revision is present on destination
-        # XXX assuming other is localrepo
+        # check to see if the pushed revisions are present on destination
         try:
-            result = other.lookup(revs[0])
-        except:
-            result = None
-        return result is not None
+            return all(other.known(list(revs or []) + (pushed or [])))
+        except (RepoError, Abort):
+            return False
+
+    def _local_push(self, other, revs, force):
+        """\
+        Push the outgoing changesets to the local repository of the peer
+        other directly, returns the nodes pushed or None if a normal push
+        is required.
+        """
+
+        repo = self._repo.unfiltered()
+        commoninc = discovery.findcommonincoming(repo, other, force=force)
+        common, inc, remoteheads = commoninc
+        outgoing = discovery.findcommonoutgoing(repo, other, onlyheads=revs,
+            commoninc=commoninc, force=force)
+        if not outgoing.missing:
+            self._ui.status(_("no changes found\n"))
+            return []
+        if not force:
+            discovery.checkheads(repo, other, outgoing, remoteheads, False,
+                                 bool(inc))
+        added = _local_transfer(repo, other.local(), outgoing.missing)
+        if added:
+            # pushed into a publishing repository.
+            lock = repo.lock()
+            try:
+                phases.advanceboundary(repo, phases.public, added)
+            finally:
+                lock.release()
+        return added
 
     def remove(self, source):
         """\
@@ -865,22 +1984,120 @@ class Sandbox(Storage):
         errors.sort()
         return errors, success
 
-    def status(self, path=''):
+    def _status_entry(self, f, status, entry, tz):
+        if status == 'clean' and entry[2] >= 0 and entry[3] > 0:
+            # the dirstate records the size and time of files known to
+            # be clean.
+            mode, size, mtime = entry[1:]
+        else:
+            s = os.lstat(self._repo.wjoin(f))
+            mode, size, mtime = s.st_mode, s.st_size, s.st_mtime
+        return {
+            'file': f,
+            'status': status,
+            'date': (int(mtime), tz),
+            'size': size,
+            'permissions': _mode_flags(mode),
+        }
+
+    def status(self, path='', ignored=True, clean=True, unknown=False):
         """\
         Status reports the state of the sandbox, for files that may have
         been added, modified, deleted and the like.
 
-        Only compare the first dirstate parent and working directory.
+        Only compare the first dirstate parent and working directory,
+        and only for the files directly within path; the directories
+        within are listed from the dirstate without being walked.  If
+        a `watcher` is enabled, only the files that changed since the
+        previous status are examined.
+
+        clean -
+            list the files that are unchanged.
+        unknown -
+            list the files that are not tracked and not ignored.
+        ignored -
+            list the files that are not tracked and ignored.
+
+        Raises PathInvalidError if path is outside of the repository.
 
         Returns a dictionary of the list of files.
         """
 
         # get back to latest working copy because this is what we want.
         ctx = self._changectx(_cwd)
-        st = self._repo.status(ignored=True, clean=True)
+        repo = self._repo
+        dmap = repo.dirstate._map
+
+        try:
+            path = scmutil.canonpath(repo.root, repo.root, path.strip('/'))
+        except Abort:
+            raise PathInvalidError('supplied path is outside repository')
+        prefix = path and path + '/' or ''
+        l = len(prefix)
+        files = []
+        dirs = set()
+        for f, entry in dmap.iteritems():
+            if f[:l] != prefix or entry[0] == 'r':
+                continue
+            remain = f[l:]
+            if '/' in remain:
+                dirs.add(remain[:remain.index('/')])
+            else:
+                files.append(f)
+
+        if unknown or ignored:
+            try:
+                names = os.listdir(repo.wjoin(path))
+            except OSError:
+                names = []
+            for name in names:
+                f = prefix + name
+                if (f not in dmap and name != '.hg'
+                        and not os.path.isdir(repo.wjoin(f))):
+                    files.append(f)
+
+        changetypes = (
+            'modified', 'added', 'removed', 'deleted', 'unknown',
+            'ignored', 'clean',
+        )
+        # with a watcher, only the files changed since their status was
+        # last found need to be examined.
+        w = watcher.get(repo.root)
+        results = {}
+        check = files
+        if w is not None:
+            w.poll()
+            check = []
+            for f in files:
+                value = w.lookup(f, dmap.get(f))
+                if value is None:
+                    check.append(f)
+                else:
+                    results[f] = value
+
+        if check:
+            # the status is cached against the dirstate entries it was
+            # found from, as examining the files may update them.
+            before = dict((f, dmap.get(f)) for f in check)
+            m = matchmod.exact(repo.root, repo.root, check)
+            st = repo.status(match=m, ignored=ignored,
+                             clean=clean or w is not None, unknown=unknown)
+            dmap = repo.dirstate._map
+            tz = util.makedate()[1]
+            for k, v in zip(changetypes, st):
+                if k in ('removed', 'deleted'):
+                    continue
+                for f in v:
+                    results[f] = self._status_entry(f, k, dmap.get(f), tz)
+                    if w is not None:
+                        w.update(f, before.get(f), results[f])
+
+        listed = {'clean': clean, 'unknown': unknown, 'ignored': ignored}
+        entries = [v for v in results.itervalues()
+                   if listed.get(v['status'], True)]
 
         hw = hgweb(self._repo)
-        return ext.status(hw, _t, self._ctx, path, st)
+        return ext.dirstatus(hw, _t, self._ctx, path, entries, dirs)
 
 # XXX features missing compared to prototype in pmr2.hgpmr.repository
 # - archive: should be done via hgweb
@@ -0,0 +1,117 @@
+"""\
+Coalescing of identical concurrent requests.
+
+When many identical requests for a workspace arrive at the same time
+(e.g. an archive of the revision linked from a publication), only the
+first one does the work; the others wait for it to complete and are
+given the same result, or the same exception.  Requests are identified
+by a key made of the workspace, node, operation and arguments.
+
+Only requests that are in flight at the same time are coalesced; no
+result is kept once the request that computed it completes.
+"""
+
+import sys
+import threading
+from time import time
+
+from pmr2.mercurial import instrument
+
+__all__ = [
+    'SingleFlight',
+    'flights',
+    'do',
+]
+
+
+class _Call(object):
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.exc_info = None
+        self.waiters = 0
+
+
+class SingleFlight(object):
+    """\
+    Runs at most one computation per key at a time.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.computed = 0
+        self.shared = 0
+
+    def do(self, key, func, *a, **kw):
+        """\
+        Return the result of `func(*a, **kw)`, unless a computation for
+        `key` is already in flight, in which case wait for it and return
+        its result instead.
+
+        Returns a tuple of the result and whether it was shared from
+        another call.
+        """
+
+        self._lock.acquire()
+        try:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.computed += 1
+            else:
+                call.waiters += 1
+                self.shared += 1
+        finally:
+            self._lock.release()
+
+        if not leader:
+            start = time()
+            call.event.wait()
+            if instrument.enabled():
+                instrument.registry.record('coalesce.wait', time() - start)
+            if call.exc_info:
+                raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+            return call.result, True
+
+        try:
+            try:
+                call.result = func(*a, **kw)
+            except:
+                call.exc_info = sys.exc_info()
+                raise
+        finally:
+            self._lock.acquire()
+            try:
+                del self._calls[key]
+            finally:
+                self._lock.release()
+            call.event.set()
+        return call.result, False
+
+    def inflight(self):
+        self._lock.acquire()
+        try:
+            return len(self._calls)
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        return {
+            'computed': self.computed,
+            'shared': self.shared,
+            'inflight': self.inflight(),
+        }
+
+
+flights = SingleFlight()
+
+def do(key, func, *a, **kw):
+    """\
+    Run `func` through the module level `SingleFlight`, returning only
+    the result.
+    """
+
+    return flights.do(key, func, *a, **kw)[0]
@@ -32,6 +32,8 @@ from mercurial import demandimport
 demandimport.disable()
 
 from pmr2.mercurial import utils
+from pmr2.mercurial.records import LogEntry
+from pmr2.mercurial.records import lazy
 
 __all__ = [
     'hex_',
@@ -40,6 +42,7 @@ __all__ = [
     'changelog',
     'filerevision',
     'status',
+    'dirstatus',
 ]
 
 def hex_(data):
@@ -268,6 +271,9 @@ def hg_copy(ui, repo, pats, opts, rename=False):
     return errors, success
 
 
+def _listfilediffs(tmpl, ctx, maxfiles):
+    return webutil.listfilediffs(tmpl, ctx.files(), ctx.node(), maxfiles)
+
 # XXX copied from webcommands.changelog, hg v1.3, with the request part
 # stripped out.
 def changelog(web, ctx, tmpl, shortlog = False):
@@ -277,22 +283,22 @@ def changelog(web, ctx, tmpl, shortlog = False):
             ctx = web.repo[i]
             n = ctx.node()
             showtags = webutil.showtag(web.repo, tmpl, 'changelogtag', n)
-            files = webutil.listfilediffs(tmpl, ctx.files(), n, web.maxfiles)
-
-            l.insert(0, {"parity": parity.next(),
-                         "author": ctx.user(),
-                         "parent": webutil.parents(ctx, i - 1),
-                         "child": webutil.children(ctx, i + 1),
-                         "changelogtag": showtags,
-                         "desc": ctx.description(),
-                         "date": ctx.date(),
-                         "files": files,
-                         "rev": i,
-                         "node": hex_(n),
-                         "tags": webutil.nodetagsdict(web.repo, n),
-                         "inbranch": webutil.nodeinbranch(web.repo, ctx),
-                         "branches": webutil.nodebranchdict(web.repo, ctx)
-                        })
+
+            l.insert(0, LogEntry(
+                parity=parity.next(),
+                author=ctx.user(),
+                parent=webutil.parents(ctx, i - 1),
+                child=webutil.children(ctx, i + 1),
+                changelogtag=showtags,
+                desc=ctx.description(),
+                date=ctx.date(),
+                files=lazy(_listfilediffs, tmpl, ctx, web.maxfiles),
+                rev=i,
+                node=hex_(n),
+                tags=lazy(webutil.nodetagsdict, web.repo, n),
+                inbranch=lazy(webutil.nodeinbranch, web.repo, ctx),
+                branches=lazy(webutil.nodebranchdict, web.repo, ctx),
+            ))
 
         if limit > 0:
             l = l[:limit]
@@ -428,17 +434,59 @@ def status(web, tmpl, ctx, path, st, datefmt='isodate'):
                    "path": "%s%s" % (abspath, f),
                    "basename": f[:-1]}
 
+    return _status_tmpl(web, tmpl, ctx, abspath, parity, filelist, dirlist,
+                        datefmt)
+
+def dirstatus(web, tmpl, ctx, path, entries, dirs, datefmt='isodate'):
+    """\
+    Same as status, but built from the precomputed entries of the files
+    directly within path.
+
+    entries
+        - list of dicts with file, status, date, size and permissions
+          keys.
+    dirs
+        - names of the directories directly within path.
+    """
+
+    parity = paritygen(web.stripecount)
+    if path and path[-1] != "/":
+        path += "/"
+    abspath = "/" + path
+
+    def filelist(**map):
+        for entry in sorted(entries, key=lambda e: e['file']):
+            i = dict(entry)
+            i['parity'] = parity.next()
+            i['basename'] = i['file'][len(path):]
+            yield i
+
+    def dirlist(**map):
+        for d in sorted(dirs):
+            yield {"parity": parity.next(),
+                   "path": "%s%s/" % (abspath, d),
+                   "basename": d}
+
+    return _status_tmpl(web, tmpl, ctx, abspath, parity, filelist, dirlist,
+                        datefmt)
+
+def _status_tmpl(web, tmpl, ctx, abspath, parity, filelist, dirlist,
+                 datefmt):
+
     def fulllist(**map):
         for i in dirlist():
             # remove first slash
             i['file'] = i['path'][1:]
             i['permissions'] = 'drwxr-xr-x'
             yield i
+        date = utils.memoized_filter(datefmt)
+        permissions = utils.memoized_filter('permissions')
         for i in filelist():
-            i['date'] = utils.filter(i['date'], datefmt)
-            i['permissions'] = utils.filter(i['permissions'], 'permissions')
+            i['date'] = date(i['date'])
+            i['permissions'] = permissions(i['permissions'])
             yield i
 
+    node = ctx.node()
     return tmpl("status",
                  rev=ctx.rev(),
                  node=hex_(node),
@@ -0,0 +1,274 @@
+"""\
+Search of the contents of the files within a revision.
+
+The files of the manifest are read in path order and matched line by
+line, skipping binary files, which are remembered by filenode.  With the
+optional trigram index, the trigrams of every file revision read are
+kept within the cache directory of the repository by filenode, so the
+file revisions that cannot contain the literal text required by a
+pattern are not read again by later searches, of that revision or any
+other revision sharing them.
+
+The index is off by default.  It is enabled with `configure()` or by
+setting the `PMR2_MERCURIAL_GREP_INDEX` environment variable to a
+non-empty value.
+"""
+
+import os
+import re
+import sre_parse
+import sre_constants
+import sqlite3
+import threading
+import zlib
+from logging import getLogger
+
+from mercurial import util
+
+from pmr2.mercurial.records import GrepMatch
+
+__all__ = [
+    'TrigramIndex',
+    'trigrams',
+    'required_trigrams',
+    'lines',
+    'configure',
+    'get',
+]
+
+logger = getLogger('pmr2.mercurial.grep')
+
+_dbname = 'cache/pmr2-grep.db'
+
+_schema = """
+CREATE TABLE IF NOT EXISTS files (
+    filenode BLOB PRIMARY KEY,
+    binary INTEGER NOT NULL,
+    grams BLOB
+)
+"""
+
+# number of filenodes looked up or stored at a time.
+_batch = 500
+
+# binary flags of file revisions by filenode.
+_binaries = util.lrucachedict(8192)
+_binaries_lock = threading.Lock()
+
+
+def trigrams(text):
+    """\
+    Returns the set of the trigrams of text, ignoring case.
+    """
+
+    text = text.lower()
+    return set(text[i:i + 3] for i in xrange(len(text) - 2))
+
+def required_trigrams(pattern):
+    """\
+    Returns the trigrams (ignoring case) of the literal text that every
+    match of the regular expression must contain, which may be none.
+    """
+
+    try:
+        parsed = sre_parse.parse(pattern)
+    except (sre_constants.error, OverflowError):
+        return set()
+    runs = ['']
+    for op, av in parsed:
+        # only the literals at the top level of the pattern are always
+        # matched.
+        if op == sre_constants.LITERAL and av < 256:
+            runs[-1] += chr(av)
+        else:
+            runs.append('')
+    result = set()
+    for run in runs:
+        result.update(trigrams(run))
+    return result
+
+def _grams(text):
+    # text files do not contain NUL, so it separates the trigrams.
+    return zlib.compress('\0%s\0' % '\0'.join(sorted(trigrams(text))))
+
+
+class TrigramIndex(object):
+    """\
+    Trigrams and binary flags of the file revisions of repo, by
+    filenode, kept within its cache directory.
+    """
+
+    def __init__(self, repo):
+        self.repo = repo
+        self.path = repo.join(_dbname)
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        conn = self._connect()
+        try:
+            conn.execute(_schema)
+        finally:
+            conn.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def get(self, filenodes):
+        """\
+        Returns a dict of the (binary, grams) of the filenodes indexed.
+        """
+
+        filenodes = list(filenodes)
+        result = {}
+        conn = self._connect()
+        try:
+            for i in xrange(0, len(filenodes), _batch):
+                batch = filenodes[i:i + _batch]
+                for filenode, binary, grams in conn.execute(
+                        'SELECT filenode, binary, grams FROM files WHERE '
+                        'filenode IN (%s)' % ', '.join('?' * len(batch)),
+                        [buffer(n) for n in batch]):
+                    result[str(filenode)] = bool(binary), grams
+        finally:
+            conn.close()
+        return result
+
+    def add(self, entries):
+        """\
+        Index the (filenode, text) of file revisions, or (filenode,
+        None) for binary file revisions.
+        """
+
+        rows = [(buffer(filenode), text is None and 1 or 0,
+                 text is not None and buffer(_grams(text)) or None)
+                for filenode, text in entries]
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.executemany('INSERT OR REPLACE INTO files (filenode, '
+                    'binary, grams) VALUES (?, ?, ?)', rows)
+                conn.execute('COMMIT')
+            except:
+                conn.execute('ROLLBACK')
+                raise
+        finally:
+            conn.close()
+
+
+def _contains(grams, required):
+    grams = zlib.decompress(grams)
+    for g in required:
+        if '\0%s\0' % g not in grams:
+            return False
+    return True
+
+def _add(index, repo, entries):
+    # the index only saves work, so the search goes on without it.
+    try:
+        index.add(entries)
+    except sqlite3.Error:
+        logger.warning('cannot update the trigram index of %s', repo.root,
+                       exc_info=1)
+
+def lines(repo, ctx, pattern, path_prefix=None, index=None):
+    """\
+    Returns an iterator of a `GrepMatch` record for each line matching
+    the regular expression pattern of the text files in the changeset
+    ctx within path_prefix, in path order.  The `TrigramIndex` index, if
+    given, is used to skip the file revisions that cannot match, and
+    updated with those that were not indexed.  Raises ValueError for an
+    invalid pattern.
+    """
+
+    if isinstance(pattern, unicode):
+        pattern = pattern.encode('utf8')
+    try:
+        regex = re.compile(pattern, re.MULTILINE)
+    except re.error, e:
+        raise ValueError('invalid pattern %r: %s' % (pattern, e))
+    required = index is not None and required_trigrams(pattern) or ()
+    return _matches(repo, ctx, regex, required, path_prefix, index)
+
+def _matches(repo, ctx, regex, required, path_prefix, index):
+    mf = ctx.manifest()
+    if path_prefix:
+        path_prefix = path_prefix.strip('/')
+        prefix = path_prefix + '/'
+        files = sorted(f for f in mf
+                       if f == path_prefix or f.startswith(prefix))
+    else:
+        files = sorted(mf)
+
+    known = {}
+    if index is not None:
+        known = index.get(set(mf[f] for f in files))
+    # the file revisions to be indexed, which may be at several paths.
+    pending = set()
+    new = []
+
+    try:
+        for f in files:
+            filenode = mf[f]
+            if filenode in known:
+                binary, grams = known[filenode]
+                if binary or required and not _contains(grams, required):
+                    continue
+            else:
+                _binaries_lock.acquire()
+                try:
+                    binary = filenode in _binaries and _binaries[filenode]
+                finally:
+                    _binaries_lock.release()
+                if binary:
+                    if index is not None and filenode not in pending:
+                        pending.add(filenode)
+                        new.append((filenode, None))
+                    continue
+
+            text = repo.file(f).read(filenode)
+            binary = util.binary(text)
+            _binaries_lock.acquire()
+            try:
+                _binaries[filenode] = binary
+            finally:
+                _binaries_lock.release()
+            if (index is not None and filenode not in known and
+                    filenode not in pending):
+                pending.add(filenode)
+                if binary:
+                    new.append((filenode, None))
+                else:
+                    new.append((filenode, text))
+                if len(new) >= _batch:
+                    _add(index, repo, new)
+                    new = []
+            if binary or not regex.search(text):
+                continue
+
+            for n, line in enumerate(text.splitlines()):
+                if regex.search(line):
+                    yield GrepMatch(file=f, lineno=n + 1, line=line)
+    finally:
+        if new:
+            _add(index, repo, new)
+
+
+class _config:
+    index = bool(os.environ.get('PMR2_MERCURIAL_GREP_INDEX'))
+
+
+def configure(index=False):
+    """\
+    Enable or disable the trigram index.
+    """
+
+    _config.index = index
+
+def get(repo):
+    """\
+    Returns the `TrigramIndex` of repo, or None if the index is disabled.
+    """
+
+    if not _config.index:
+        return None
+    return TrigramIndex(repo)
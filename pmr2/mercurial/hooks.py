@@ -1,5 +1,21 @@
 # [hooks]
 # pretxnchangegroup.01_one_head_per_branch = python:pmr2.mercurial.hooks.one_head_per_branch
+# pretxnchangegroup.02_changegroup_limits = python:pmr2.mercurial.hooks.changegroup_limits
+#
+# [pmr2.limits]
+# # all values are optional, unset or 0 means unlimited.
+# max_incoming = 200 MB
+# max_file_size = 20 MB
+# max_files = 10000
+# max_changesets = 1000
+
+from mercurial.node import bin
+
+_limits_section = 'pmr2.limits'
+
+# number of offending paths to list before summarizing the rest.
+_report_limit = 20
+
 
 def one_head_per_branch(ui, repo, **kwargs):
     for b in repo.branchtags():
@@ -11,3 +27,93 @@ def one_head_per_branch(ui, repo, **kwargs):
                 'alternately, name your head as a new branch.\n' % b)
             return True
     return False
+
+def _incoming(repo, clstart):
+    """\
+    Scan the revlogs for the data introduced by the changesets starting
+    from `clstart`.
+
+    Only the revlog indexes are consulted; stored (compressed) lengths
+    are used for the incoming byte count and the recorded raw sizes are
+    used for the size of each file revision, so no file content is
+    decompressed.  Returns a tuple of changeset count, incoming bytes
+    and a dict of path to the largest incoming file revision size.
+    """
+
+    cl = repo.changelog
+    clend = len(cl)
+    total = 0
+    touched = set()
+
+    for rev in xrange(clstart, clend):
+        total += cl.length(rev)
+        touched.update(cl.read(cl.node(rev))[3])
+
+    mf = repo.manifest
+    for rev in xrange(len(mf) - 1, -1, -1):
+        if mf.linkrev(rev) < clstart:
+            break
+        total += mf.length(rev)
+
+    sizes = {}
+    for path in touched:
+        fl = repo.file(path)
+        for rev in xrange(len(fl) - 1, -1, -1):
+            if fl.linkrev(rev) < clstart:
+                break
+            total += fl.length(rev)
+            sizes[path] = max(sizes.get(path, 0), fl.rawsize(rev))
+
+    return clend - clstart, total, sizes
+
+def _report(ui, message, paths):
+    ui.warn(message)
+    for path in paths[:_report_limit]:
+        ui.warn('  %s\n' % path)
+    if len(paths) > _report_limit:
+        ui.warn('  ... and %d more\n' % (len(paths) - _report_limit))
+
+def changegroup_limits(ui, repo, node=None, **kwargs):
+    """\
+    Reject an incoming changegroup that exceeds any of the limits
+    configured in the `pmr2.limits` section.
+    """
+
+    max_incoming = ui.configbytes(_limits_section, 'max_incoming', 0)
+    max_file_size = ui.configbytes(_limits_section, 'max_file_size', 0)
+    max_files = ui.configint(_limits_section, 'max_files', 0)
+    max_changesets = ui.configint(_limits_section, 'max_changesets', 0)
+
+    if node is None or not (
+            max_incoming or max_file_size or max_files or max_changesets):
+        return False
+
+    clstart = repo.changelog.rev(bin(node))
+    changesets, total, sizes = _incoming(repo, clstart)
+    failed = False
+
+    if max_changesets and changesets > max_changesets:
+        ui.warn('push contains %d changesets, limit is %d.\n' % (
+            changesets, max_changesets))
+        failed = True
+
+    if max_files and len(sizes) > max_files:
+        ui.warn('push modifies %d files, limit is %d.\n' % (
+            len(sizes), max_files))
+        failed = True
+
+    if max_file_size:
+        oversized = sorted(p for p, s in sizes.iteritems()
+                           if s > max_file_size)
+        if oversized:
+            _report(ui, 'push contains files larger than %d bytes:\n' %
+                max_file_size, oversized)
+            failed = True
+
+    if max_incoming and total > max_incoming:
+        largest = sorted(sizes, key=lambda p: (-sizes[p], p))
+        _report(ui, 'push contains %d bytes of data, limit is %d; '
+            'the largest files are:\n' % (total, max_incoming), largest)
+        failed = True
+
+    return failed
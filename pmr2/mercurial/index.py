@@ -0,0 +1,379 @@
+"""\
+Persistent index of the workspaces within workspace roots.
+
+The index keeps the tip node and date, the size of the store and the
+number of named branches of each workspace in a sqlite database, so the
+workspaces within a root can be listed with a single read instead of
+examining every directory.  Workspaces are updated in the index as they
+are created, pushed to or synchronized.  The workspaces added to or
+removed from a root by other means change the modification time of the
+root, and are reconciled when the root is next listed.  A root can be
+rebuilt by scanning it in parallel, e.g.::
+
+    python -m pmr2.mercurial.index --db workspaces.db rebuild /srv/hg
+
+The index is off by default.  It is enabled with `configure()` or the
+`PMR2_MERCURIAL_INDEX_DB` environment variable holding the path to the
+database.
+"""
+
+import os
+import json
+import sqlite3
+import threading
+import multiprocessing
+import optparse
+from time import time
+from logging import getLogger
+
+from mercurial import hg
+from mercurial import ui
+from mercurial.node import hex
+from mercurial.error import RepoError
+
+__all__ = [
+    'WorkspaceIndex',
+    'workspace_info',
+    'configure',
+    'get',
+    'updated',
+    'main',
+]
+
+logger = getLogger('pmr2.mercurial.index')
+
+_rstub = '.hg'
+
+_schema = """
+CREATE TABLE IF NOT EXISTS workspaces (
+    root TEXT NOT NULL,
+    name TEXT NOT NULL,
+    tip TEXT NOT NULL,
+    tipdate REAL,
+    size INTEGER NOT NULL,
+    branches INTEGER NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (root, name)
+);
+CREATE TABLE IF NOT EXISTS roots (
+    root TEXT PRIMARY KEY,
+    rebuilt REAL NOT NULL,
+    mtime REAL
+);
+"""
+
+_fields = ('name', 'tip', 'tipdate', 'size', 'branches', 'updated')
+
+
+def _split(path):
+    path = os.path.abspath(path)
+    return os.path.dirname(path), os.path.basename(path)
+
+def workspace_info(path):
+    """\
+    Returns the tip node (hex), tip date (seconds since epoch, UTC), the
+    size of the store in bytes and the number of named branches of the
+    workspace at path, or None if there is no repository there.
+    """
+
+    u = ui.ui()
+    u.setconfig('ui', 'quiet', 'on')
+    u.setconfig('ui', 'report_untrusted', 'off')
+    try:
+        repo = hg.repository(u, path)
+    except RepoError:
+        return None
+    tip = repo['tip']
+    size = 0
+    for name, encoded, s in repo.store.walk():
+        size += s
+    return {
+        'tip': hex(tip.node()),
+        'tipdate': len(repo) and tip.date()[0] or None,
+        'size': size,
+        'branches': len(repo.branchmap()),
+    }
+
+def _mtime(root, now):
+    # the modification time of root, if it tells of later changes to
+    # its entries; it may not change for those within the same second.
+    mtime = os.stat(root).st_mtime
+    if mtime >= now - 1:
+        return None
+    return mtime
+
+def _workspaces(root):
+    return set(name for name in os.listdir(root)
+               if os.path.isdir(os.path.join(root, name, _rstub)))
+
+def _scan(path):
+    try:
+        return path, workspace_info(path)
+    except Exception, e:
+        logger.warning('cannot index %s: %s', path, e)
+        return path, None
+
+
+class WorkspaceIndex(object):
+    """\
+    Index of workspaces stored at path.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        conn = self._connect()
+        try:
+            conn.executescript(_schema)
+        finally:
+            conn.close()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _row(self, row):
+        return dict((k, row[k]) for k in _fields)
+
+    def update(self, path, info=None):
+        """\
+        Update the entry of the workspace at path, removing it if there
+        is no longer a repository there.  Returns the entry.
+        """
+
+        if info is None:
+            info = workspace_info(path)
+        root, name = _split(path)
+        conn = self._connect()
+        try:
+            if info is None:
+                conn.execute('DELETE FROM workspaces WHERE root = ? AND '
+                    'name = ?', (root, name))
+                return None
+            conn.execute('INSERT OR REPLACE INTO workspaces (root, name, '
+                'tip, tipdate, size, branches, updated) VALUES '
+                '(?, ?, ?, ?, ?, ?, ?)', (root, name, info['tip'],
+                    info['tipdate'], info['size'], info['branches'], time()))
+        finally:
+            conn.close()
+        return self.get(path)
+
+    def remove(self, path):
+        root, name = _split(path)
+        conn = self._connect()
+        try:
+            conn.execute('DELETE FROM workspaces WHERE root = ? AND '
+                'name = ?', (root, name))
+        finally:
+            conn.close()
+
+    def get(self, path):
+        """\
+        Returns the entry of the workspace at path, or None.
+        """
+
+        root, name = _split(path)
+        conn = self._connect()
+        try:
+            row = conn.execute('SELECT * FROM workspaces WHERE root = ? AND '
+                'name = ?', (root, name)).fetchone()
+        finally:
+            conn.close()
+        return row and self._row(row) or None
+
+    def entries(self, root):
+        """\
+        Returns the entries of the workspaces within root sorted by name,
+        or None if root has not been indexed.  The entries are reconciled
+        with the workspaces within root first if it has changed since.
+        """
+
+        root = os.path.abspath(root)
+        conn = self._connect()
+        try:
+            row = conn.execute('SELECT mtime FROM roots WHERE root = ?',
+                (root,)).fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            return None
+        if row['mtime'] is None or row['mtime'] != os.stat(root).st_mtime:
+            self.reconcile(root)
+
+        conn = self._connect()
+        try:
+            return [self._row(row) for row in conn.execute(
+                'SELECT * FROM workspaces WHERE root = ? ORDER BY name',
+                (root,))]
+        finally:
+            conn.close()
+
+    def reconcile(self, root):
+        """\
+        Remove the entries of the workspaces no longer within root and
+        add those of the workspaces not indexed yet.
+        """
+
+        root = os.path.abspath(root)
+        mtime = _mtime(root, time())
+        names = _workspaces(root)
+        conn = self._connect()
+        try:
+            indexed = set(row['name'] for row in conn.execute(
+                'SELECT name FROM workspaces WHERE root = ?', (root,)))
+            conn.executemany('DELETE FROM workspaces WHERE root = ? AND '
+                'name = ?', [(root, name) for name in indexed - names])
+        finally:
+            conn.close()
+        for name in sorted(names - indexed):
+            path, info = _scan(os.path.join(root, name))
+            if info is not None:
+                self.update(path, info)
+
+        conn = self._connect()
+        try:
+            conn.execute('UPDATE roots SET mtime = ? WHERE root = ?',
+                (mtime, root))
+        finally:
+            conn.close()
+
+    def names(self, root):
+        """\
+        Returns the names of the workspaces within root, or None if root
+        has not been indexed.
+        """
+
+        entries = self.entries(root)
+        if entries is None:
+            return None
+        return [e['name'] for e in entries]
+
+    def rebuild(self, root, processes=None):
+        """\
+        Scan root for workspaces and replace its entries, examining the
+        workspaces on a pool of processes.  Returns the number of
+        workspaces indexed.
+        """
+
+        root = os.path.abspath(root)
+        now = time()
+        # taken before scanning, so changes during the scan are
+        # reconciled later.
+        mtime = _mtime(root, now)
+        paths = [os.path.join(root, name) for name in _workspaces(root)]
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        processes = max(1, min(processes, len(paths)))
+        if processes == 1:
+            results = map(_scan, paths)
+        else:
+            pool = multiprocessing.Pool(processes)
+            try:
+                results = pool.map(_scan, paths,
+                                   max(1, len(paths) // (processes * 4)))
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+
+        rows = [(root, os.path.basename(path), info['tip'], info['tipdate'],
+                 info['size'], info['branches'], now)
+                for path, info in results if info is not None]
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.execute('DELETE FROM workspaces WHERE root = ?', (root,))
+                conn.executemany('INSERT INTO workspaces (root, name, tip, '
+                    'tipdate, size, branches, updated) VALUES '
+                    '(?, ?, ?, ?, ?, ?, ?)', rows)
+                conn.execute('INSERT OR REPLACE INTO roots (root, rebuilt, '
+                    'mtime) VALUES (?, ?, ?)', (root, now, mtime))
+                conn.execute('COMMIT')
+            except:
+                conn.execute('ROLLBACK')
+                raise
+        finally:
+            conn.close()
+        return len(rows)
+
+
+class _config:
+    path = os.environ.get('PMR2_MERCURIAL_INDEX_DB') or None
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def configure(path=None):
+    """\
+    Use the index at path, or disable the index.
+    """
+
+    global _index
+    _index_lock.acquire()
+    try:
+        _config.path = path
+        _index = None
+    finally:
+        _index_lock.release()
+
+def get():
+    """\
+    Returns the configured index, or None if the index is disabled.
+    """
+
+    global _index
+    _index_lock.acquire()
+    try:
+        if _index is None and _config.path:
+            _index = WorkspaceIndex(_config.path)
+        return _index
+    finally:
+        _index_lock.release()
+
+def updated(path):
+    """\
+    Update the entry of the workspace at path in the configured index,
+    if any; failures are logged, as the index can be rebuilt.
+    """
+
+    try:
+        index = get()
+        if index is not None:
+            index.update(path)
+    except Exception:
+        logger.warning('cannot update the index for %s', path, exc_info=1)
+
+
+def main(args=None):
+    parser = optparse.OptionParser(
+        usage='%prog [options] rebuild|list|update path...')
+    parser.add_option('--db', default=_config.path,
+        help='path to the index database, default: %default')
+    parser.add_option('--processes', type='int', default=None,
+        help='number of processes used to rebuild, default: one per CPU')
+    options, args = parser.parse_args(args)
+    if len(args) < 2 or args[0] not in ('rebuild', 'list', 'update'):
+        parser.error('a command and at least one path are required')
+    if not options.db:
+        parser.error('no index database given')
+
+    index = WorkspaceIndex(options.db)
+    command, paths = args[0], args[1:]
+    for path in paths:
+        if command == 'rebuild':
+            start = time()
+            count = index.rebuild(path, options.processes)
+            print '%s: %d workspaces indexed in %.2fs' % (
+                path, count, time() - start)
+        elif command == 'list':
+            print json.dumps(index.entries(path), indent=2, sort_keys=True)
+        else:
+            print json.dumps(index.update(path), indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
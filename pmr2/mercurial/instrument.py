@@ -0,0 +1,195 @@
+"""\
+Opt-in timing instrumentation for the storage hot paths.
+
+Instrumentation is disabled by default, and a disabled wrapper costs a
+single attribute check per call.  Set the `PMR2_MERCURIAL_INSTRUMENT`
+environment variable to a non-empty value other than `0` to enable it
+at startup, or call `enable()`/`disable()` at runtime.
+
+Measurements accumulate in the module level `registry`, which can be
+dumped as JSON or scraped in the Prometheus text exposition format.
+"""
+
+import os
+import json
+import threading
+from time import time
+
+__all__ = [
+    'Registry',
+    'registry',
+    'enable',
+    'disable',
+    'enabled',
+    'timed',
+]
+
+
+class _state:
+    enabled = os.environ.get('PMR2_MERCURIAL_INSTRUMENT', '') not in (
+        '', '0')
+
+
+class Registry(object):
+    """\
+    Thread-safe aggregation of call statistics, keyed by name.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def record(self, name, elapsed, size=0, items=0, error=False):
+        self._lock.acquire()
+        try:
+            stat = self._stats.get(name)
+            if stat is None:
+                stat = self._stats[name] = {
+                    'calls': 0,
+                    'errors': 0,
+                    'seconds': 0.0,
+                    'min': elapsed,
+                    'max': elapsed,
+                    'bytes': 0,
+                    'items': 0,
+                }
+            stat['calls'] += 1
+            stat['errors'] += error and 1 or 0
+            stat['seconds'] += elapsed
+            stat['min'] = min(stat['min'], elapsed)
+            stat['max'] = max(stat['max'], elapsed)
+            stat['bytes'] += size
+            stat['items'] += items
+        finally:
+            self._lock.release()
+
+    def snapshot(self):
+        """\
+        Return a copy of the current statistics.
+        """
+
+        self._lock.acquire()
+        try:
+            return dict((k, dict(v)) for k, v in self._stats.iteritems())
+        finally:
+            self._lock.release()
+
+    def reset(self):
+        self._lock.acquire()
+        try:
+            self._stats.clear()
+        finally:
+            self._lock.release()
+
+    def dump(self):
+        """\
+        Return the statistics as a JSON string.
+        """
+
+        return json.dumps(self.snapshot(), indent=2, sort_keys=True)
+
+    def scrape(self, prefix='pmr2_mercurial'):
+        """\
+        Return the statistics in the Prometheus text format.
+        """
+
+        metrics = (
+            ('calls', 'calls_total', 'counter'),
+            ('errors', 'errors_total', 'counter'),
+            ('seconds', 'seconds_total', 'counter'),
+            ('max', 'seconds_max', 'gauge'),
+            ('bytes', 'bytes_total', 'counter'),
+            ('items', 'items_total', 'counter'),
+        )
+        stats = sorted(self.snapshot().iteritems())
+        lines = []
+        for key, suffix, kind in metrics:
+            metric = '%s_%s' % (prefix, suffix)
+            lines.append('# TYPE %s %s' % (metric, kind))
+            for name, stat in stats:
+                lines.append('%s{name="%s"} %s' % (metric, name, stat[key]))
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+
+
+def enable():
+    _state.enabled = True
+
+def disable():
+    _state.enabled = False
+
+def enabled():
+    return _state.enabled
+
+def _timed_iter(name, it, elapsed):
+    # account for the time spent producing each item, but not the time
+    # the consumer spends between items.
+    items = 0
+    size = 0
+    try:
+        while True:
+            start = time()
+            try:
+                item = it.next()
+            except StopIteration:
+                elapsed += time() - start
+                break
+            elapsed += time() - start
+            items += 1
+            if isinstance(item, str):
+                size += len(item)
+            yield item
+    except GeneratorExit:
+        # consumer stopped early, which is not an error.
+        registry.record(name, elapsed, size, items)
+        raise
+    except:
+        registry.record(name, elapsed, size, items, error=True)
+        raise
+    registry.record(name, elapsed, size, items)
+
+def timed(name, key=None):
+    """\
+    Decorator that records the calls to the wrapped function under
+    `name` while instrumentation is enabled.
+
+    key -
+        optional callable that is given the same arguments as the
+        wrapped function and returns a suffix for `name`, for metrics
+        that should be split further (e.g. by protocol command).  It is
+        only evaluated when instrumentation is enabled.
+
+    Strings returned count towards the bytes recorded, lists and tuples
+    towards the items.  Returned generators are wrapped so that the time
+    taken to produce each item is included once they are exhausted.
+    """
+
+    def decorator(func):
+        def wrapper(*a, **kw):
+            if not _state.enabled:
+                return func(*a, **kw)
+            label = name
+            if key is not None:
+                label = '%s.%s' % (name, key(*a, **kw))
+            start = time()
+            try:
+                result = func(*a, **kw)
+            except:
+                registry.record(label, time() - start, error=True)
+                raise
+            elapsed = time() - start
+            if isinstance(result, str):
+                registry.record(label, elapsed, size=len(result))
+            elif isinstance(result, (list, tuple)):
+                registry.record(label, elapsed, items=len(result))
+            elif hasattr(result, 'next') and hasattr(result, '__iter__'):
+                return _timed_iter(label, result, elapsed)
+            else:
+                registry.record(label, elapsed)
+            return result
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        wrapper.__dict__.update(func.__dict__)
+        return wrapper
+    return decorator
@@ -0,0 +1,476 @@
+"""\
+Workspace synchronization jobs.
+
+Syncs may be queued in a persistent queue, or run in bulk on a pool of
+processes with `sync_many`.
+
+Queued jobs are kept in a sqlite database, so they survive restarts and
+can be shared by several processes, and are run by a pool of worker
+threads.  A sync that is submitted while an identical one is still
+pending is merged into it, and jobs for the same workspace never run
+concurrently.
+
+The queue used by `MercurialStorageUtility` is configured with these
+environment variables:
+
+PMR2_MERCURIAL_JOBS_DB
+    path to the database.  Default: .pmr2.mercurial-jobs.db within the
+    repository root of the PMR2 settings.  No shared location (such as
+    the temporary directory) is used, as whoever can write to the
+    database decides what is pulled into the workspaces.
+PMR2_MERCURIAL_JOBS_WORKERS
+    number of worker threads.  Default: 2
+"""
+
+import os
+import json
+import socket
+import sqlite3
+import threading
+import traceback
+import multiprocessing
+from time import time
+from logging import getLogger
+
+from pmr2.mercurial import admission
+from pmr2.mercurial import backend
+from pmr2.mercurial import index
+from pmr2.mercurial import search
+
+__all__ = [
+    'JobQueue',
+    'sync',
+    'sync_many',
+    'queue',
+]
+
+logger = getLogger('pmr2.mercurial.jobs')
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+_schema = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    target TEXT NOT NULL,
+    source TEXT NOT NULL,
+    state TEXT NOT NULL,
+    owner TEXT,
+    submitted INTEGER NOT NULL DEFAULT 1,
+    created REAL NOT NULL,
+    started REAL,
+    finished REAL,
+    result TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, target);
+"""
+
+_fields = ('id', 'target', 'source', 'state', 'owner', 'submitted',
+           'created', 'started', 'finished', 'result', 'error')
+
+
+def sync(target, source):
+    """\
+    Pull the new changesets from source into the workspace at target,
+    returns the number of heads added.
+    """
+
+    sandbox = backend.Sandbox(target)
+    with admission.limit('sync'):
+        heads = sandbox.pull(source, update=False)
+    if heads:
+        index.updated(target)
+        search.updated(target)
+    return heads
+
+
+def _format_error(e):
+    return traceback.format_exception_only(type(e), e)[-1].strip()
+
+# source repositories opened by this process, for `sync_many`.
+_sources = {}
+
+def _sync_task(task):
+    target, source = task
+    start = time()
+    heads = error = None
+    try:
+        other = _sources.get(source)
+        if other is None:
+            other = _sources[source] = backend.Storage(source)._repo.peer()
+        sandbox = backend.Sandbox(target)
+        with admission.limit('sync'):
+            heads = sandbox.pull(source, update=False, other=other)
+        if heads:
+            index.updated(target)
+            search.updated(target)
+    except Exception, e:
+        logger.warning('sync of %s from %s failed', target, source,
+                       exc_info=1)
+        error = _format_error(e)
+    return {
+        'target': target,
+        'source': source,
+        'heads': heads,
+        'error': error,
+        'duration': time() - start,
+    }
+
+def _init_worker():
+    # the limiter copied from the parent may count its operations.
+    limiter = admission.limiter('sync')
+    if limiter is not None:
+        admission.configure('sync', limiter.concurrency, limiter.queue,
+                            limiter.timeout)
+
+def sync_many(pairs, processes=None):
+    """\
+    Sync many workspaces, each target path from its source path given
+    as pairs, on a pool of processes (by default, one per CPU; with 1
+    the syncs are run in this process).
+
+    Each process opens a source repository once and reuses it for the
+    targets it syncs from that source.  The same target is never synced
+    concurrently; the pulls take the lock of the target.
+
+    The pulls are admitted as sync operations (see `admission`).  As
+    the limits are kept by each process, the number of processes is
+    also capped at the sync concurrency, so the pool never pulls more
+    at a time than the limit allows.  Syncs rejected by the limit are
+    reported with their error.
+
+    Returns a list of dicts with the target, source, number of heads
+    added, error and duration of each sync, in the order of pairs.
+    Identical pairs are synced once.
+    """
+
+    pairs = list(pairs)
+    # group the tasks by source, so they are handed to the processes
+    # in runs that reuse the same source repository.
+    tasks = sorted(set(pairs), key=lambda p: (p[1], p[0]))
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    limiter = admission.limiter('sync')
+    if limiter is not None:
+        processes = min(processes, limiter.concurrency)
+    processes = max(1, min(processes, len(tasks)))
+
+    if processes == 1:
+        try:
+            results = map(_sync_task, tasks)
+        finally:
+            _sources.clear()
+    else:
+        chunksize = max(1, len(tasks) // (processes * 4))
+        pool = multiprocessing.Pool(processes, _init_worker)
+        try:
+            results = list(pool.imap_unordered(_sync_task, tasks,
+                                               chunksize))
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    results = dict(((r['target'], r['source']), r) for r in results)
+    return [dict(results[p]) for p in pairs]
+
+
+class JobQueue(object):
+    """\
+    Sync job queue stored at `path`, with `workers` threads running the
+    jobs through `runner`, a callable taking the target and source and
+    returning a JSON serializable result.
+    """
+
+    def __init__(self, path, workers=2, runner=sync, poll_interval=5.0):
+        self.path = path
+        self.workers = workers
+        self.runner = runner
+        self.poll_interval = poll_interval
+        self.owner = '%s:%d' % (socket.gethostname(), os.getpid())
+        self._cond = threading.Condition()
+        self._threads = []
+        self._stopping = False
+        conn = self._connect()
+        try:
+            conn.executescript(_schema)
+        finally:
+            conn.close()
+        self._recover()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _recover(self):
+        # jobs left running by processes on this host that have died.
+        host = socket.gethostname()
+        conn = self._connect()
+        try:
+            rows = conn.execute('SELECT id, owner FROM jobs WHERE state = ?',
+                                (RUNNING,)).fetchall()
+            for row in rows:
+                owner_host, pid = (row['owner'] or ':0').rsplit(':', 1)
+                if owner_host != host or _alive(int(pid)):
+                    continue
+                conn.execute('UPDATE jobs SET state = ?, owner = NULL, '
+                    'started = NULL WHERE id = ? AND state = ?',
+                    (PENDING, row['id'], RUNNING))
+        finally:
+            conn.close()
+
+    def submit(self, target, source):
+        """\
+        Queue a sync of target from source, returns the job id.  An
+        identical pending job is reused.
+        """
+
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = conn.execute('SELECT id FROM jobs WHERE state = ? AND '
+                    'target = ? AND source = ?',
+                    (PENDING, target, source)).fetchone()
+                if row is not None:
+                    job_id = row['id']
+                    conn.execute('UPDATE jobs SET submitted = submitted + 1 '
+                        'WHERE id = ?', (job_id,))
+                else:
+                    job_id = conn.execute('INSERT INTO jobs (target, source, '
+                        'state, created) VALUES (?, ?, ?, ?)',
+                        (target, source, PENDING, time())).lastrowid
+                conn.execute('COMMIT')
+            except:
+                conn.execute('ROLLBACK')
+                raise
+        finally:
+            conn.close()
+
+        self.start()
+        self._cond.acquire()
+        try:
+            self._cond.notify()
+        finally:
+            self._cond.release()
+        return job_id
+
+    def status(self, job_id):
+        """\
+        Returns the job as a dict, with the duration and the decoded
+        result, or None if there is no such job.
+        """
+
+        conn = self._connect()
+        try:
+            row = conn.execute('SELECT * FROM jobs WHERE id = ?',
+                               (job_id,)).fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            return None
+        result = dict((k, row[k]) for k in _fields)
+        if result['result'] is not None:
+            result['result'] = json.loads(result['result'])
+        result['duration'] = None
+        if result['started'] and result['finished']:
+            result['duration'] = result['finished'] - result['started']
+        return result
+
+    def jobs(self, target=None, state=None):
+        """\
+        Returns the ids of the jobs, optionally for a target and in a
+        state.
+        """
+
+        sql = 'SELECT id FROM jobs WHERE 1'
+        args = []
+        if target is not None:
+            sql += ' AND target = ?'
+            args.append(target)
+        if state is not None:
+            sql += ' AND state = ?'
+            args.append(state)
+        conn = self._connect()
+        try:
+            return [r['id'] for r in conn.execute(sql + ' ORDER BY id', args)]
+        finally:
+            conn.close()
+
+    def wait(self, job_id, timeout=None):
+        """\
+        Wait for the job to finish, returns its status.
+        """
+
+        end = timeout is not None and time() + timeout or None
+        while True:
+            result = self.status(job_id)
+            if result is None or result['state'] in (DONE, FAILED):
+                return result
+            remaining = end and end - time()
+            if remaining is not None and remaining <= 0:
+                return result
+            self._cond.acquire()
+            try:
+                self._cond.wait(min(remaining or 0.1, 0.1))
+            finally:
+                self._cond.release()
+
+    def purge(self, age):
+        """\
+        Delete the finished jobs older than age seconds.
+        """
+
+        conn = self._connect()
+        try:
+            return conn.execute('DELETE FROM jobs WHERE state IN (?, ?) AND '
+                'finished < ?', (DONE, FAILED, time() - age)).rowcount
+        finally:
+            conn.close()
+
+    def _claim(self):
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                # jobs for a workspace are run one at a time.
+                row = conn.execute('SELECT * FROM jobs WHERE state = ? AND '
+                    'target NOT IN (SELECT target FROM jobs WHERE state = ?) '
+                    'ORDER BY id LIMIT 1', (PENDING, RUNNING)).fetchone()
+                if row is not None:
+                    conn.execute('UPDATE jobs SET state = ?, owner = ?, '
+                        'started = ? WHERE id = ?',
+                        (RUNNING, self.owner, time(), row['id']))
+                conn.execute('COMMIT')
+            except:
+                conn.execute('ROLLBACK')
+                raise
+            return row
+        finally:
+            conn.close()
+
+    def _finish(self, job_id, state, result=None, error=None):
+        conn = self._connect()
+        try:
+            conn.execute('UPDATE jobs SET state = ?, finished = ?, '
+                'result = ?, error = ? WHERE id = ?', (state, time(),
+                    result is not None and json.dumps(result) or None, error,
+                    job_id))
+        finally:
+            conn.close()
+        self._cond.acquire()
+        try:
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+    def run_pending(self):
+        """\
+        Run the pending jobs that can be run in this thread, returns the
+        number of jobs run.
+        """
+
+        count = 0
+        while not self._stopping:
+            row = self._claim()
+            if row is None:
+                break
+            count += 1
+            try:
+                result = self.runner(row['target'], row['source'])
+            except Exception, e:
+                logger.warning('sync of %s from %s failed',
+                               row['target'], row['source'], exc_info=1)
+                self._finish(row['id'], FAILED, error=_format_error(e))
+            else:
+                self._finish(row['id'], DONE, result=result)
+        return count
+
+    def _work(self):
+        while not self._stopping:
+            try:
+                ran = self.run_pending()
+            except Exception:
+                logger.exception('job queue %s failed', self.path)
+                ran = 0
+            if ran:
+                continue
+            self._cond.acquire()
+            try:
+                if not self._stopping:
+                    self._cond.wait(self.poll_interval)
+            finally:
+                self._cond.release()
+
+    def start(self):
+        """\
+        Start the worker threads, if not already running.
+        """
+
+        self._cond.acquire()
+        try:
+            self._stopping = False
+            self._threads = [t for t in self._threads if t.isAlive()]
+            while len(self._threads) < self.workers:
+                t = threading.Thread(target=self._work,
+                    name='pmr2.mercurial.jobs-%d' % len(self._threads))
+                t.setDaemon(True)
+                t.start()
+                self._threads.append(t)
+        finally:
+            self._cond.release()
+
+    def stop(self, timeout=None):
+        """\
+        Stop the worker threads once their current jobs are done.
+        """
+
+        self._cond.acquire()
+        try:
+            self._stopping = True
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def queue(default=None):
+    """\
+    Returns the job queue configured by the environment, stored at the
+    default path if the environment does not give one.  Raises
+    ValueError if there is neither.
+    """
+
+    global _queue
+    _queue_lock.acquire()
+    try:
+        if _queue is None:
+            path = os.environ.get('PMR2_MERCURIAL_JOBS_DB') or default
+            if not path:
+                raise ValueError('no job queue database configured; set '
+                                 'PMR2_MERCURIAL_JOBS_DB')
+            workers = int(os.environ.get('PMR2_MERCURIAL_JOBS_WORKERS', 2))
+            _queue = JobQueue(path, workers)
+        return _queue
+    finally:
+        _queue_lock.release()
@@ -0,0 +1,275 @@
+"""\
+Sampling profiler for slow storage requests.
+
+Profiling is off unless a profile directory is configured, either with
+`configure()` or through these environment variables:
+
+PMR2_MERCURIAL_PROFILE_DIR
+    directory the profiles are written to; enables profiling.
+PMR2_MERCURIAL_PROFILE_RATE
+    fraction of requests (0.0 - 1.0) profiled with cProfile, written
+    as `.prof` files readable by `pstats`.  Default: 0
+PMR2_MERCURIAL_PROFILE_THRESHOLD
+    requests taking at least this many seconds have the stacks
+    collected by a background sampler written out as `.stacks` files,
+    in the collapsed format used by flame graph tools.  Default: unset
+PMR2_MERCURIAL_PROFILE_KEEP
+    number of profiles to keep in the directory.  Default: 100
+
+File names are tagged with the time, duration, method, revision and
+workspace path of the request.
+"""
+
+import os
+import re
+import sys
+import time
+import random
+import cProfile
+import threading
+import itertools
+from collections import defaultdict
+
+__all__ = [
+    'configure',
+    'profiled',
+]
+
+
+class _config:
+    directory = None
+    rate = 0.0
+    threshold = None
+    keep = 100
+    interval = 0.01
+
+
+class _local(threading.local):
+    # set while a request in this thread is being profiled, so nested
+    # profiled calls are not profiled again.
+    active = False
+
+
+_local = _local()
+
+
+def configure(directory=None, rate=0.0, threshold=None, keep=100,
+              interval=0.01):
+    """\
+    Configure the profiler; a `directory` of None disables it.
+    """
+
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    _config.directory = directory
+    _config.rate = rate
+    _config.threshold = threshold
+    _config.keep = keep
+    _config.interval = interval
+
+def _configure_from_environ(environ=os.environ):
+    threshold = environ.get('PMR2_MERCURIAL_PROFILE_THRESHOLD')
+    configure(
+        directory=environ.get('PMR2_MERCURIAL_PROFILE_DIR') or None,
+        rate=float(environ.get('PMR2_MERCURIAL_PROFILE_RATE', 0)),
+        threshold=threshold and float(threshold) or None,
+        keep=int(environ.get('PMR2_MERCURIAL_PROFILE_KEEP', 100)),
+    )
+
+
+class _Sampler(object):
+    """\
+    Background thread that periodically records the stacks of the
+    threads registered with it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._threads = {}
+        self._thread = None
+
+    def _ensure_started(self):
+        if self._thread is None or not self._thread.isAlive():
+            self._thread = threading.Thread(target=self._run,
+                name='pmr2.mercurial.profiler')
+            self._thread.setDaemon(True)
+            self._thread.start()
+
+    def register(self, counts):
+        ident = threading.currentThread().ident
+        self._lock.acquire()
+        try:
+            self._threads[ident] = counts
+            self._ensure_started()
+        finally:
+            self._lock.release()
+        self._wakeup.set()
+
+    def unregister(self):
+        ident = threading.currentThread().ident
+        self._lock.acquire()
+        try:
+            self._threads.pop(ident, None)
+        finally:
+            self._lock.release()
+
+    def _run(self):
+        while True:
+            if not self._threads:
+                self._wakeup.wait()
+                self._wakeup.clear()
+            time.sleep(_config.interval)
+            frames = sys._current_frames()
+            self._lock.acquire()
+            try:
+                for ident, counts in self._threads.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        counts[_collapse(frame)] += 1
+            finally:
+                self._lock.release()
+
+_sampler = _Sampler()
+
+
+def _collapse(frame):
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append('%s:%s:%d' % (os.path.basename(code.co_filename),
+                                   code.co_name, frame.f_lineno))
+        frame = frame.f_back
+    stack.reverse()
+    return ';'.join(stack)
+
+def _slug(value, length=80):
+    return re.sub(r'[^\w.]+', '-', value or '').strip('-')[-length:]
+
+def _rotate(directory, keep):
+    names = sorted(os.listdir(directory))
+    for name in names[:max(0, len(names) - keep)]:
+        try:
+            os.unlink(os.path.join(directory, name))
+        except OSError:
+            pass
+
+_sequence = itertools.count()
+
+def _filename(start, elapsed, method, path, rev, ext):
+    # the sequence keeps requests finishing within the same millisecond
+    # from overwriting each other.
+    stamp = time.strftime('%Y%m%dT%H%M%S', time.gmtime(start))
+    return '%s.%03d-%04d-%dms-%s-%s-%s.%s' % (stamp,
+        int(start * 1000) % 1000, _sequence.next() % 10000,
+        int(elapsed * 1000), _slug(method), _slug(rev)[:12] or 'none',
+        _slug(path), ext)
+
+
+class _Session(object):
+    """\
+    Profiling of a single request, which may be suspended and resumed
+    when the request returns a generator.
+    """
+
+    def __init__(self, sampled):
+        self.elapsed = 0.0
+        self.profile = None
+        self.counts = None
+        if sampled:
+            self.profile = cProfile.Profile()
+        else:
+            self.counts = defaultdict(int)
+
+    def resume(self):
+        _local.active = True
+        self._start = time.time()
+        if self.profile is not None:
+            self.profile.enable()
+        else:
+            _sampler.register(self.counts)
+
+    def suspend(self):
+        if self.profile is not None:
+            self.profile.disable()
+        else:
+            _sampler.unregister()
+        self.elapsed += time.time() - self._start
+        _local.active = False
+
+    def finish(self, start, method, tags):
+        if self.profile is None and self.elapsed < _config.threshold:
+            return
+        directory = _config.directory
+        if not directory:
+            return
+        path, rev = tags()
+        if self.profile is not None:
+            name = _filename(start, self.elapsed, method, path, rev, 'prof')
+            self.profile.dump_stats(os.path.join(directory, name))
+        else:
+            name = _filename(start, self.elapsed, method, path, rev,
+                             'stacks')
+            f = open(os.path.join(directory, name), 'w')
+            for stack, count in sorted(self.counts.iteritems()):
+                f.write('%s %d\n' % (stack, count))
+            f.close()
+        _rotate(directory, _config.keep)
+
+
+def _profiled_iter(session, it, start, method, tags):
+    try:
+        while True:
+            session.resume()
+            try:
+                item = it.next()
+            except StopIteration:
+                break
+            finally:
+                session.suspend()
+            yield item
+    finally:
+        session.finish(start, method, tags)
+
+def profiled(method, tags):
+    """\
+    Decorator that profiles the wrapped function as `method`.
+
+    tags -
+        callable that is given the same arguments as the wrapped
+        function and returns a tuple of the workspace path and revision
+        for naming the profile.  It is only called when a profile is
+        written.
+    """
+
+    def decorator(func):
+        def wrapper(*a, **kw):
+            if _config.directory is None or _local.active:
+                return func(*a, **kw)
+            sampled = _config.rate and random.random() < _config.rate
+            if not sampled and _config.threshold is None:
+                return func(*a, **kw)
+
+            session = _Session(sampled)
+            start = time.time()
+            gettags = lambda: tags(*a, **kw)
+            session.resume()
+            try:
+                result = func(*a, **kw)
+            except:
+                session.suspend()
+                session.finish(start, method, gettags)
+                raise
+            session.suspend()
+            if hasattr(result, 'next') and hasattr(result, '__iter__'):
+                return _profiled_iter(session, result, start, method,
+                                      gettags)
+            session.finish(start, method, gettags)
+            return result
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        wrapper.__dict__.update(func.__dict__)
+        return wrapper
+    return decorator
+
+_configure_from_environ()
@@ -0,0 +1,268 @@
+"""\
+Compact records for directory listing, log, annotation and grep entries.
+
+A record holds its fields in slots rather than in a dict per entry, and
+a field may hold a `lazy` value, which is only computed when the field
+is first read.  Records provide the mapping interface of the dicts they
+replace; the slots are named after the fields with a leading underscore,
+so the raw values are not reachable as attributes of the field names
+(e.g. through traversal, which tries attributes before items).
+"""
+
+__all__ = [
+    'lazy',
+    'resolve',
+    'Record',
+    'DirEntry',
+    'LogEntry',
+    'AnnotateLine',
+    'GrepMatch',
+]
+
+
+class lazy(object):
+    """\
+    A field value computed as `func(*args)` when first read.
+    """
+
+    __slots__ = ('func', 'args')
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __call__(self):
+        return self.func(*self.args)
+
+
+def resolve(fields):
+    """\
+    Return a copy of the fields dict with the lazy values computed.
+    """
+
+    return dict((k, type(v) is lazy and v() or v)
+                for k, v in fields.iteritems())
+
+
+class _Unset(object):
+    __slots__ = ()
+
+    def __repr__(self):
+        return '<unset>'
+
+_unset = _Unset()
+
+
+def _slots(fields):
+    return tuple('_' + name for name in fields)
+
+
+class Record(object):
+    """\
+    Mapping with a fixed set of fields kept in slots.  Keys outside of
+    `fields` that are assigned are kept in a dict of their own, and the
+    fields that were not given are looked up through `_fallback`.
+    """
+
+    __slots__ = ('_extra',)
+
+    # names of the fields, which subclasses also declare as slots with a
+    # leading underscore.
+    fields = ()
+    _fieldset = frozenset()
+
+    def __init__(self, **kw):
+        for name in self.fields:
+            setattr(self, '_' + name, kw.pop(name, _unset))
+        self._extra = kw or None
+
+    def _fallback(self, key):
+        raise KeyError(key)
+
+    def _fallback_keys(self):
+        return []
+
+    def __getitem__(self, key):
+        extra = self._extra
+        if extra is not None and key in extra:
+            return extra[key]
+        if key in self._fieldset:
+            value = getattr(self, '_' + key)
+            if type(value) is lazy:
+                value = value()
+                setattr(self, '_' + key, value)
+            if value is not _unset:
+                return value
+        return self._fallback(key)
+
+    def __setitem__(self, key, value):
+        if key in self._fieldset:
+            setattr(self, '_' + key, value)
+            return
+        if self._extra is None:
+            self._extra = {}
+        self._extra[key] = value
+
+    def __delitem__(self, key):
+        if self._extra is not None and key in self._extra:
+            del self._extra[key]
+        elif (key in self._fieldset and
+                getattr(self, '_' + key) is not _unset):
+            setattr(self, '_' + key, _unset)
+        else:
+            raise KeyError(key)
+
+    def keys(self):
+        result = [k for k in self.fields
+                  if getattr(self, '_' + k) is not _unset]
+        seen = set(result)
+        for k in self._fallback_keys():
+            if k not in seen:
+                result.append(k)
+                seen.add(k)
+        if self._extra:
+            result.extend(k for k in self._extra if k not in seen)
+        return result
+
+    def __contains__(self, key):
+        return key in self.keys()
+
+    has_key = __contains__
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    iterkeys = __iter__
+
+    def __len__(self):
+        return len(self.keys())
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def iteritems(self):
+        for k in self.keys():
+            yield k, self[k]
+
+    def items(self):
+        return list(self.iteritems())
+
+    def itervalues(self):
+        for k in self.keys():
+            yield self[k]
+
+    def values(self):
+        return list(self.itervalues())
+
+    def copy(self):
+        return dict(self.iteritems())
+
+    def update(self, other=(), **kw):
+        if hasattr(other, 'keys'):
+            other = [(k, other[k]) for k in other.keys()]
+        for k, v in other:
+            self[k] = v
+        for k, v in kw.iteritems():
+            self[k] = v
+
+    def __eq__(self, other):
+        if isinstance(other, (Record, dict)):
+            return self.copy() == dict(other.items())
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '<%s %r>' % (type(self).__name__, self.copy())
+
+
+class DirEntry(Record):
+    """\
+    Entry of a directory listing, as produced by `BaseStorage.format`
+    for the storage.  The keys that only format provides, and the fields
+    that were not given, are all taken from a single call of format with
+    every other field resolved, when the first of them is read.
+    """
+
+    fields = ('permissions', 'contenttype', 'node', 'date', 'size', 'file',
+              'basename', 'desc', 'author', 'contents', 'fullpath',
+              'external')
+    _fieldset = frozenset(fields)
+    __slots__ = _slots(fields) + ('_storage',)
+
+    # keys only provided by format.
+    _format_keys = ('baseview', 'mimetype')
+    _keys = fields + _format_keys
+
+    def __init__(self, storage, path, **kw):
+        self._storage = storage
+        kw.setdefault('basename', lazy(storage.basename, path))
+        Record.__init__(self, file=path, **kw)
+
+    def _fallback(self, key):
+        if key not in self._fieldset and key not in self._format_keys:
+            raise KeyError(key)
+        kw = dict(self._extra or ())
+        for name in self.fields:
+            if getattr(self, '_' + name) is not _unset:
+                kw[name == 'file' and 'path' or name] = self[name]
+        result = self._storage.format(**kw)
+        for k, v in result.iteritems():
+            if k in self._fieldset:
+                if getattr(self, '_' + k) is _unset:
+                    self[k] = v
+            elif self._extra is None or k not in self._extra:
+                self[k] = v
+        return result[key]
+
+    def keys(self):
+        if not self._extra:
+            return list(self._keys)
+        return list(self._keys) + [k for k in self._extra
+                                   if k not in self._keys]
+
+    def __contains__(self, key):
+        return (key in self._fieldset or key in self._format_keys or
+                bool(self._extra) and key in self._extra)
+
+    has_key = __contains__
+
+
+class LogEntry(Record):
+    """\
+    Entry of a changelog listing.
+    """
+
+    fields = ('parity', 'author', 'parent', 'child', 'changelogtag', 'desc',
+              'date', 'files', 'rev', 'node', 'tags', 'inbranch', 'branches')
+    _fieldset = frozenset(fields)
+    __slots__ = _slots(fields)
+
+
+class AnnotateLine(Record):
+    """\
+    Line of an annotated file.
+    """
+
+    fields = ('rev', 'author', 'date', 'line')
+    _fieldset = frozenset(fields)
+    __slots__ = _slots(fields)
+
+
+class GrepMatch(Record):
+    """\
+    Line of a file matching a pattern.
+    """
+
+    fields = ('file', 'lineno', 'line')
+    _fieldset = frozenset(fields)
+    __slots__ = _slots(fields)
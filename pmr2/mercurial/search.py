@@ -0,0 +1,225 @@
+"""\
+Full text index of the changesets of a workspace.
+
+The description, author and the paths of the files touched by each
+changeset are indexed in a sqlite database within the cache directory of
+the repository, using the FTS4 extension of sqlite where it is available
+and LIKE queries otherwise.  The index is brought up to date with the
+changesets added since it was last updated when changesets are pushed or
+pulled into the workspace, and before it is searched.
+"""
+
+import os
+import sqlite3
+from logging import getLogger
+
+from mercurial import encoding
+from mercurial import hg
+from mercurial import ui
+from mercurial.node import hex
+
+__all__ = [
+    'LogIndex',
+    'updated',
+]
+
+logger = getLogger('pmr2.mercurial.search')
+
+_dbname = 'cache/pmr2-search.db'
+
+_schema = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+_fts_table = """
+CREATE VIRTUAL TABLE changesets USING fts4(author, description, files)
+"""
+
+_plain_table = """
+CREATE TABLE changesets (
+    docid INTEGER PRIMARY KEY,
+    author TEXT,
+    description TEXT,
+    files TEXT
+)
+"""
+
+_like = ("(author LIKE ? ESCAPE '\\' OR description LIKE ? ESCAPE '\\' OR "
+         "files LIKE ? ESCAPE '\\')")
+
+
+def _text(s):
+    if isinstance(s, unicode):
+        return s
+    # local strings from the changelog keep their UTF-8 original.
+    return encoding.fromlocal(s).decode('utf8', 'replace')
+
+
+class LogIndex(object):
+    """\
+    Index of the changesets of repo, kept within its cache directory.
+    The FTS4 extension is not used if fts is False, or if sqlite was
+    built without it.
+    """
+
+    def __init__(self, repo, fts=True):
+        self.repo = repo
+        self.path = repo.join(_dbname)
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        conn = self._connect()
+        try:
+            self.fts = self._created(conn)
+            if self.fts is None:
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    self.fts = self._init(conn, fts)
+                    conn.execute('COMMIT')
+                except:
+                    conn.execute('ROLLBACK')
+                    raise
+        finally:
+            conn.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def _created(self, conn):
+        # whether FTS4 is used, or None if the index is not created yet;
+        # read only, so opening an index does not wait for writers.
+        try:
+            row = conn.execute("SELECT value FROM meta WHERE key = 'fts'"
+                ).fetchone()
+        except sqlite3.OperationalError:
+            return None
+        if row is None:
+            return None
+        return row[0] == '1'
+
+    def _init(self, conn, fts):
+        conn.execute(_schema)
+        row = conn.execute("SELECT value FROM meta WHERE key = 'fts'"
+            ).fetchone()
+        if row is not None:
+            return row[0] == '1'
+        if fts:
+            try:
+                conn.execute(_fts_table)
+            except sqlite3.OperationalError:
+                # no FTS4 within this sqlite.
+                fts = False
+        if not fts:
+            conn.execute(_plain_table)
+        conn.execute("INSERT INTO meta (key, value) VALUES ('fts', ?)",
+            (fts and '1' or '0',))
+        return fts
+
+    def _get(self, conn, key):
+        row = conn.execute('SELECT value FROM meta WHERE key = ?',
+            (key,)).fetchone()
+        return row and row[0] or None
+
+    def _set(self, conn, key, value):
+        conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+            (key, value))
+
+    def _current(self, conn, cl):
+        count = int(self._get(conn, 'count') or 0)
+        return count == len(cl) and (not count or
+            hex(cl.node(count - 1)) == self._get(conn, 'last'))
+
+    def update(self):
+        """\
+        Index the changesets added since the last update, starting over
+        if the changesets indexed are no longer in the repository.
+        Returns the number of changesets indexed.  Nothing is locked if
+        the index is already up to date.
+        """
+
+        cl = self.repo.changelog
+        conn = self._connect()
+        try:
+            if self._current(conn, cl):
+                return 0
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                count = int(self._get(conn, 'count') or 0)
+                if count and (count > len(cl) or
+                        hex(cl.node(count - 1)) != self._get(conn, 'last')):
+                    conn.execute('DELETE FROM changesets')
+                    count = 0
+                rows = []
+                for rev in xrange(count, len(cl)):
+                    changes = cl.read(cl.node(rev))
+                    rows.append((rev, _text(changes[1]), _text(changes[4]),
+                                 _text('\n'.join(changes[3]))))
+                conn.executemany('INSERT INTO changesets (docid, author, '
+                    'description, files) VALUES (?, ?, ?, ?)', rows)
+                if len(cl):
+                    self._set(conn, 'count', str(len(cl)))
+                    self._set(conn, 'last', hex(cl.node(len(cl) - 1)))
+                conn.execute('COMMIT')
+            except:
+                conn.execute('ROLLBACK')
+                raise
+        finally:
+            conn.close()
+        return len(rows)
+
+    def search(self, query, limit=20, cursor=None):
+        """\
+        Returns the revisions (newest first) of up to limit changesets
+        with descriptions, authors or paths matching every word of the
+        query (as a prefix, with FTS4) and older than the cursor, and the
+        cursor for the next page, or None if there are no more matches.
+        """
+
+        terms = [t.replace('"', '') for t in _text(query).split()]
+        terms = [t for t in terms if t]
+        if not terms:
+            return [], None
+
+        if self.fts:
+            sql = 'SELECT docid FROM changesets WHERE changesets MATCH ?'
+            args = [' '.join('"%s*"' % t for t in terms)]
+        else:
+            sql = 'SELECT docid FROM changesets WHERE ' + ' AND '.join(
+                [_like] * len(terms))
+            args = []
+            for t in terms:
+                t = t.replace('\\', '\\\\').replace('%', '\\%').replace(
+                    '_', '\\_')
+                args.extend(['%' + t + '%'] * 3)
+        if cursor is not None:
+            sql += ' AND docid < ?'
+            args.append(int(cursor))
+        sql += ' ORDER BY docid DESC LIMIT ?'
+        args.append(limit + 1)
+
+        conn = self._connect()
+        try:
+            revs = [row[0] for row in conn.execute(sql, args)]
+        finally:
+            conn.close()
+        if len(revs) > limit:
+            return revs[:limit], revs[limit - 1]
+        return revs, None
+
+
+def updated(path):
+    """\
+    Index the changesets added to the workspace at path; failures are
+    logged, as the index is also updated before it is searched.
+    """
+
+    try:
+        u = ui.ui()
+        u.setconfig('ui', 'quiet', 'on')
+        u.setconfig('ui', 'report_untrusted', 'off')
+        LogIndex(hg.repository(u, path)).update()
+    except Exception:
+        logger.warning('cannot update the log index of %s', path,
+                       exc_info=1)
@@ -0,0 +1,193 @@
+"""\
+Benchmarks for the storage entry points against synthetic repositories.
+
+Run this module directly to generate a repository with the requested
+shape and print the timings as JSON, for example::
+
+    python -m pmr2.mercurial.tests.benchmark --files 5000 --depth 4 \\
+        --revisions 200 --output bench_output.txt
+"""
+
+import sys
+import gc
+import json
+import time
+import shutil
+import tempfile
+import resource
+import optparse
+from os.path import basename, join
+
+import zope.component
+import zope.interface
+from zope.component.hooks import getSiteManager
+
+from mercurial import util as hgutil
+from mercurial.node import hex
+
+from pmr2.app.settings.interfaces import IPMR2GlobalSettings
+from pmr2.app.workspace.interfaces import IWorkspace
+
+from pmr2.mercurial.utility import MercurialStorage
+from pmr2.mercurial.tests import synthetic
+from pmr2.mercurial.tests import util
+
+__all__ = [
+    'run',
+    'main',
+]
+
+
+class BenchmarkWorkspace(object):
+    zope.interface.implements(IWorkspace)
+
+    def __init__(self, path):
+        self.path = path
+        self.storage = 'mercurial'
+
+    @property
+    def id(self):
+        return basename(self.path)
+
+
+class BenchmarkSettings(object):
+    zope.interface.implements(IPMR2GlobalSettings)
+
+    def dirOf(self, obj):
+        return obj.path
+
+    dirCreatedFor = dirOf
+
+
+def _maxrss():
+    # kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def _consume(result):
+    # generators must be exhausted for the work to be done.
+    if isinstance(result, basestring):
+        return len(result)
+    count = 0
+    for i in result:
+        count += 1
+    return count
+
+def measure(func, repeat=3):
+    """\
+    Call `func` `repeat` times and return the timing and memory summary.
+    """
+
+    timings = []
+    rss = _maxrss()
+    gc.collect()
+    for i in xrange(repeat):
+        start = time.time()
+        size = _consume(func())
+        timings.append(time.time() - start)
+    return {
+        'repeat': repeat,
+        'min': min(timings),
+        'max': max(timings),
+        'mean': sum(timings) / len(timings),
+        'items': size,
+        'maxrss_kb': _maxrss(),
+        'maxrss_delta_kb': _maxrss() - rss,
+    }
+
+def _protocol(storage, cmd, **kw):
+    kw['cmd'] = cmd
+    def call():
+        request = util.build_wsgi_request('workspace_view', kw)
+        return storage.storage.process_request(request)
+    return call
+
+def entry_points(storage):
+    """\
+    Return the list of (name, callable) to be measured for `storage`.
+    """
+
+    files = storage.files()
+    deepest = max(files, key=lambda p: (p.count('/'), p))
+    subdir = '/'.join(deepest.split('/')[:-1])
+    heads = ' '.join(hex(n) for n in storage.storage._repo.heads())
+
+    return [
+        ('files', storage.files),
+        ('listdir_root', lambda: storage.listdir('')),
+        ('listdir_deep', lambda: storage.listdir(subdir)),
+        ('pathinfo_file', lambda: [storage.pathinfo(deepest)]),
+        ('fileinfo', lambda: [storage.fileinfo(deepest)]),
+        ('file', lambda: storage.file(deepest)),
+        ('log', lambda: storage.log(storage.rev, 50)),
+        ('shortlog', lambda: storage.log(storage.rev, 50, shortlog=True)),
+        ('hg_archive_zip', lambda: storage.hg_archive('bench', 'zip')),
+        ('hg_archive_tgz', lambda: storage.hg_archive('bench', 'tgz')),
+        ('process_request_capabilities', _protocol(storage, 'capabilities')),
+        ('process_request_heads', _protocol(storage, 'heads')),
+        ('process_request_getbundle', _protocol(storage, 'getbundle',
+            heads=heads.replace(' ', '+'), common='0' * 40)),
+    ]
+
+def run(params, repeat=3, workdir=None, keep=False):
+    """\
+    Generate a repository with `params` (see synthetic.generate) and
+    return the benchmark results as a dict.
+    """
+
+    params = dict(synthetic.DEFAULTS, **params)
+    testdir = tempfile.mkdtemp(dir=workdir)
+    try:
+        path = join(testdir, 'synthetic')
+        start = time.time()
+        nodes = synthetic.generate(path, **params)
+        generated = time.time() - start
+
+        getSiteManager().registerUtility(
+            BenchmarkSettings(), IPMR2GlobalSettings)
+        storage = MercurialStorage(BenchmarkWorkspace(path))
+
+        results = {}
+        for name, func in entry_points(storage):
+            results[name] = measure(func, repeat)
+
+        return {
+            'params': params,
+            'mercurial': hgutil.version(),
+            'python': sys.version.split()[0],
+            'tip': hex(nodes[-1]),
+            'generate_seconds': generated,
+            'results': results,
+        }
+    finally:
+        if keep:
+            sys.stderr.write('repository kept at %s\n' % testdir)
+        else:
+            shutil.rmtree(testdir)
+
+def main(args=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    for name, default in sorted(synthetic.DEFAULTS.iteritems()):
+        parser.add_option('--%s' % name, type='int', default=default,
+            help='default: %default')
+    parser.add_option('--repeat', type='int', default=3,
+        help='number of calls per entry point, default: %default')
+    parser.add_option('--workdir', default=None,
+        help='directory to generate the repository in')
+    parser.add_option('--keep', action='store_true', default=False,
+        help='keep the generated repository')
+    parser.add_option('--output', default=None,
+        help='write results to this file instead of stdout')
+    options, args = parser.parse_args(args)
+
+    params = dict((k, getattr(options, k)) for k in synthetic.DEFAULTS)
+    result = run(params, options.repeat, options.workdir, options.keep)
+    output = json.dumps(result, indent=2, sort_keys=True)
+    if options.output:
+        f = open(options.output, 'w')
+        f.write(output + '\n')
+        f.close()
+    else:
+        print output
+
+if __name__ == '__main__':
+    main()
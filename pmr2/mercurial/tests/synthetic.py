@@ -0,0 +1,117 @@
+"""\
+Deterministic generator of synthetic Mercurial repositories.
+
+The same parameters always produce the same repository, down to the
+changeset ids, so benchmark results can be compared across releases.
+"""
+
+import random
+
+from mercurial import context
+from mercurial.node import nullid
+
+from pmr2.mercurial.backend import Storage
+
+__all__ = [
+    'DEFAULTS',
+    'generate',
+]
+
+DEFAULTS = {
+    'files': 1000,
+    'depth': 3,
+    'revisions': 50,
+    'size': 2048,
+    'branches': 1,
+    'seed': 0,
+}
+
+_words = (
+    'model', 'component', 'variable', 'units', 'initial_value', 'math',
+    'connection', 'map_variables', 'reaction', 'membrane', 'potential',
+    'current', 'channel', 'gate', 'time', 'second', 'millivolt', 'cell',
+)
+
+_user = 'Synthetic User <synthetic@example.com>'
+
+
+def _lines(rng, count=64):
+    result = []
+    for i in xrange(count):
+        words = [rng.choice(_words) for j in xrange(rng.randint(3, 12))]
+        result.append('  <%s/>\n' % ' '.join(words))
+    return result
+
+def _content(rng, lines, size):
+    result = []
+    length = 0
+    while length < size:
+        line = lines[rng.randrange(len(lines))]
+        result.append(line)
+        length += len(line)
+    return ''.join(result)[:size]
+
+def _paths(rng, files, depth):
+    fanout = max(2, int(round(files ** (1.0 / (depth + 1)))))
+    paths = set()
+    while len(paths) < files:
+        dirs = ['dir%02d' % rng.randrange(fanout)
+                for i in xrange(rng.randint(0, depth))]
+        paths.add('/'.join(dirs + ['file%05d.xml' % len(paths)]))
+    return sorted(paths)
+
+def generate(path, files=DEFAULTS['files'], depth=DEFAULTS['depth'],
+             revisions=DEFAULTS['revisions'], size=DEFAULTS['size'],
+             branches=DEFAULTS['branches'], seed=DEFAULTS['seed']):
+    """\
+    Create a repository at `path` and populate it.
+
+    files -
+        number of files in the manifest.
+    depth -
+        maximum directory depth of the files.
+    revisions -
+        number of changesets; the first one adds every file, the rest
+        each modify a small sample of them.
+    size -
+        approximate size of each file in bytes.
+    branches -
+        number of named branches the revisions are spread across.
+    seed -
+        seed for the random number generator.
+
+    Returns the list of the changeset nodes generated.
+    """
+
+    rng = random.Random(seed)
+    Storage.create(path)
+    repo = Storage(path)._repo
+    lines = _lines(rng)
+    paths = _paths(rng, files, depth)
+    contents = {}
+    heads = {}
+    nodes = []
+
+    def filectxfn(repo, memctx, path):
+        return context.memfilectx(path, contents[path])
+
+    for rev in xrange(revisions):
+        if rev == 0:
+            changed = paths
+            branch = 'default'
+        else:
+            changed = rng.sample(paths, max(1, min(len(paths), files // 100)))
+            branch = rev % branches and 'branch%d' % (rev % branches) or \
+                'default'
+        for p in changed:
+            contents[p] = _content(rng, lines, size)
+        parent = heads.get(branch, nodes and nodes[0] or nullid)
+        ctx = context.memctx(repo, (parent, None),
+                             'synthetic revision %d' % rev, changed,
+                             filectxfn, _user, '%d 0' % (rev * 3600),
+                             {'branch': branch})
+        node = repo.commitctx(ctx)
+        heads[branch] = node
+        nodes.append(node)
+
+    return nodes
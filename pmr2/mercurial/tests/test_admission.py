@@ -0,0 +1,112 @@
+import unittest
+import tempfile
+import shutil
+import threading
+import time
+from os.path import join
+
+from pmr2.mercurial import *
+from pmr2.mercurial import admission
+from pmr2.mercurial.admission import Limiter, OperationRejectedError
+from pmr2.mercurial.tests import util
+
+
+class LimiterTestCase(unittest.TestCase):
+
+    def test_admit_and_reject(self):
+        limiter = Limiter('test', 1, queue=0)
+        limiter.acquire()
+        self.assertRaises(OperationRejectedError, limiter.acquire)
+        limiter.release()
+        limiter.acquire()
+        limiter.release()
+        stats = limiter.stats()
+        self.assertEqual(stats['admitted'], 2)
+        self.assertEqual(stats['rejected'], 1)
+        self.assertEqual(stats['active'], 0)
+
+    def test_timeout(self):
+        limiter = Limiter('test', 1, queue=1, timeout=0.05)
+        limiter.acquire()
+        self.assertRaises(OperationRejectedError, limiter.acquire)
+        stats = limiter.stats()
+        self.assertEqual(stats['timedout'], 1)
+        self.assertEqual(stats['waiting'], 0)
+        limiter.release()
+
+    def test_queued(self):
+        limiter = Limiter('test', 1, queue=1, timeout=5)
+        limiter.acquire()
+        result = []
+
+        def waiter():
+            limiter.acquire()
+            result.append(True)
+            limiter.release()
+
+        t = threading.Thread(target=waiter)
+        t.start()
+        while not limiter.stats()['waiting']:
+            time.sleep(0.01)
+        # the queue is full.
+        self.assertRaises(OperationRejectedError, limiter.acquire)
+        limiter.release()
+        t.join()
+        self.assertEqual(result, [True])
+        self.assertEqual(limiter.stats()['admitted'], 2)
+
+    def test_limit(self):
+        admission.configure('test', 1)
+        try:
+            with admission.limit('test'):
+                self.assertEqual(admission.stats()['test']['active'], 1)
+            self.assertEqual(admission.stats()['test']['active'], 0)
+        finally:
+            admission.configure('test')
+        self.assertFalse('test' in admission.stats())
+
+    def test_command_class(self):
+        self.assertEqual(admission.command_class('getbundle'), 'clone')
+        self.assertEqual(admission.command_class('unbundle'), 'push')
+        self.assertEqual(admission.command_class('heads'), None)
+
+
+class ProtocolAdmissionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        self.repodir = join(self.testdir, 'repodir')
+        Sandbox.create(self.repodir, True)
+        sandbox = Sandbox(self.repodir)
+        sandbox.add_file_content('file1', 'file1')
+        sandbox.commit('added1', 'user1 <1@example.com>')
+        admission.configure('clone', 0)
+
+    def tearDown(self):
+        admission.configure('clone')
+        shutil.rmtree(self.testdir)
+
+    def test_rejected(self):
+        storage = WebStorage(self.repodir)
+        request = util.build_wsgi_request('script', {
+            'cmd': 'getbundle', 'heads': storage.rev, 'common': '0' * 40})
+        result = storage.process_request(request)
+        self.assertTrue('clone operation rejected' in result)
+        self.assertEqual(request.response.getStatus(), 503)
+
+    def test_unrestricted(self):
+        storage = WebStorage(self.repodir)
+        request = util.build_wsgi_request('script', {'cmd': 'heads'})
+        result = storage.process_request(request)
+        self.assertEqual(result, storage.rev + '\n')
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(LimiterTestCase))
+    suite.addTest(makeSuite(ProtocolAdmissionTestCase))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,159 @@
+import unittest
+import tempfile
+import shutil
+from os.path import join
+
+from mercurial import hg
+from mercurial.node import hex
+
+from pmr2.app.workspace.exceptions import *
+
+from pmr2.mercurial import *
+from pmr2.mercurial import annotate
+from pmr2.mercurial.annotate import AnnotateCache
+from pmr2.mercurial.backend import FixedRevWebStorage
+from pmr2.mercurial.records import AnnotateLine
+from pmr2.mercurial.utility import MercurialStorage
+from pmr2.mercurial.tests.test_utility import TestCase
+
+
+class CountingCache(AnnotateCache):
+
+    def __init__(self, repo):
+        AnnotateCache.__init__(self, repo)
+        self.stored = []
+
+    def set(self, path, filenode, annotation):
+        self.stored.append((path, hex(filenode)))
+        AnnotateCache.set(self, path, filenode, annotation)
+
+
+class AnnotateTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        self.repodir = join(self.testdir, 'repodir')
+        Sandbox.create(self.repodir, True)
+        self.sandbox = Sandbox(self.repodir, ctx='tip')
+        self.user = 'Tester <test@example.com>'
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def commit(self, content, name='file', user=None):
+        self.sandbox.add_file_content(name, content)
+        self.sandbox.commit('commit', user or self.user)
+        return self.sandbox._repo['tip']
+
+    def expected(self, fctx):
+        return [hex(f.node()) for f, line in fctx.annotate(follow=True)]
+
+    def test_annotate(self):
+        self.commit('a\nb\nc\n')
+        self.commit('a\nB\nc\nd\n', user='Other <other@example.com>')
+        ctx = self.commit('\na\nB\nd\n')
+        fctx = ctx['file']
+        result = annotate.annotate(fctx)
+        self.assertEqual(result, self.expected(fctx))
+        repo = self.sandbox._repo
+        self.assertEqual(result, [hex(repo[i].node()) for i in (2, 0, 1, 1)])
+
+        lines = annotate.lines(fctx)
+        self.assertTrue(isinstance(lines[0], AnnotateLine))
+        self.assertEqual([(i['author'], i['line']) for i in lines], [
+            (self.user, '\n'),
+            (self.user, 'a\n'),
+            ('Other <other@example.com>', 'B\n'),
+            ('Other <other@example.com>', 'd\n'),
+        ])
+        self.assertEqual(lines[0]['date'], ctx.date())
+
+    def test_incremental(self):
+        for i in xrange(5):
+            ctx = self.commit(''.join('line %d\n' % j
+                                      for j in xrange(i + 1)))
+        cache = CountingCache(self.sandbox._repo)
+        annotate.annotate(ctx['file'], cache)
+        self.assertEqual(len(cache.stored), 5)
+
+        # extended from the annotation of the parent revision only.
+        ctx = self.commit('changed\n' + ctx['file'].data())
+        cache = CountingCache(self.sandbox._repo)
+        result = annotate.annotate(ctx['file'], cache)
+        self.assertEqual(cache.stored,
+                         [('file', hex(ctx['file'].filenode()))])
+        self.assertEqual(result, self.expected(ctx['file']))
+
+        # cached.
+        cache = CountingCache(self.sandbox._repo)
+        self.assertEqual(annotate.annotate(ctx['file'], cache), result)
+        self.assertEqual(cache.stored, [])
+
+    def test_corrupted_cache(self):
+        ctx = self.commit('a\nb\n')
+        fctx = ctx['file']
+        cache = AnnotateCache(self.sandbox._repo)
+        result = annotate.annotate(fctx, cache)
+        name = cache._name('file', fctx.filenode())
+        self.sandbox._repo.opener.write(name, '{"nodes": ')
+        self.assertEqual(cache.get('file', fctx.filenode()), None)
+        self.assertEqual(annotate.annotate(fctx, cache), result)
+
+    def test_rename_merge(self):
+        self.commit('a\nb\nc\n')
+        self.sandbox.rename('file', 'renamed')
+        self.sandbox.commit('renamed', self.user)
+        self.commit('a\nb\nc\nd\n', 'renamed')
+        repo = self.sandbox._repo
+        hg.update(repo, 1)
+        self.commit('x\na\nb\nc\n', 'renamed')
+        hg.merge(repo, 2)
+        ctx = self.commit('x\na\nb\nc\nd\ny\n', 'renamed')
+        self.assertEqual(len(ctx.parents()), 2)
+
+        fctx = ctx['renamed']
+        result = annotate.annotate(fctx)
+        self.assertEqual(result, self.expected(fctx))
+        self.assertEqual(result[1:4], [hex(repo[0].node())] * 3)
+        # from the cache, with the copy followed.
+        self.assertEqual(annotate.annotate(fctx), result)
+
+
+class StorageAnnotateTestCase(TestCase):
+
+    def test_storage(self):
+        storage = Storage(self.repodir)
+        result = storage.annotate(self.revs[2], 'file2')
+        fctx = storage._repo[self.revs[2]]['file2']
+        self.assertEqual([i['rev'] for i in result],
+                         [hex(f.node()) for f, l in fctx.annotate()])
+        self.assertEqual(result[-1]['rev'], self.revs[2])
+        self.assertEqual(''.join(i['line'] for i in result), self.files[1])
+        self.assertRaises(PathNotFoundError, storage.annotate,
+                          self.revs[2], 'nested/not')
+
+        storage = FixedRevWebStorage(self.repodir, self.revs[1])
+        self.assertEqual(storage.annotate('file1'),
+                         Storage(self.repodir).annotate(self.revs[1],
+                                                        'file1'))
+
+    def test_mercurial_storage(self):
+        storage = MercurialStorage(self.workspace)
+        storage.checkout(self.revs[3])
+        result = storage.annotate(self.nested_name)
+        self.assertEqual([i['line'] for i in result],
+                         self.nested_file.splitlines(True))
+        self.assertEqual(result[0]['rev'], self.revs[3])
+        self.assertEqual(result[0]['author'], 'user3 <3@example.com>')
+        self.assertEqual(result[0]['date'][:10], self.date)
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(AnnotateTestCase))
+    suite.addTest(makeSuite(StorageAnnotateTestCase))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import unittest
+import tempfile
+import shutil
+import json
+from os.path import join
+
+from zope.component.testing import setUp, tearDown
+
+from pmr2.mercurial import *
+from pmr2.mercurial.tests import benchmark
+from pmr2.mercurial.tests import synthetic
+
+
+class SyntheticTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def test_deterministic(self):
+        params = dict(files=40, depth=2, revisions=5, size=256, branches=2)
+        nodes1 = synthetic.generate(join(self.testdir, 'a'), **params)
+        nodes2 = synthetic.generate(join(self.testdir, 'b'), **params)
+        self.assertEqual(len(nodes1), 5)
+        self.assertEqual(nodes1, nodes2)
+        nodes3 = synthetic.generate(join(self.testdir, 'c'), seed=1,
+                                    **params)
+        self.assertNotEqual(nodes1, nodes3)
+
+    def test_shape(self):
+        synthetic.generate(join(self.testdir, 'a'), files=50, depth=3,
+                           revisions=6, size=100, branches=3)
+        storage = Storage(join(self.testdir, 'a'))
+        manifest = storage.raw_manifest()
+        self.assertEqual(len(manifest), 50)
+        self.assertTrue(max(p.count('/') for p in manifest) <= 3)
+        self.assertEqual(len(storage._repo), 6)
+        self.assertEqual(sorted(storage.branches().keys()),
+                         ['branch1', 'branch2', 'default'])
+        self.assertEqual(len(storage.file(path=sorted(manifest)[0])), 100)
+
+
+class BenchmarkTestCase(unittest.TestCase):
+
+    def setUp(self):
+        setUp()
+        self.testdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+        tearDown()
+
+    def test_run(self):
+        result = benchmark.run(dict(files=20, depth=2, revisions=3),
+                               repeat=1, workdir=self.testdir)
+        # must be serializable.
+        json.dumps(result)
+        self.assertEqual(result['params']['files'], 20)
+        self.assertEqual(result['results']['files']['items'], 20)
+        self.assertTrue('process_request_getbundle' in result['results'])
+        self.assertTrue('hg_archive_zip' in result['results'])
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(SyntheticTestCase))
+    suite.addTest(makeSuite(BenchmarkTestCase))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main()
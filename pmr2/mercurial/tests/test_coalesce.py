@@ -0,0 +1,218 @@
+import unittest
+import threading
+import time
+from os.path import join
+
+import mercurial.hgweb.protocol
+
+from pmr2.mercurial import *
+from pmr2.mercurial import coalesce
+from pmr2.mercurial.coalesce import SingleFlight
+from pmr2.mercurial.utility import MercurialStorage
+from pmr2.mercurial.tests import util
+from pmr2.mercurial.tests.test_utility import TestCase
+
+
+def wait_for(condition, timeout=5):
+    end = time.time() + timeout
+    while not condition() and time.time() < end:
+        time.sleep(0.01)
+
+
+class SingleFlightTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.flights = SingleFlight()
+        self.release = threading.Event()
+        self.calls = []
+
+    def compute(self, value):
+        self.calls.append(value)
+        self.release.wait()
+        if isinstance(value, Exception):
+            raise value
+        return value
+
+    def start(self, key, value):
+        results = []
+        def run():
+            try:
+                results.append(self.flights.do(key, self.compute, value))
+            except Exception, e:
+                results.append(e)
+        t = threading.Thread(target=run)
+        t.start()
+        return t, results
+
+    def test_sequential(self):
+        self.release.set()
+        self.assertEqual(self.flights.do('a', self.compute, 1), (1, False))
+        self.assertEqual(self.flights.do('a', self.compute, 2), (2, False))
+        self.assertEqual(self.calls, [1, 2])
+        self.assertEqual(self.flights.inflight(), 0)
+
+    def test_shared(self):
+        t1, r1 = self.start('a', 1)
+        wait_for(lambda: self.calls)
+        t2, r2 = self.start('a', 2)
+        t3, r3 = self.start('b', 3)
+        wait_for(lambda: self.flights.stats()['shared'] == 1
+                 and len(self.calls) == 2)
+        self.release.set()
+        for t in (t1, t2, t3):
+            t.join()
+        self.assertEqual(sorted(self.calls), [1, 3])
+        self.assertEqual(r1, [(1, False)])
+        self.assertEqual(r2, [(1, True)])
+        self.assertEqual(r3, [(3, False)])
+        self.assertEqual(self.flights.stats(), {
+            'computed': 2, 'shared': 1, 'inflight': 0})
+
+    def test_shared_exception(self):
+        error = ValueError('failed')
+        t1, r1 = self.start('a', error)
+        wait_for(lambda: self.calls)
+        t2, r2 = self.start('a', 2)
+        wait_for(lambda: self.flights.stats()['shared'] == 1)
+        self.release.set()
+        t1.join()
+        t2.join()
+        self.assertEqual(r1, [error])
+        self.assertEqual(r2, [error])
+        self.assertEqual(self.flights.inflight(), 0)
+
+
+class StorageCoalesceTestCase(TestCase):
+
+    def hold(self, key, result):
+        """\
+        Occupy `key` with a computation that returns `result` once the
+        returned event is set.
+        """
+
+        started = threading.Event()
+        release = threading.Event()
+        def func():
+            started.set()
+            release.wait()
+            return result
+        t = threading.Thread(target=coalesce.flights.do, args=(key, func))
+        t.start()
+        started.wait()
+        return release, t
+
+    def test_archive(self):
+        storage = MercurialStorage(self.workspace)
+        key = (self.repodir, storage.rev, 'archive', 'prefix', 'zip')
+        release, t = self.hold(key, 'shared archive')
+        shared = coalesce.flights.stats()['shared']
+        results = []
+        waiter = threading.Thread(target=lambda: results.append(
+            storage.hg_archive('prefix', 'zip')))
+        waiter.start()
+        wait_for(lambda: coalesce.flights.stats()['shared'] > shared)
+        release.set()
+        t.join()
+        waiter.join()
+        self.assertEqual(results, ['shared archive'])
+        # not in flight, so computed.
+        self.assertNotEqual(storage.hg_archive('prefix', 'zip'),
+                            'shared archive')
+
+    def test_log(self):
+        storage = MercurialStorage(self.workspace)
+        first = list(storage.log(self.revs[2], 2))
+        second = list(storage.log(self.revs[2], 2))
+        self.assertEqual(first, second)
+        self.assertFalse(first[0] is second[0])
+        self.assertEqual(first[0]['node'], self.revs[2])
+        # generators are materialized so they may be shared.
+        self.assertEqual(len(first[0]['files']), 2)
+        self.assertEqual(first[0]['files'][1][0]['file'], 'file3')
+
+
+class ProtocolCoalesceTestCase(TestCase):
+
+    def setUp(self):
+        TestCase.setUp(self)
+        self.protocol = mercurial.hgweb.protocol
+        self.call = self.protocol.call
+        self.release = threading.Event()
+        self.calls = []
+        def call(*a, **kw):
+            self.calls.append(a[2])
+            self.release.wait()
+            return self.call(*a, **kw)
+        self.protocol.call = call
+
+    def tearDown(self):
+        self.protocol.call = self.call
+        TestCase.tearDown(self)
+
+    def test_getbundle(self):
+        results = []
+        def run():
+            storage = WebStorage(self.repodir)
+            request = util.build_wsgi_request('script', {
+                'cmd': 'getbundle', 'heads': self.rev, 'common': '0' * 40})
+            results.append((storage.process_request(request),
+                            request.response.getStatus()))
+
+        shared = coalesce.flights.stats()['shared']
+        threads = [threading.Thread(target=run) for i in xrange(3)]
+        for t in threads:
+            t.start()
+        wait_for(lambda: coalesce.flights.stats()['shared'] == shared + 2)
+        self.release.set()
+        for t in threads:
+            t.join()
+        self.assertEqual(self.calls, ['getbundle'])
+        self.assertEqual(len(results), 3)
+        self.assertTrue(results[0][0])
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[0], results[2])
+        self.assertEqual(str(results[0][1]), '200')
+
+    def test_stream_out_disabled(self):
+        # responds with a string rather than a stream.
+        hgrc = open(join(self.repodir, '.hg', 'hgrc'), 'a')
+        hgrc.write('[server]\nuncompressed = False\n')
+        hgrc.close()
+        results = []
+        def run():
+            storage = WebStorage(self.repodir)
+            request = util.build_wsgi_request('script',
+                                              {'cmd': 'stream_out'})
+            results.append((storage.process_request(request),
+                            request.response.getStatus()))
+
+        shared = coalesce.flights.stats()['shared']
+        threads = [threading.Thread(target=run) for i in xrange(3)]
+        for t in threads:
+            t.start()
+        wait_for(lambda: coalesce.flights.stats()['shared'] == shared + 2)
+        self.release.set()
+        for t in threads:
+            t.join()
+        self.assertEqual(self.calls, ['stream_out'])
+        self.assertEqual([r[0] for r in results], ['1\n'] * 3)
+        self.assertEqual([str(r[1]) for r in results], ['200'] * 3)
+
+    def test_not_coalesced(self):
+        self.release.set()
+        storage = WebStorage(self.repodir)
+        request = util.build_wsgi_request('script', {'cmd': 'heads'})
+        self.assertEqual(storage.process_request(request), self.rev + '\n')
+        self.assertEqual(coalesce.flights.inflight(), 0)
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(SingleFlightTestCase))
+    suite.addTest(makeSuite(StorageCoalesceTestCase))
+    suite.addTest(makeSuite(ProtocolCoalesceTestCase))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main()
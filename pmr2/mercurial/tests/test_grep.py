@@ -0,0 +1,190 @@
+import unittest
+import tempfile
+import shutil
+import sqlite3
+from os.path import join
+
+from pmr2.mercurial import *
+from pmr2.mercurial import grep
+from pmr2.mercurial.grep import TrigramIndex
+from pmr2.mercurial.records import GrepMatch
+from pmr2.mercurial.utility import MercurialStorage
+from pmr2.mercurial.tests.test_utility import TestCase
+
+
+class CountingIndex(TrigramIndex):
+
+    def __init__(self, repo):
+        TrigramIndex.__init__(self, repo)
+        self.added = []
+
+    def add(self, entries):
+        entries = list(entries)
+        self.added.extend(filenode for filenode, text in entries)
+        TrigramIndex.add(self, entries)
+
+
+class GrepTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        self.repodir = join(self.testdir, 'repodir')
+        Sandbox.create(self.repodir, True)
+        self.sandbox = Sandbox(self.repodir, ctx='tip')
+        self.user = 'Tester <test@example.com>'
+        self.sandbox.add_file_content('heart/model.cellml',
+            '<model name="heart">\n  <units name="mV"/>\n</model>\n')
+        self.sandbox.add_file_content('heart/notes',
+            'Membrane potential\nin mV\n')
+        self.sandbox.add_file_content('liver/model.cellml',
+            '<model name="liver">\n</model>\n')
+        self.sandbox.add_file_content('heart/image.png',
+            '\x89PNG\r\n\x00\x00name="heart"\n')
+        self.sandbox.add_file_content('kidney/image.png',
+            '\x89PNG\r\n\x00\x00name="heart"\n')
+        self.sandbox.add_file_content('kidney/notes',
+            'Membrane potential\nin mV\n')
+        self.sandbox.add_file_content('kidney/empty', '')
+        self.ctx = self.commit('initial')
+
+    def tearDown(self):
+        grep.configure()
+        shutil.rmtree(self.testdir)
+
+    def commit(self, message):
+        self.sandbox.commit(message, self.user)
+        return self.sandbox._repo['tip']
+
+    def grep(self, pattern, path_prefix=None, index=None, ctx=None):
+        return [(m['file'], m['lineno'], m['line'])
+                for m in grep.lines(self.sandbox._repo, ctx or self.ctx,
+                                    pattern, path_prefix, index)]
+
+    def test_required_trigrams(self):
+        self.assertEqual(grep.required_trigrams('Model'),
+                         set(['mod', 'ode', 'del']))
+        self.assertEqual(grep.required_trigrams('ab.cdef+'),
+                         set(['cde']))
+        self.assertEqual(grep.required_trigrams('model|units'), set())
+        self.assertEqual(grep.required_trigrams('(model)'), set())
+        self.assertEqual(grep.required_trigrams('mod(el)?'),
+                         set(['mod']))
+
+    def test_lines(self):
+        result = list(grep.lines(self.sandbox._repo, self.ctx, 'mV'))
+        self.assertTrue(isinstance(result[0], GrepMatch))
+        self.assertEqual(self.grep('mV'), [
+            ('heart/model.cellml', 2, '  <units name="mV"/>'),
+            ('heart/notes', 2, 'in mV'),
+            ('kidney/notes', 2, 'in mV'),
+        ])
+        # the binary file is skipped.
+        self.assertEqual(self.grep('name="[a-z]+">'), [
+            ('heart/model.cellml', 1, '<model name="heart">'),
+            ('liver/model.cellml', 1, '<model name="liver">'),
+        ])
+        self.assertEqual(self.grep('^</model>$'), [
+            ('heart/model.cellml', 3, '</model>'),
+            ('liver/model.cellml', 2, '</model>'),
+        ])
+        self.assertEqual(self.grep('nothing'), [])
+
+    def test_path_prefix(self):
+        self.assertEqual(self.grep('model', 'liver'), [
+            ('liver/model.cellml', 1, '<model name="liver">'),
+            ('liver/model.cellml', 2, '</model>'),
+        ])
+        self.assertEqual(self.grep('mV', 'heart/notes'),
+                         [('heart/notes', 2, 'in mV')])
+        self.assertEqual(self.grep('mV', 'heart/'), self.grep('mV')[:2])
+        self.assertEqual(self.grep('mV', 'hear'), [])
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, grep.lines, self.sandbox._repo,
+                          self.ctx, 'model(')
+
+    def test_index(self):
+        index = CountingIndex(self.sandbox._repo)
+        expected = self.grep('(?i)membrane')
+        self.assertEqual(self.grep('(?i)membrane', index=index), expected)
+        # each file revision once, even if at more than one path.
+        self.assertEqual(len(index.added), 5)
+        self.assertEqual(len(set(index.added)), 5)
+        indexed = index.get(index.added)
+        self.assertTrue(indexed[self.ctx['heart/image.png'].filenode()][0])
+        self.assertFalse(indexed[self.ctx['kidney/empty'].filenode()][0])
+
+        # only the changed file of the next revision is read and indexed.
+        self.sandbox.add_file_content('liver/model.cellml',
+            '<model name="liver">\n<!-- membrane -->\n</model>\n')
+        ctx = self.commit('changed')
+        index = CountingIndex(self.sandbox._repo)
+        self.assertEqual(self.grep('Membrane', index=index, ctx=ctx), [
+            ('heart/notes', 1, 'Membrane potential'),
+            ('kidney/notes', 1, 'Membrane potential'),
+        ])
+        self.assertEqual(index.added, [ctx['liver/model.cellml'].filenode()])
+        self.assertEqual(self.grep('(?i)membrane', index=index, ctx=ctx), [
+            ('heart/notes', 1, 'Membrane potential'),
+            ('kidney/notes', 1, 'Membrane potential'),
+            ('liver/model.cellml', 2, '<!-- membrane -->'),
+        ])
+        # patterns without literal text are matched against every file.
+        self.assertEqual(self.grep('model|Membrane', index=index, ctx=ctx),
+                         self.grep('model|Membrane', ctx=ctx))
+
+    def test_index_failure(self):
+        class FailingIndex(TrigramIndex):
+            def add(self, entries):
+                raise sqlite3.OperationalError('database is locked')
+        index = FailingIndex(self.sandbox._repo)
+        batch = grep._batch
+        # the failures of the batches written within the search as well.
+        grep._batch = 2
+        try:
+            self.assertEqual(self.grep('(?i)membrane', index=index),
+                             self.grep('(?i)membrane'))
+        finally:
+            grep._batch = batch
+
+    def test_get(self):
+        self.assertEqual(grep.get(self.sandbox._repo), None)
+        grep.configure(index=True)
+        self.assertTrue(isinstance(grep.get(self.sandbox._repo),
+                                   TrigramIndex))
+
+
+class StorageGrepTestCase(TestCase):
+
+    def test_storage(self):
+        storage = Storage(self.repodir)
+        result = list(storage.grep('deeply'))
+        self.assertEqual([(m['file'], m['lineno']) for m in result],
+                         [(self.nested_name, 3)])
+        self.assertEqual(list(storage.grep('deeply', self.revs[2])), [])
+        self.assertRaises(ValueError, storage.grep, '[')
+
+    def test_mercurial_storage(self):
+        storage = MercurialStorage(self.workspace)
+        storage.checkout(self.revs[3])
+        grep.configure(index=True)
+        try:
+            result = storage.grep('s', path_prefix='nested')
+            self.assertEqual(result, storage.grep('s', self.revs[3],
+                                                  'nested/deep'))
+        finally:
+            grep.configure()
+        self.assertEqual([m['line'] for m in result],
+                         ['This is', 'a deeply nested file'])
+        self.assertEqual(storage.grep('s', self.revs[0], 'nested'), [])
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(GrepTestCase))
+    suite.addTest(makeSuite(StorageGrepTestCase))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import unittest
+import tempfile
+import shutil
+from os.path import join
+
+from pmr2.app.workspace.exceptions import *
+
+from pmr2.mercurial import *
+from pmr2.mercurial.hooks import changegroup_limits
+
+
+class ChangegroupLimitsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        self.repodir = join(self.testdir, 'repodir')
+        self.sandboxdir = join(self.testdir, 'sandbox')
+        Storage.create(self.repodir, True)
+        storage = Storage(self.repodir)
+        storage.clone(self.sandboxdir)
+        self.sandbox = Sandbox(self.sandboxdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def _configure(self, **limits):
+        f = open(join(self.repodir, '.hg', 'hgrc'), 'w')
+        f.write(
+            '[hooks]\n'
+            'pretxnchangegroup.limits = '
+                'python:pmr2.mercurial.hooks.changegroup_limits\n'
+            '[pmr2.limits]\n'
+        )
+        for k, v in limits.iteritems():
+            f.write('%s = %s\n' % (k, v))
+        f.close()
+
+    def _commit(self, files):
+        for name, content in files:
+            self.sandbox.add_file_content(name, content)
+        self.sandbox.commit('commit', 'user <user@example.com>')
+
+    def test_unlimited(self):
+        self._configure()
+        self._commit([('file1', 'x' * 4096)])
+        self.assertTrue(self.sandbox.push())
+        self.assertEqual(len(Storage(self.repodir)._repo), 1)
+
+    def test_max_file_size(self):
+        self._configure(max_file_size='1 kb')
+        self._commit([('small', 'x' * 16), ('large', 'x' * 2048)])
+        self.assertRaises(ProtocolError, self.sandbox.push)
+        self.assertEqual(len(Storage(self.repodir)._repo), 0)
+
+    def test_max_changesets(self):
+        self._configure(max_changesets='2')
+        self._commit([('file1', '1')])
+        self._commit([('file1', '2')])
+        self.assertTrue(self.sandbox.push())
+        self._commit([('file1', '3')])
+        self._commit([('file1', '4')])
+        self._commit([('file1', '5')])
+        self.assertRaises(ProtocolError, self.sandbox.push)
+        self.assertEqual(len(Storage(self.repodir)._repo), 2)
+
+    def test_max_files(self):
+        self._configure(max_files='2')
+        self._commit([('file1', '1'), ('file2', '2'), ('file3', '3')])
+        self.assertRaises(ProtocolError, self.sandbox.push)
+
+    def test_max_incoming(self):
+        self._configure(max_incoming='64')
+        # random-ish data so compression does not help.
+        self._commit([('file1', ''.join(chr(i % 251) for i in xrange(4096)))])
+        self.assertRaises(ProtocolError, self.sandbox.push)
+
+    def test_report_paths(self):
+        # call the hook directly against the committed sandbox data to
+        # verify the reported paths.
+        self._commit([('small', 'x' * 16), ('large', 'x' * 2048)])
+        ui = self.sandbox._ui
+        ui.setconfig('pmr2.limits', 'max_file_size', '1 kb')
+        node = self.sandbox._repo[0].hex()
+        self.assertTrue(changegroup_limits(ui, self.sandbox._repo, node=node))
+        output = ui.fout.getvalue()
+        self.assertTrue('  large\n' in output)
+        self.assertFalse('  small\n' in output)
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(ChangegroupLimitsTestCase))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main()
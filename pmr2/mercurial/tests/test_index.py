@@ -0,0 +1,173 @@
+import unittest
+import tempfile
+import shutil
+import sys
+import os
+import json
+from cStringIO import StringIO
+from os.path import join
+
+from mercurial.node import hex, nullid
+
+from pmr2.mercurial import *
+from pmr2.mercurial import index
+from pmr2.mercurial import utils
+from pmr2.mercurial.index import WorkspaceIndex
+from pmr2.mercurial.utility import MercurialStorageUtility
+from pmr2.mercurial.tests.test_utility import DummyWorkspace
+from pmr2.mercurial.tests.test_utility import TestCase
+
+
+class WorkspaceIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        self.root = join(self.testdir, 'root')
+        os.mkdir(self.root)
+        os.mkdir(join(self.root, 'notrepo'))
+        for name in ('empty', 'repo1', 'repo2'):
+            Sandbox.create(join(self.root, name), True)
+        for name in ('repo1', 'repo2'):
+            self.commit(name, 'file', name)
+        self.index = WorkspaceIndex(join(self.testdir, 'index.db'))
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def commit(self, name, filename, content, branch=None):
+        sandbox = Sandbox(join(self.root, name))
+        if branch:
+            sandbox._repo.dirstate.setbranch(branch)
+        sandbox.add_file_content(filename, content)
+        sandbox.commit('commit', 'user <user@example.com>')
+        return Storage(join(self.root, name), ctx='tip')
+
+    def test_workspace_info(self):
+        info = index.workspace_info(join(self.root, 'repo1'))
+        repo = Storage(join(self.root, 'repo1'), ctx='tip')
+        self.assertEqual(info['tip'], repo.rev)
+        self.assertEqual(info['tipdate'], repo._ctx.date()[0])
+        self.assertEqual(info['branches'], 1)
+        self.assertTrue(info['size'] > 0)
+
+        info = index.workspace_info(join(self.root, 'empty'))
+        self.assertEqual(info, {'tip': hex(nullid), 'tipdate': None,
+                                'size': 0, 'branches': 0})
+        self.assertEqual(index.workspace_info(join(self.root, 'notrepo')),
+                         None)
+
+    def test_rebuild(self):
+        self.assertEqual(self.index.entries(self.root), None)
+        self.assertEqual(self.index.rebuild(self.root, processes=2), 3)
+        self.assertEqual(self.index.names(self.root),
+                         ['empty', 'repo1', 'repo2'])
+        entry = self.index.get(join(self.root, 'repo2'))
+        self.assertEqual(entry['tip'],
+                         Storage(join(self.root, 'repo2'), ctx='tip').rev)
+
+        shutil.rmtree(join(self.root, 'repo1'))
+        self.assertEqual(self.index.rebuild(self.root, processes=1), 2)
+        self.assertEqual(self.index.names(self.root), ['empty', 'repo2'])
+
+    def test_update(self):
+        self.index.rebuild(self.root)
+        repo = self.commit('repo1', 'other', 'other', branch='new')
+        self.assertNotEqual(self.index.get(join(self.root, 'repo1'))['tip'],
+                            repo.rev)
+        entry = self.index.update(join(self.root, 'repo1'))
+        self.assertEqual(entry['tip'], repo.rev)
+        self.assertEqual(entry['branches'], 2)
+
+        Sandbox.create(join(self.root, 'repo3'), True)
+        self.index.update(join(self.root, 'repo3'))
+        self.assertEqual(self.index.names(self.root),
+                         ['empty', 'repo1', 'repo2', 'repo3'])
+
+        shutil.rmtree(join(self.root, 'repo2'))
+        self.assertEqual(self.index.update(join(self.root, 'repo2')), None)
+        self.assertEqual(self.index.names(self.root),
+                         ['empty', 'repo1', 'repo3'])
+
+    def age(self, path, seconds=10):
+        mtime = os.stat(path).st_mtime - seconds
+        os.utime(path, (mtime, mtime))
+
+    def test_webdir(self):
+        index.configure(join(self.testdir, 'index.db'))
+        self.addCleanup(index.configure)
+        self.assertEqual(sorted(utils.webdir(self.root)),
+                         ['empty', 'repo1', 'repo2'])
+        self.age(self.root)
+        self.index.rebuild(self.root)
+        # not scanned again while the root is unchanged.
+        self.index.remove(join(self.root, 'repo2'))
+        self.assertEqual(utils.webdir(self.root), ['empty', 'repo1'])
+
+        # workspaces added and removed outside of the index.
+        Sandbox.create(join(self.root, 'repo3'), True)
+        shutil.rmtree(join(self.root, 'repo1'))
+        self.assertEqual(utils.webdir(self.root), ['empty', 'repo2', 'repo3'])
+        self.assertEqual(self.index.get(join(self.root, 'repo3'))['tip'],
+                         hex(nullid))
+
+    def test_reconcile_recent(self):
+        # changes within the second of the last scan are not told by the
+        # modification time, so the root is scanned again.
+        os.utime(self.root, None)
+        self.index.rebuild(self.root)
+        self.index.remove(join(self.root, 'repo2'))
+        self.assertEqual(self.index.names(self.root),
+                         ['empty', 'repo1', 'repo2'])
+
+    def test_main(self):
+        db = join(self.testdir, 'index.db')
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            index.main(['--db', db, '--processes', '1', 'rebuild', self.root])
+            index.main(['--db', db, 'list', self.root])
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertTrue(output.startswith('%s: 3 workspaces indexed' %
+                                          self.root))
+        entries = json.loads(output[output.index('\n'):])
+        self.assertEqual([e['name'] for e in entries],
+                         ['empty', 'repo1', 'repo2'])
+
+
+class UtilityIndexTestCase(TestCase):
+
+    def setUp(self):
+        super(UtilityIndexTestCase, self).setUp()
+        index.configure(join(self.testdir, 'index.db'))
+        index.get().rebuild(self.testdir)
+
+    def tearDown(self):
+        index.configure()
+        super(UtilityIndexTestCase, self).tearDown()
+
+    def test_create(self):
+        utility = MercurialStorageUtility()
+        utility.create(DummyWorkspace(join(self.testdir, 'created')))
+        self.assertTrue('created' in utils.webdir(self.testdir))
+
+    def test_sync(self):
+        utility = MercurialStorageUtility()
+        before = index.get().get(self.simple2.path)
+        utility.sync(self.simple2, join(self.testdir, 'simple1'))
+        after = index.get().get(self.simple2.path)
+        self.assertNotEqual(before['tip'], after['tip'])
+        self.assertEqual(after['tip'],
+                         Storage(self.simple2.path, ctx='tip').rev)
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(WorkspaceIndexTestCase))
+    suite.addTest(makeSuite(UtilityIndexTestCase))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main()
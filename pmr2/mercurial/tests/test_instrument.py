@@ -0,0 +1,106 @@
+import unittest
+import tempfile
+import shutil
+import json
+from os.path import join
+
+from pmr2.mercurial import *
+from pmr2.mercurial import instrument
+
+
+class InstrumentTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = instrument.registry
+        self.registry.reset()
+        self.enabled = instrument.enabled()
+
+    def tearDown(self):
+        if not self.enabled:
+            instrument.disable()
+        self.registry.reset()
+
+    def test_disabled(self):
+        instrument.disable()
+        func = instrument.timed('test.func')(lambda: 'abc')
+        self.assertEqual(func(), 'abc')
+        self.assertEqual(self.registry.snapshot(), {})
+
+    def test_bytes_and_calls(self):
+        instrument.enable()
+        func = instrument.timed('test.func')(lambda x: 'x' * x)
+        func(3)
+        func(4)
+        stat = self.registry.snapshot()['test.func']
+        self.assertEqual(stat['calls'], 2)
+        self.assertEqual(stat['bytes'], 7)
+        self.assertEqual(stat['errors'], 0)
+
+    def test_errors(self):
+        instrument.enable()
+        def fail():
+            raise ValueError
+        func = instrument.timed('test.fail')(fail)
+        self.assertRaises(ValueError, func)
+        self.assertEqual(self.registry.snapshot()['test.fail']['errors'], 1)
+
+    def test_generator(self):
+        instrument.enable()
+        def gen():
+            yield 'ab'
+            yield 'cde'
+        func = instrument.timed('test.gen')(gen)
+        result = func()
+        # recorded only once exhausted
+        self.assertEqual(self.registry.snapshot(), {})
+        self.assertEqual(list(result), ['ab', 'cde'])
+        stat = self.registry.snapshot()['test.gen']
+        self.assertEqual(stat['items'], 2)
+        self.assertEqual(stat['bytes'], 5)
+
+    def test_key(self):
+        instrument.enable()
+        func = instrument.timed('test.cmd', key=lambda cmd: cmd)(
+            lambda cmd: '')
+        func('heads')
+        func('heads')
+        func('getbundle')
+        stats = self.registry.snapshot()
+        self.assertEqual(stats['test.cmd.heads']['calls'], 2)
+        self.assertEqual(stats['test.cmd.getbundle']['calls'], 1)
+
+    def test_dump_scrape(self):
+        instrument.enable()
+        instrument.timed('test.func')(lambda: 'abc')()
+        self.assertEqual(json.loads(self.registry.dump())['test.func'][
+            'bytes'], 3)
+        scrape = self.registry.scrape()
+        self.assertTrue('pmr2_mercurial_calls_total{name="test.func"} 1\n'
+                        in scrape)
+        self.assertTrue('pmr2_mercurial_bytes_total{name="test.func"} 3\n'
+                        in scrape)
+
+    def test_storage(self):
+        testdir = tempfile.mkdtemp()
+        try:
+            repodir = join(testdir, 'repodir')
+            Sandbox.create(repodir, True)
+            instrument.enable()
+            sandbox = Sandbox(repodir)
+            sandbox.add_file_content('file1', 'content')
+            sandbox.commit('message', 'user <user@example.com>')
+            Storage(repodir)
+            self.assertEqual(
+                self.registry.snapshot()['Storage.open']['calls'], 2)
+        finally:
+            shutil.rmtree(testdir)
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(InstrumentTestCase))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main()
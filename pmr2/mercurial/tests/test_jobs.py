@@ -0,0 +1,260 @@
+import unittest
+import threading
+import tempfile
+import shutil
+import socket
+import os
+from os.path import join
+
+from pmr2.mercurial import *
+from pmr2.mercurial import admission
+from pmr2.mercurial import jobs
+from pmr2.mercurial.jobs import JobQueue
+from pmr2.mercurial.utility import MercurialStorageUtility
+from pmr2.mercurial.tests.test_utility import DummyWorkspace
+from pmr2.mercurial.tests.test_utility import TestCase
+
+
+class JobQueueTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        self.path = join(self.testdir, 'jobs.db')
+        self.release = threading.Event()
+        self.calls = []
+        self.queue = JobQueue(self.path, workers=2, runner=self.runner)
+
+    def tearDown(self):
+        self.release.set()
+        self.queue.stop()
+        shutil.rmtree(self.testdir)
+
+    def runner(self, target, source):
+        self.calls.append((target, source))
+        self.release.wait()
+        if source == 'broken':
+            raise ValueError('cannot pull')
+        return len(self.calls)
+
+    def test_run(self):
+        self.release.set()
+        job_id = self.queue.submit('target', 'source')
+        result = self.queue.wait(job_id, 5)
+        self.assertEqual(result['state'], 'done')
+        self.assertEqual(result['result'], 1)
+        self.assertEqual(result['target'], 'target')
+        self.assertEqual(result['source'], 'source')
+        self.assertTrue(result['duration'] >= 0)
+        self.assertTrue(result['created'] <= result['started'])
+
+    def test_failed(self):
+        self.release.set()
+        result = self.queue.wait(self.queue.submit('target', 'broken'), 5)
+        self.assertEqual(result['state'], 'failed')
+        self.assertEqual(result['error'], 'ValueError: cannot pull')
+        self.assertEqual(result['result'], None)
+
+    def test_dedupe(self):
+        # occupy the workspace so the next jobs stay pending.
+        first = self.queue.submit('target', 'source')
+        self.queue.wait(first, 0.2)
+        second = self.queue.submit('target', 'source')
+        third = self.queue.submit('target', 'source')
+        other = self.queue.submit('target', 'other')
+        self.assertNotEqual(first, second)
+        self.assertEqual(second, third)
+        self.assertNotEqual(second, other)
+        self.assertEqual(self.queue.status(first)['state'], 'running')
+        self.assertEqual(self.queue.status(second)['state'], 'pending')
+        self.assertEqual(self.queue.status(second)['submitted'], 2)
+        # the second worker is not allowed to run a job for the same
+        # workspace.
+        self.assertEqual(self.calls, [('target', 'source')])
+
+        self.release.set()
+        for job_id in (first, second, other):
+            self.assertEqual(self.queue.wait(job_id, 5)['state'], 'done')
+        self.assertEqual(len(self.calls), 3)
+        self.assertEqual(self.queue.jobs(state='done'),
+                         [first, second, other])
+
+    def test_persistent(self):
+        queue = JobQueue(self.path, workers=0, runner=self.runner)
+        job_id = queue.submit('target', 'source')
+        self.assertEqual(queue.status(job_id)['state'], 'pending')
+        # a new queue on the same database runs the pending jobs.
+        self.release.set()
+        queue = JobQueue(self.path, workers=0, runner=self.runner)
+        self.assertEqual(queue.run_pending(), 1)
+        self.assertEqual(queue.status(job_id)['state'], 'done')
+        self.assertEqual(queue.run_pending(), 0)
+
+    def test_recover(self):
+        queue = JobQueue(self.path, workers=0, runner=self.runner)
+        job_id = queue.submit('target', 'source')
+        self.assertEqual(queue._claim()['id'], job_id)
+
+        def restart(owner):
+            conn = queue._connect()
+            conn.execute('UPDATE jobs SET owner = ?', (owner,))
+            conn.close()
+            JobQueue(self.path, workers=0, runner=self.runner)
+            return queue.status(job_id)['state']
+
+        # still running elsewhere, or in this process.
+        self.assertEqual(restart('elsewhere:1'), 'running')
+        self.assertEqual(restart(queue.owner), 'running')
+        # left running by a process on this host that has died.
+        self.assertEqual(restart('%s:%d' % (socket.gethostname(),
+            0x7fffffff)), 'pending')
+
+    def test_purge(self):
+        self.release.set()
+        job_id = self.queue.submit('target', 'source')
+        self.queue.wait(job_id, 5)
+        self.assertEqual(self.queue.purge(3600), 0)
+        self.assertEqual(self.queue.purge(-1), 1)
+        self.assertEqual(self.queue.status(job_id), None)
+
+
+class UtilityJobsTestCase(TestCase):
+
+    def setUp(self):
+        super(UtilityJobsTestCase, self).setUp()
+        self.environ = os.environ.get('PMR2_MERCURIAL_JOBS_DB')
+        os.environ['PMR2_MERCURIAL_JOBS_DB'] = join(self.testdir, 'jobs.db')
+        jobs._queue = None
+
+    def tearDown(self):
+        jobs.queue().stop()
+        jobs._queue = None
+        if self.environ is None:
+            os.environ.pop('PMR2_MERCURIAL_JOBS_DB', None)
+        else:
+            os.environ['PMR2_MERCURIAL_JOBS_DB'] = self.environ
+        super(UtilityJobsTestCase, self).tearDown()
+
+    def test_sync_async(self):
+        utility = MercurialStorageUtility()
+        target = join(self.testdir, 'simple1')
+        job_id = utility.syncIdentifierAsync(self.simple2, target)
+        jobs.queue().wait(job_id, 30)
+        result = utility.syncStatus(job_id)
+        self.assertEqual(result['state'], 'done')
+        self.assertEqual(result['heads'], 1)
+        self.assertEqual(result['message'], None)
+
+        simple2 = utility(self.simple2)
+        simple2.checkout()
+        self.assertEqual(simple2.files(),
+                         ['README', 'test1', 'test2', 'test3'])
+
+        job_id = utility.syncIdentifierAsync(self.simple2, target)
+        jobs.queue().wait(job_id, 30)
+        self.assertEqual(utility.syncStatus(job_id)['message'],
+                         'No new changes found.')
+
+    def test_queue_default(self):
+        utility = MercurialStorageUtility()
+        del os.environ['PMR2_MERCURIAL_JOBS_DB']
+        # no shared default location is used.
+        self.assertRaises(ValueError, utility.syncStatus, 1)
+        self.settings.repo_root = self.testdir
+        self.assertEqual(utility.syncStatus(1), None)
+        self.assertEqual(jobs.queue().path,
+                         join(self.testdir, '.pmr2.mercurial-jobs.db'))
+
+    def test_sync_async_failed(self):
+        utility = MercurialStorageUtility()
+        job_id = utility.syncIdentifierAsync(self.simple3, self.repodir)
+        jobs.queue().wait(job_id, 30)
+        result = utility.syncStatus(job_id)
+        self.assertEqual(result['state'], 'failed')
+        self.assertTrue(result['message'])
+        self.assertEqual(utility.syncStatus(job_id + 1), None)
+
+
+class SyncManyTestCase(TestCase):
+
+    def setUp(self):
+        super(SyncManyTestCase, self).setUp()
+        self.targets = []
+        for i in xrange(3):
+            path = join(self.testdir, 'target%d' % i)
+            Sandbox.create(path, True)
+            self.targets.append(DummyWorkspace(path))
+
+    def sync(self, processes):
+        utility = MercurialStorageUtility()
+        pairs = [(t, self.simple1) for t in self.targets] + [
+            (self.simple3, self.simple1),
+            (self.simple3, self.workspace),
+            (self.targets[0], self.simple1),
+        ]
+        results = utility.syncWorkspaces(pairs, processes)
+        self.assertEqual([(r['target'], r['source']) for r in results],
+            [(t.path, s.path) for t, s in pairs])
+        self.assertEqual([r['heads'] for r in results],
+                         [1, 1, 1, 2, None, 1])
+        self.assertEqual([bool(r['error']) for r in results],
+                         [False] * 4 + [True, False])
+        self.assertTrue(min(r['duration'] for r in results) >= 0)
+        for t in self.targets:
+            self.assertEqual(utility(t).files(),
+                             ['README', 'test1', 'test2', 'test3'])
+        # synced again, without new changes.
+        results = utility.syncWorkspaces(pairs[:3], processes)
+        self.assertEqual([r['heads'] for r in results], [0, 0, 0])
+
+    def test_sync_many(self):
+        self.sync(2)
+
+    def test_sync_many_inline(self):
+        opened = []
+        class Sources(dict):
+            def __setitem__(self, key, value):
+                opened.append(key)
+                dict.__setitem__(self, key, value)
+        sources = jobs._sources
+        jobs._sources = Sources()
+        try:
+            self.sync(1)
+            # each source is opened once per run.
+            self.assertEqual(sorted(opened), sorted([self.simple1.path] * 2 +
+                                                    [self.repodir]))
+            self.assertEqual(jobs._sources, {})
+        finally:
+            jobs._sources = sources
+
+    def test_sync_many_admission(self):
+        admission.configure('sync', 1)
+        try:
+            limiter = admission.limiter('sync')
+            # capped at the sync concurrency, so synced in this process
+            # and admitted through its limiter.
+            self.sync(4)
+            self.assertEqual(limiter.admitted, 8)
+            self.assertEqual(limiter.active, 0)
+
+            # pool syncs are rejected while the limit is taken.
+            limiter.acquire()
+            try:
+                results = jobs.sync_many([(self.targets[0].path,
+                                           self.simple1.path)])
+            finally:
+                limiter.release()
+            self.assertTrue('rejected' in results[0]['error'])
+        finally:
+            admission.configure('sync')
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(JobQueueTestCase))
+    suite.addTest(makeSuite(UtilityJobsTestCase))
+    suite.addTest(makeSuite(SyncManyTestCase))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import unittest
+import tempfile
+import shutil
+import pstats
+import time
+import os
+from os.path import join
+
+from pmr2.mercurial import profiler
+
+
+def tags(*a, **kw):
+    return '/var/pmr2/workspace/my model', 'd52a32a5fa62a357ed77'
+
+
+class ProfilerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        self.profiledir = join(self.testdir, 'profiles')
+
+    def tearDown(self):
+        profiler.configure()
+        shutil.rmtree(self.testdir)
+
+    def profiles(self):
+        return sorted(os.listdir(self.profiledir))
+
+    def test_disabled(self):
+        profiler.configure()
+        func = profiler.profiled('test.func', tags)(lambda: 'x')
+        self.assertEqual(func(), 'x')
+        self.assertFalse(os.path.exists(self.profiledir))
+
+    def test_rate(self):
+        profiler.configure(self.profiledir, rate=1.0)
+        func = profiler.profiled('test.func', tags)(lambda: 'x')
+        self.assertEqual(func(), 'x')
+        names = self.profiles()
+        self.assertEqual(len(names), 1)
+        self.assertTrue(names[0].endswith(
+            '-test.func-d52a32a5fa62-var-pmr2-workspace-my-model.prof'))
+        # readable by pstats
+        pstats.Stats(join(self.profiledir, names[0]))
+
+    def test_threshold(self):
+        profiler.configure(self.profiledir, threshold=0.05, interval=0.005)
+        fast = profiler.profiled('test.fast', tags)(lambda: 'x')
+        slow = profiler.profiled('test.slow', tags)(
+            lambda: time.sleep(0.1))
+        fast()
+        self.assertEqual(self.profiles(), [])
+        slow()
+        names = self.profiles()
+        self.assertEqual(len(names), 1)
+        self.assertTrue('-test.slow-' in names[0])
+        self.assertTrue(names[0].endswith('.stacks'))
+        content = open(join(self.profiledir, names[0])).read()
+        self.assertTrue('test_profiler.py:<lambda>' in content)
+
+    def test_generator(self):
+        profiler.configure(self.profiledir, rate=1.0)
+        def gen():
+            yield 1
+            yield 2
+        func = profiler.profiled('test.gen', tags)(gen)
+        result = func()
+        # written once the generator is exhausted.
+        self.assertEqual(self.profiles(), [])
+        self.assertEqual(list(result), [1, 2])
+        self.assertEqual(len(self.profiles()), 1)
+
+    def test_nested(self):
+        profiler.configure(self.profiledir, rate=1.0)
+        inner = profiler.profiled('test.inner', tags)(lambda: 'x')
+        outer = profiler.profiled('test.outer', tags)(lambda: inner())
+        outer()
+        names = self.profiles()
+        self.assertEqual(len(names), 1)
+        self.assertTrue('-test.outer-' in names[0])
+
+    def test_rotate(self):
+        profiler.configure(self.profiledir, rate=1.0, keep=3)
+        func = profiler.profiled('test.func', tags)(lambda: 'x')
+        for i in xrange(5):
+            func()
+        self.assertEqual(len(self.profiles()), 3)
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(ProfilerTestCase))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main()
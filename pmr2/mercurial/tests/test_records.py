@@ -0,0 +1,150 @@
+import unittest
+
+from pmr2.app.workspace.storage import BaseStorage
+
+from pmr2.mercurial.records import *
+from pmr2.mercurial.utility import MercurialStorage
+from pmr2.mercurial.tests.test_utility import TestCase
+
+
+class Point(Record):
+    fields = ('x', 'y')
+    _fieldset = frozenset(fields)
+    __slots__ = ('_x', '_y')
+
+
+class Storage(BaseStorage):
+
+    def __init__(self):
+        self.formatted = 0
+        self.arguments = None
+
+    def format(self, *a, **kw):
+        self.formatted += 1
+        self.arguments = kw
+        return BaseStorage.format(self, *a, **kw)
+
+
+class RecordTestCase(unittest.TestCase):
+
+    def test_mapping(self):
+        p = Point(x=1, y=2)
+        self.assertFalse(hasattr(p, '__dict__'))
+        # the fields are not attributes.
+        self.assertFalse(hasattr(p, 'x'))
+        self.assertEqual(p['x'], 1)
+        self.assertEqual(p.keys(), ['x', 'y'])
+        self.assertEqual(p, {'x': 1, 'y': 2})
+        self.assertEqual(dict(p), {'x': 1, 'y': 2})
+        self.assertRaises(KeyError, p.__getitem__, 'z')
+        self.assertEqual(p.get('z', 3), 3)
+        p['z'] = 3
+        p['x'] = 0
+        self.assertEqual(p.copy(), {'x': 0, 'y': 2, 'z': 3})
+        self.assertTrue('z' in p)
+        del p['y']
+        self.assertEqual(sorted(p), ['x', 'z'])
+
+    def test_lazy(self):
+        calls = []
+        def compute(value):
+            calls.append(value)
+            return value * 2
+        p = Point(x=lazy(compute, 1), y=lazy(compute, 2))
+        self.assertEqual(calls, [])
+        self.assertEqual(p['y'], 4)
+        self.assertEqual(p['y'], 4)
+        self.assertEqual(calls, [2])
+        self.assertEqual(resolve({'a': lazy(compute, 3), 'b': 1}),
+                         {'a': 6, 'b': 1})
+
+    def test_dir_entry(self):
+        storage = Storage()
+        calls = []
+        def describe():
+            calls.append('desc')
+            return 'described'
+        entry = DirEntry(storage, path='dir/file', permissions='-rw-r--r--',
+                         node='0' * 40, date='', size='1',
+                         desc=lazy(describe), contents=lambda: 'text')
+        self.assertEqual(entry['basename'], 'file')
+        self.assertEqual(entry['file'], 'dir/file')
+        # the keys are known without calling format.
+        self.assertEqual(len(entry), 14)
+        self.assertTrue('mimetype' in entry)
+        self.assertFalse('missing' in entry)
+        self.assertEqual(entry.get('missing'), None)
+        self.assertEqual(storage.formatted, 0)
+
+        # the fields read do not call format.
+        self.assertEqual(entry['size'], '1')
+        self.assertEqual(storage.formatted, 0)
+        self.assertEqual(calls, [])
+
+        # the keys only provided by format, and the fields not given,
+        # are computed by a single call with all the other fields.
+        self.assertEqual(entry['baseview'], 'file')
+        self.assertEqual(storage.formatted, 1)
+        self.assertEqual(sorted(storage.arguments), ['basename',
+            'contents', 'date', 'desc', 'node', 'path', 'permissions',
+            'size'])
+        self.assertEqual(storage.arguments['desc'], 'described')
+        self.assertEqual(calls, ['desc'])
+        self.assertEqual(entry['mimetype'](), 'text/plain')
+        self.assertEqual(entry['author'], '')
+        self.assertEqual(storage.formatted, 1)
+
+        answer = storage.format(permissions='-rw-r--r--', node='0' * 40,
+            date='', size='1', path='dir/file', desc='described',
+            contents=entry['contents'])
+        answer['mimetype'] = entry['mimetype']
+        self.assertEqual(entry, answer)
+        self.assertEqual(calls, ['desc'])
+
+
+class StorageRecordsTestCase(TestCase):
+
+    def test_listdir_lazy(self):
+        storage = MercurialStorage(self.workspace)
+        storage.checkout(self.revs[3])
+        result = list(storage.listdir(''))
+        self.assertTrue(isinstance(result[1], DirEntry))
+        self.assertTrue(type(result[1]._size) is lazy)
+        self.assertEqual(result[1]['size'], str(len(self.files[1])))
+        self.assertEqual(result[1]._size, str(len(self.files[1])))
+        self.assertTrue(type(result[1]._desc) is lazy)
+        # neither lazy nor unset values are reachable as attributes.
+        self.assertFalse(hasattr(result[1], 'size'))
+        self.assertFalse(hasattr(result[1], 'external'))
+        # contents of each entry are of its own file.
+        self.assertEqual([e['contents']() for e in result[1:]],
+                         [storage.file(e['file']) for e in result[1:]])
+
+    def test_listdir_format_overridden(self):
+        class Storage(MercurialStorage):
+            def format(self, **kw):
+                kw['desc'] = 'formatted'
+                return MercurialStorage.format(self, **kw)
+        storage = Storage(self.workspace)
+        storage.checkout(self.revs[3])
+        result = list(storage.listdir(''))
+        self.assertTrue(isinstance(result[1], dict))
+        self.assertEqual(result[1]['desc'], 'formatted')
+        self.assertEqual(result[1]['size'], str(len(self.files[1])))
+
+    def test_log(self):
+        storage = MercurialStorage(self.workspace)
+        result = list(storage.log(self.revs[2], 2))
+        self.assertEqual(result[0]['node'], self.revs[2])
+        self.assertTrue(isinstance(result[0]['files'], list))
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(RecordTestCase))
+    suite.addTest(makeSuite(StorageRecordsTestCase))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main()
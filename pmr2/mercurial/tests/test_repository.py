@@ -2,11 +2,19 @@ import unittest
 import tempfile
 import shutil
 import os
+import errno
+import tarfile
+import zipfile
+from cStringIO import StringIO
 from os.path import dirname, join
 
+from mercurial import phases
+from mercurial import verify
+
 from pmr2.app.workspace.exceptions import *
 
 from pmr2.mercurial import *
+from pmr2.mercurial import backend
 
 class RepositoryInitTestCase(unittest.TestCase):
 
@@ -236,6 +244,55 @@ class SandboxTestCase(unittest.TestCase):
         # file should not exist.
         self.assert_(not os.path.exists(join(repo3._rpath, 'file1')))
 
+    def test_share(self):
+        self._demo()
+        dest = join(self.testdir, 'shared', 'sandbox')
+        sharedpath = self.sandbox.share(dest)
+        self.assertEqual(sharedpath, join(self.repodir, '.hg'))
+        self.assertFalse(os.path.exists(join(dest, '.hg', 'store')))
+        self.assertFalse(self.sandbox.shared)
+
+        sandbox = Sandbox(dest)
+        self.assertTrue(sandbox.shared)
+        self.assertEqual(open(join(dest, 'file3')).read(), self.files[0])
+        self.assertEqual(sandbox._repo.ui.config('paths', 'default'),
+                         self.repodir)
+
+        # commits are made into the shared store.
+        sandbox.add_file_content('file4', 'file4')
+        node = sandbox.commit('shared commit', self.user)
+        self.assertEqual(Storage(self.repodir)._repo[node].description(),
+                         'shared commit')
+
+    def test_share_no_update(self):
+        self._demo()
+        dest = join(self.testdir, 'shared')
+        self.sandbox.share(dest, update=False)
+        self.assertEqual(os.listdir(dest), ['.hg'])
+        self.assertEqual(len(Sandbox(dest)._repo), 3)
+
+    def test_share_rev(self):
+        self._demo()
+        dest = join(self.testdir, 'shared')
+        node = self.sandbox._repo.changelog.node(0)
+        self.sandbox.share(dest, node)
+        self.assertEqual(Sandbox(dest)._repo['.'].node(), node)
+        self.assertFalse(os.path.exists(join(dest, 'file3')))
+        self.assertRaises(RevisionNotFoundError, self.sandbox.share,
+                          join(self.testdir, 'other'), 'zzz')
+        self.assertRaises(PathExistsError, self.sandbox.share, dest)
+
+    def test_share_hooks(self):
+        self._demo()
+        # commits in the shared sandbox would bypass the hooks.
+        f = open(join(self.repodir, '.hg', 'hgrc'), 'a')
+        f.write('[hooks]\npretxnchangegroup.limits = false\n')
+        f.close()
+        dest = join(self.testdir, 'shared')
+        self.assertRaises(UnsupportedCommandError, Sandbox(self.repodir).share,
+                          dest)
+        self.assertFalse(os.path.exists(dest))
+
     def test_commit_fail(self):
         # commit failing due to missing required values
         self.assertRaises(ValueError, self.sandbox.commit, '', '')
@@ -255,6 +312,280 @@ class SandboxTestCase(unittest.TestCase):
         self.assertEqual(status['clean'], ['file1'])
         self.assertNotEqual(node1, node2, 'internal context not updated')
 
+    def test_commit_files(self):
+        self._demo()
+        node = self.sandbox.commit_files([
+            ('file1', self.files[2]),
+            ('nested/dir/file4', 'new file', 'x'),
+            ('file3', None),
+        ], 'in memory', self.user, date='0 0')
+        ctx = self.sandbox._repo[node]
+        self.assertEqual(ctx.parents()[0].description(), 'added3')
+        self.assertEqual(sorted(ctx.files()),
+                         ['file1', 'file3', 'nested/dir/file4'])
+        self.assertEqual(sorted(ctx.manifest()),
+                         ['file1', 'file2', 'nested/dir/file4'])
+        self.assertEqual(ctx['file1'].data(), self.files[2])
+        self.assertEqual(ctx['nested/dir/file4'].flags(), 'x')
+        self.assertEqual(ctx.user(), self.user)
+        self.assertEqual(ctx.date(), (0, 0))
+        self.assertEqual(self.sandbox._ctx.node(), node)
+        # working directory is untouched.
+        self.assertEqual(self.sandbox._repo['.'].description(), 'added3')
+        self.assertFalse(os.path.exists(join(self.repodir, 'nested')))
+
+    def test_commit_files_unchanged(self):
+        self._demo()
+        result = self.sandbox.commit_files([('file1', self.files[1])],
+                                           'no change', self.user)
+        self.assertEqual(result, None)
+
+    def test_commit_files_update(self):
+        self._demo()
+        node = self.sandbox.commit_files([('file4', 'file4')],
+                                         'updated', self.user, update=True)
+        self.assertEqual(self.sandbox._repo['.'].node(), node)
+        self.assertEqual(open(join(self.repodir, 'file4')).read(), 'file4')
+
+    def test_commit_files_fail(self):
+        self._demo()
+        self.assertRaises(PathInvalidError, self.sandbox.commit_files,
+            [('../outside', '')], self.msg, self.user)
+        self.assertRaises(PathInvalidError, self.sandbox.commit_files,
+            [('.hg/hgrc', '')], self.msg, self.user)
+        self.assertRaises(PathNotFoundError, self.sandbox.commit_files,
+            [('nosuchfile', None)], self.msg, self.user)
+        self.assertRaises(PathExistsError, self.sandbox.commit_files,
+            [('file1/file', '')], self.msg, self.user)
+        self.assertRaises(ValueError, self.sandbox.commit_files,
+            [('file4', '')], '', self.user)
+        self.assertEqual(len(self.sandbox._repo), 3)
+
+    def test_changed_files(self):
+        self._demo()
+        node = self.sandbox.commit_files([
+            ('file1', self.files[2]),
+            ('file2', self.files[1], 'x'),
+            ('nested/dir/file4', 'new file', 'l'),
+            ('file3', None),
+        ], 'in memory', self.user)
+        repo = self.sandbox._repo
+        result = self.sandbox.changed_files(2, node)
+        self.assertEqual(result, {
+            'added': [('nested/dir/file4', 'l')],
+            'removed': [('file3', '')],
+            'modified': [('file1', ''), ('file2', 'x')],
+        })
+        self.assertEqual(self.sandbox.changed_files(node, 2), {
+            'added': [('file3', '')],
+            'removed': [('nested/dir/file4', 'l')],
+            'modified': [('file1', ''), ('file2', '')],
+        })
+        self.assertEqual(self.sandbox.changed_files('null', 0), {
+            'added': [('file1', ''), ('file2', '')],
+            'removed': [],
+            'modified': [],
+        })
+        self.assertEqual(self.sandbox.changed_files(1, 1),
+            {'added': [], 'removed': [], 'modified': []})
+        self.assertRaises(RevisionNotFoundError, self.sandbox.changed_files,
+                          'nosuchrev', node)
+
+    def test_changed_files_delta(self):
+        self.sandbox.commit_files([('file%d' % i, 'file%d' % i)
+            for i in xrange(100)], 'many files', self.user)
+        self.sandbox.commit_files([('new', 'new')], 'added', self.user)
+        self.sandbox.commit_files([('file50', 'changed'), ('file60', None)],
+            'changed', self.user)
+        mf = self.sandbox._repo.manifest
+        self.assertEqual(mf.deltaparent(1), 0)
+        self.assertEqual(mf.deltaparent(2), 1)
+
+        revisions = []
+        def revision(rev):
+            revisions.append(rev)
+            return type(mf).revision(mf, rev)
+        mf.revision = revision
+        # only additions are read from the stored delta.
+        self.assertEqual(self.sandbox.changed_files(0, 1)['added'],
+                         [('new', '')])
+        self.assertEqual(revisions, [])
+        # removed lines are read from the text of the first revision.
+        self.assertEqual(self.sandbox.changed_files(1, 2), {
+            'added': [],
+            'removed': [('file60', '')],
+            'modified': [('file50', '')],
+        })
+        self.assertEqual(revisions, [1])
+
+    def test_diff(self):
+        self._demo()
+        node = self.sandbox.commit_files([
+            ('file1', 'changed\n'),
+            ('nested/file4', 'new\nfile\n'),
+        ], 'changed', self.user)
+        diff = self.sandbox.diff(node)
+        self.assertFalse(isinstance(diff, (list, str)))
+        diff = ''.join(diff)
+        self.assertTrue('diff --git a/file1 b/file1\n' in diff)
+        self.assertTrue('+changed\n' in diff)
+        self.assertTrue('+++ b/nested/file4\n' in diff)
+        diff = ''.join(self.sandbox.diff(node, 'nested'))
+        self.assertFalse('file1' in diff)
+        self.assertTrue('nested/file4' in diff)
+        self.assertEqual(''.join(self.sandbox.diff(node, 'file2')), '')
+
+        # kinds of patterns are not honoured.
+        self.assertEqual(''.join(self.sandbox.diff(node, 're:.*')), '')
+        listfile = join(self.testdir, 'list')
+        open(listfile, 'w').write('file1\n')
+        self.assertEqual(''.join(self.sandbox.diff(node,
+                                                   'listfile:' + listfile)),
+                         '')
+        node = self.sandbox.commit_files([('re:.*', 'literal\n')],
+                                         'pattern', self.user)
+        diff = ''.join(self.sandbox.diff(node, 're:.*'))
+        self.assertTrue('+++ b/re:.*\n' in diff)
+
+    def test_diffstat(self):
+        self._demo()
+        node = self.sandbox.commit_files([
+            ('file1', 'changed\n'),
+            ('nested/file4', 'new\nfile\n'),
+            ('binary', '\0binary'),
+        ], 'changed', self.user)
+        answer = {
+            'added': 3,
+            'removed': self.files[1].count('\n'),
+            'files': [
+                {'file': 'binary', 'added': 0, 'removed': 0, 'binary': True},
+                {'file': 'file1', 'added': 1,
+                 'removed': self.files[1].count('\n'), 'binary': False},
+                {'file': 'nested/file4', 'added': 2, 'removed': 0,
+                 'binary': False},
+            ],
+        }
+        self.assertEqual(self.sandbox.diffstat(node), answer)
+        # cached by node.
+        self.sandbox.diff = None
+        self.assertEqual(self.sandbox.diffstat(node), answer)
+        self.assertEqual(Storage(self.repodir).diffstat(node), answer)
+
+    def test_changeset_bare(self):
+        # a repository without any checkout, which may have been pushed
+        # to.
+        self._demo()
+        bare = join(self.testdir, 'bare')
+        self.sandbox.clone(bare, update=False)
+        sandbox = Sandbox(bare)
+        changeset = sandbox.changeset()
+        self.assertEqual(changeset.parent.description(), 'added3')
+        changeset.add_file_content('file1', 'bare')
+        changeset.remove('file2')
+        changeset.add_file_content('file5', 'new')
+        changeset.remove('file5')
+        self.assertEqual(len(changeset), 2)
+        node = changeset.commit('bare commit', self.user)
+        ctx = sandbox._repo[node]
+        self.assertEqual(sorted(ctx.manifest()), ['file1', 'file3'])
+        self.assertEqual(os.listdir(bare), ['.hg'])
+
+    def test_changeset_branch(self):
+        self._demo()
+        changeset = self.sandbox.changeset(branch='other')
+        node = changeset.commit('new branch', self.user)
+        self.assertEqual(self.sandbox._repo[node].branch(), 'other')
+
+    def _archive(self, kind):
+        entries = [
+            ('top/file1', self.files[0], 0644),
+            ('top/nested/file2', self.files[1], 0755),
+            ('top/../../outside', 'outside', 0644),
+            ('top/.hg/hgrc', '[hooks]\n', 0644),
+        ]
+        stream = StringIO()
+        if kind == 'zip':
+            zf = zipfile.ZipFile(stream, 'w')
+            for name, content, mode in entries:
+                info = zipfile.ZipInfo(name)
+                info.external_attr = (0100000 | mode) << 16
+                zf.writestr(info, content)
+            zf.close()
+        else:
+            tf = tarfile.open(fileobj=stream, mode='w:gz')
+            for name, content, mode in entries:
+                info = tarfile.TarInfo(name)
+                info.size = len(content)
+                info.mode = mode
+                tf.addfile(info, StringIO(content))
+            link = tarfile.TarInfo('top/link')
+            link.type = tarfile.SYMTYPE
+            link.linkname = '/etc/passwd'
+            tf.addfile(link)
+            tf.close()
+        stream.seek(0)
+        return stream
+
+    def _check_import(self, errors, imported):
+        self.assertEqual(imported, ['file1', 'nested/file2'])
+        self.assertEqual([e[0] for e in errors],
+                         ['top/../../outside', 'top/.hg/hgrc'])
+        self.assertEqual(open(join(self.repodir, 'file1')).read(),
+                         self.files[0])
+        self.assertTrue(os.access(join(self.repodir, 'nested', 'file2'),
+                                  os.X_OK))
+        self.assertFalse(os.path.exists(join(self.testdir, 'outside')))
+        status = statdict(self.sandbox._repo.status())
+        self.assertEqual(status['added'], ['file1', 'nested/file2'])
+
+    def test_import_archive_zip(self):
+        seen = []
+        errors, imported = self.sandbox.import_archive(
+            self._archive('zip'), strip=1,
+            progress=lambda i, name: seen.append((i, name)))
+        self._check_import(errors, imported)
+        self.assertEqual(seen[0], (1, 'top/file1'))
+        self.assertEqual(len(seen), 4)
+
+    def test_import_archive_tar(self):
+        class Stream(object):
+            # a stream that cannot seek.
+            def __init__(self, fp):
+                self.read = fp.read
+        errors, imported = self.sandbox.import_archive(
+            Stream(self._archive('tar')), strip=1)
+        self.assertEqual(errors[-1], ('top/link', 'unsupported entry type'))
+        self._check_import(errors[:-1], imported)
+        self.sandbox.commit(self.msg, self.user)
+        self.assertEqual(sorted(self.sandbox._ctx.manifest()),
+                         ['file1', 'nested/file2'])
+
+    def test_import_archive_dest(self):
+        self._demo()
+        errors, imported = self.sandbox.import_archive(
+            self._archive('zip'), dest='sub', kind='zip')
+        # the names are resolved relative to dest.
+        self.assertEqual(imported,
+                         ['sub/top/file1', 'sub/top/nested/file2', 'outside'])
+        self.assertEqual(errors[0][0], 'top/.hg/hgrc')
+        # the existing file cannot become a directory.
+        errors, imported = self.sandbox.import_archive(
+            self._archive('zip'), dest='file1', strip=1)
+        self.assertEqual(imported, [])
+        self.assertEqual(len(errors), 4)
+
+    def test_import_archive_symlink(self):
+        victim = join(self.testdir, 'victim')
+        open(victim, 'w').write('victim')
+        os.symlink(victim, join(self.repodir, 'file1'))
+        errors, imported = self.sandbox.import_archive(
+            self._archive('tar'), strip=1)
+        # not written through the symlink in the working directory.
+        self.assertEqual(errors[0], ('top/file1', 'path is a symbolic link'))
+        self.assertEqual(imported, ['nested/file2'])
+        self.assertEqual(open(victim).read(), 'victim')
+        self.assertTrue(os.path.islink(join(self.repodir, 'file1')))
+
     def test_current_branch(self):
         self._demo()
         self.assertEqual('default', self.sandbox.current_branch())
@@ -438,6 +769,109 @@ class SandboxTestCase(unittest.TestCase):
         result = target.push()
         self.assert_(result)
 
+    def _transfers(self):
+        transfers = []
+        transfer = backend._local_transfer
+        def counted(*a, **kw):
+            result = transfer(*a, **kw)
+            transfers.append(result)
+            return result
+        backend._local_transfer = counted
+        self.addCleanup(setattr, backend, '_local_transfer', transfer)
+        return transfers
+
+    def _verify(self, sandbox):
+        repo = Sandbox(sandbox._rpath)._repo
+        self.assertEqual(verify.verify(repo), None)
+        return repo
+
+    def test_pull_local_transfer(self):
+        self._demo()
+        transfers = self._transfers()
+        dest = join(self.testdir, 'dest')
+        Sandbox.create(dest, True)
+        target = Sandbox(dest)
+
+        # an empty target gets the revlogs hardlinked.
+        self.assertEqual(target.pull(self.repodir), 1)
+        self.assertEqual(len(transfers[-1]), 3)
+        repo = self._verify(target)
+        self.assertEqual(repo['tip'].node(), self.sandbox._repo['tip'].node())
+        self.assertEqual(repo['tip'].phase(), phases.public)
+        self.assertEqual(open(join(dest, 'file3')).read(), self.files[0])
+        self.assertEqual(os.stat(repo.sjoin('data/file3.i')).st_nlink, 2)
+
+        # new revisions are appended, breaking the links.
+        self.sandbox.add_file_content('file3', 'new content for file3')
+        self.sandbox.add_file_content('file4', 'file4')
+        self.sandbox.commit('added4', 'user4 <4@example.com>')
+        self.assertEqual(target.pull(self.repodir, update=False), 1)
+        self.assertEqual(len(transfers[-1]), 1)
+        repo = self._verify(target)
+        self.assertEqual(repo['tip'].node(), self.sandbox._repo['tip'].node())
+        self.assertEqual(os.stat(repo.sjoin('data/file3.i')).st_nlink, 1)
+        self.assertEqual(repo['tip']['file3'].data(), 'new content for file3')
+        self._verify(self.sandbox)
+
+        self.assertEqual(target.pull(self.repodir), 0)
+        self.assertEqual(transfers[-1], [])
+
+    def test_pull_local_diverged(self):
+        self._demo()
+        dest = join(self.testdir, 'dest')
+        self.sandbox.clone(dest)
+        target = Sandbox(dest)
+        target.add_file_content('file1', 'target')
+        target.commit('target', 'user4 <4@example.com>')
+        self.sandbox.add_file_content('file1', 'source')
+        self.sandbox.commit('source', 'user4 <4@example.com>')
+
+        transfers = self._transfers()
+        # the revlogs of the target are no longer a prefix.
+        self.assertEqual(target.pull(self.repodir, update=False), 2)
+        self.assertEqual(transfers, [None])
+        repo = self._verify(target)
+        self.assertEqual(len(repo), 5)
+
+    def test_pull_local_hooks(self):
+        self._demo()
+        dest = join(self.testdir, 'dest')
+        Sandbox.create(dest, True)
+        f = open(join(dest, '.hg', 'hgrc'), 'a')
+        f.write('[hooks]\nincoming.test = true\n')
+        f.close()
+        transfers = self._transfers()
+        self.assertEqual(Sandbox(dest).pull(self.repodir), 1)
+        self.assertEqual(transfers, [None])
+
+    def test_push_local_transfer(self):
+        self._demo()
+        dest = join(self.testdir, 'dest')
+        self.sandbox.clone(dest)
+        target = Sandbox(dest)
+        target.add_file_content('file1', 'target')
+        target.add_file_content('newfile', 'new')
+        target.commit('tar1', 'user4 <4@example.com>')
+        node = target._repo['tip'].node()
+
+        transfers = self._transfers()
+        self.assertTrue(target.push())
+        self.assertEqual(transfers, [[node]])
+        repo = self._verify(self.sandbox)
+        self.assertEqual(repo['tip'].node(), node)
+        self.assertEqual(repo['tip'].phase(), phases.public)
+        self.assertEqual(Sandbox(dest)._repo['tip'].phase(), phases.public)
+
+        # the destination has a changeset the target doesn't have, so
+        # it is pushed normally.
+        self.sandbox.add_file_content('file2', 'source')
+        self.sandbox.commit('source', 'user4 <4@example.com>')
+        target.add_file_content('file2', 'target')
+        target.commit('tar2', 'user4 <4@example.com>')
+        self.assertTrue(target.push())
+        self.assertEqual(transfers[-1], None)
+        self.assertEqual(len(self._verify(self.sandbox)), 6)
+
     def test_status(self):
         # status code is based on manifest, including the additional
         # aentries code added to both status and manifest.
@@ -484,6 +918,64 @@ class SandboxTestCase(unittest.TestCase):
         self.assertEqual(fent[0]['basename'], 'sleep')
         self.assertEqual(fent[0]['status'], 'clean')
 
+    def test_status_scoped(self):
+        self.sandbox.add_file_content('file1', self.files[0])
+        self.sandbox.add_file_content('a/file2', self.files[1])
+        self.sandbox.add_file_content('a/b/c/file3', self.files[2])
+        self.sandbox.commit(self.msg, self.user)
+        self.sandbox.add_file_content('a/file4', self.files[2])
+        self.sandbox.add_file_content('a/file2', self.files[2])
+        open(join(self.repodir, 'a', 'unknown'), 'w').close()
+        os.utime(join(self.repodir, 'a', 'file2'), (86400, 86400))
+
+        stat = self.sandbox.status(path='a').next()
+        fent = list(stat['fentries']())
+        dent = list(stat['dentries']())
+        self.assertEqual([(i['file'], i['status']) for i in fent],
+                         [('a/file2', 'modified'), ('a/file4', 'added')])
+        self.assertEqual(fent[0]['date'], (86400, fent[0]['date'][1]))
+        self.assertEqual(fent[0]['basename'], 'file2')
+        self.assertEqual([i['path'] for i in dent], ['/a/b/'])
+        self.assertEqual(stat['path'], '/a/')
+
+        stat = self.sandbox.status(path='a', clean=False, unknown=True).next()
+        fent = list(stat['fentries']())
+        self.assertEqual([(i['file'], i['status']) for i in fent], [
+            ('a/file2', 'modified'),
+            ('a/file4', 'added'),
+            ('a/unknown', 'unknown'),
+        ])
+
+        stat = self.sandbox.status(clean=False).next()
+        self.assertEqual(list(stat['fentries']()), [])
+        self.assertEqual([i['path'] for i in stat['dentries']()], ['/a/'])
+
+    def test_status_ignored(self):
+        self.sandbox.add_file_content('.hgignore', 'syntax: glob\n*.pyc\n')
+        self.sandbox.commit(self.msg, self.user)
+        open(join(self.repodir, 'ignored.pyc'), 'w').close()
+        open(join(self.repodir, 'unknown'), 'w').close()
+
+        def listed(**kw):
+            stat = self.sandbox.status(clean=False, **kw).next()
+            return [(i['file'], i['status']) for i in stat['fentries']()]
+
+        # independent of each other.
+        self.assertEqual(listed(), [('ignored.pyc', 'ignored')])
+        self.assertEqual(listed(ignored=False, unknown=True),
+                         [('unknown', 'unknown')])
+        self.assertEqual(listed(unknown=True), [
+            ('ignored.pyc', 'ignored'), ('unknown', 'unknown')])
+        self.assertEqual(listed(ignored=False), [])
+
+    def test_status_outside(self):
+        open(join(self.testdir, 'secret.txt'), 'w').close()
+        for path in ('..', '../', 'a/../..', '../repodir2'):
+            self.assertRaises(PathInvalidError, self.sandbox.status,
+                              path=path, unknown=True)
+        stat = self.sandbox.status(path='a/..', unknown=True).next()
+        self.assertEqual(stat['path'], '/')
+
     def test_source_check(self):
         self.assertRaises(TypeError,
                 self.sandbox._source_check, None)
@@ -536,6 +1028,166 @@ class SandboxTestCase(unittest.TestCase):
         self.assertEqual(len(ff), 0)
         self.assertEqual(len(ss), 0)
 
+    def _demo_dir(self):
+        self._demo()
+        self.sandbox.add_file_content('dir/a', 'a')
+        self.sandbox.add_file_content('dir/b', 'b')
+        self.sandbox.commit('added dir', self.user)
+
+    def test_apply_operations(self):
+        self._demo_dir()
+        ops = [
+            ('rename', 'dir', 'newdir'),
+            ('copy', 'file1', 'newdir/file1'),
+            ('remove', 'file2'),
+            ('rename', 'file3', 'newdir'),
+        ]
+        errors, plan = self.sandbox.apply_operations(ops, dry_run=True)
+        self.assertEqual(errors, [])
+        self.assertEqual(plan, [
+            ('remove', 'file2'),
+            ('move', 'dir/a', 'newdir/a'),
+            ('move', 'dir/b', 'newdir/b'),
+            ('copy', 'file1', 'newdir/file1'),
+            ('move', 'file3', 'newdir/file3'),
+        ])
+        # nothing changed
+        status = statdict(self.sandbox._repo.status())
+        self.assertEqual(status['removed'], [])
+
+        self.assertEqual(self.sandbox.apply_operations(ops), ([], plan))
+        repo = Sandbox(self.repodir)._repo
+        status = statdict(repo.status())
+        self.assertEqual(status['added'], ['newdir/a', 'newdir/b',
+            'newdir/file1', 'newdir/file3'])
+        self.assertEqual(status['removed'], ['dir/a', 'dir/b', 'file2',
+            'file3'])
+        self.assertEqual(repo.dirstate.copied('newdir/a'), 'dir/a')
+        self.assertEqual(repo.dirstate.copied('newdir/file1'), 'file1')
+        self.assertFalse(os.path.exists(join(self.repodir, 'dir')))
+        self.assertEqual(open(join(self.repodir, 'newdir', 'file3')).read(),
+                         self.files[0])
+
+    def test_apply_operations_swap(self):
+        self._demo()
+        errors, plan = self.sandbox.apply_operations([
+            ('rename', 'file1', 'tmp'),
+            ('rename', 'file3', 'file1'),
+            ('rename', 'tmp', 'file3'),
+        ])
+        self.assertEqual(errors, [])
+        self.assertEqual(plan, [
+            ('move', 'file3', 'file1'),
+            ('move', 'file1', 'file3'),
+        ])
+        status = statdict(Sandbox(self.repodir)._repo.status())
+        self.assertEqual(status['modified'], ['file1', 'file3'])
+        self.assertEqual(status['added'] + status['removed'], [])
+        self.assertEqual(open(join(self.repodir, 'file1')).read(),
+                         self.files[0])
+        self.assertEqual(open(join(self.repodir, 'file3')).read(),
+                         self.files[1])
+
+    def test_apply_operations_errors(self):
+        self._demo_dir()
+        open(join(self.repodir, 'untracked'), 'w').close()
+        ops = [
+            ('rename', 'file1', 'file2'),
+            ('remove', 'nothing'),
+            ('copy', '../outside', 'file4'),
+            ('copy', 'file1', 'untracked'),
+            ('rename', 'file2', 'file1/file'),
+            ('move', 'file1', 'file5'),
+            ('copy', 'file1', 'file6'),
+        ]
+        errors, plan = self.sandbox.apply_operations(ops)
+        self.assertEqual([e[0] for e in errors], ops[:-1])
+        self.assertEqual(plan, [('copy', 'file1', 'file6')])
+        self.assertFalse(os.path.exists(join(self.repodir, 'file6')))
+
+        errors, plan = self.sandbox.apply_operations(
+            [('copy', 'file1', 'untracked')], force=True)
+        self.assertEqual(errors, [])
+        self.assertEqual(open(join(self.repodir, 'untracked')).read(),
+                         self.files[1])
+
+    def test_apply_operations_untracked_parent(self):
+        self._demo()
+        open(join(self.repodir, 'blocker'), 'w').close()
+        ops = [('rename', 'file1', 'blocker/file1')]
+        errors, plan = self.sandbox.apply_operations(ops)
+        self.assertEqual([e[0] for e in errors], ops)
+        self.assertEqual(open(join(self.repodir, 'file1')).read(),
+                         self.files[1])
+        errors, plan = self.sandbox.apply_operations(ops, force=True)
+        self.assertEqual([e[0] for e in errors], ops)
+
+        # a tracked file in the way is moved away first.
+        errors, plan = self.sandbox.apply_operations([
+            ('remove', 'file2'), ('rename', 'file1', 'file2/file1')])
+        self.assertEqual(errors, [])
+        self.assertEqual(open(join(self.repodir, 'file2', 'file1')).read(),
+                         self.files[1])
+
+    def test_apply_operations_restore(self):
+        self._demo()
+        # the destination becomes unwritable after planning.
+        original = backend.util.makedirs
+        def makedirs(name, mode=None):
+            if name == join(self.repodir, 'dir'):
+                raise OSError(errno.ENOTDIR, 'Not a directory', name)
+            return original(name, mode)
+        backend.util.makedirs = makedirs
+        try:
+            self.assertRaises(OSError, self.sandbox.apply_operations,
+                              [('rename', 'file1', 'dir/file1')])
+        finally:
+            backend.util.makedirs = original
+        self.assertEqual(open(join(self.repodir, 'file1')).read(),
+                         self.files[1])
+        status = statdict(Sandbox(self.repodir)._repo.status())
+        self.assertEqual(status['removed'] + status['deleted'], [])
+        self.assertEqual([f for f in os.listdir(self.sandbox._repo.join(''))
+                          if f.startswith('tmp')], [])
+
+    def test_apply_operations_restore_partial(self):
+        self._demo()
+        open(join(self.repodir, 'file1'), 'w').write('uncommitted')
+        open(join(self.repodir, 'untracked'), 'w').write('untracked')
+        # the second copy fails after everything is moved aside and the
+        # first destination is written.
+        original = backend.util.copyfile
+        calls = []
+        def copyfile(src, dest):
+            calls.append(dest)
+            if len(calls) == 2:
+                raise IOError(errno.ENOSPC, 'No space left on device', dest)
+            return original(src, dest)
+        backend.util.copyfile = copyfile
+        try:
+            self.assertRaises(IOError, self.sandbox.apply_operations, [
+                ('remove', 'file2'),
+                ('rename', 'file1', 'file2/file1'),
+                ('copy', 'file3', 'new/file3'),
+                ('copy', 'file3', 'untracked'),
+            ], force=True)
+        finally:
+            backend.util.copyfile = original
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(open(join(self.repodir, 'file1')).read(),
+                         'uncommitted')
+        self.assertEqual(open(join(self.repodir, 'file2')).read(),
+                         self.files[1])
+        self.assertEqual(open(join(self.repodir, 'untracked')).read(),
+                         'untracked')
+        self.assertFalse(os.path.exists(join(self.repodir, 'new')))
+        status = statdict(Sandbox(self.repodir)._repo.status())
+        self.assertEqual(status['modified'], ['file1'])
+        self.assertEqual(status['added'] + status['removed'] +
+                         status['deleted'], [])
+        self.assertEqual([f for f in os.listdir(self.sandbox._repo.join(''))
+                          if f.startswith('tmp')], [])
+
     def test_remove_file_str(self):
         for i, x in enumerate(self.filelist):
             self.sandbox.add_file_content(self.filelist[i], self.files[i])
@@ -0,0 +1,159 @@
+import unittest
+import tempfile
+import shutil
+import sqlite3
+from os.path import join
+
+from mercurial import encoding
+
+from pmr2.mercurial import *
+from pmr2.mercurial import search
+from pmr2.mercurial.search import LogIndex
+from pmr2.mercurial.utility import MercurialStorage
+from pmr2.mercurial.utility import MercurialStorageUtility
+from pmr2.mercurial.tests.test_utility import TestCase
+
+
+class LogIndexTestCase(unittest.TestCase):
+
+    fts = True
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        self.repodir = join(self.testdir, 'repodir')
+        Sandbox.create(self.repodir, True)
+        self.sandbox = Sandbox(self.repodir, ctx='tip')
+        self.commit('heart/model.cellml', 'Initial import of the heart model',
+                    'Alice <alice@example.com>')
+        self.commit('heart/model.cellml', 'Fixed the units in heart model',
+                    'Bob <bob@example.com>')
+        self.commit('liver/model.cellml', 'Liver model, with 100% units',
+                    'Alice <alice@example.com>')
+        local, encoding.encoding = encoding.encoding, 'utf-8'
+        try:
+            self.commit('docs/README', u'Documented the caf\xe9 model'.encode(
+                        'utf8'), 'Carol <carol@example.com>')
+        finally:
+            encoding.encoding = local
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def commit(self, path, message, user):
+        self.sandbox.add_file_content(path, message)
+        self.sandbox.commit(message, user)
+
+    def index(self):
+        return LogIndex(self.sandbox._repo, fts=self.fts)
+
+    def test_search(self):
+        index = self.index()
+        self.assertEqual(index.update(), 4)
+        self.assertEqual(index.search('heart units'), ([1], None))
+        self.assertEqual(index.search('units'), ([2, 1], None))
+        self.assertEqual(index.search('alice'), ([2, 0], None))
+        self.assertEqual(index.search('liver/model.cellml'), ([2], None))
+        self.assertEqual(index.search('docs'), ([3], None))
+        self.assertEqual(index.search(u'caf\xe9'), ([3], None))
+        self.assertEqual(index.search('nothing'), ([], None))
+        self.assertEqual(index.search('  '), ([], None))
+
+    def test_pages(self):
+        index = self.index()
+        index.update()
+        self.assertEqual(index.search('model', 2), ([3, 2], 2))
+        self.assertEqual(index.search('model', 2, 2), ([1, 0], None))
+
+    def test_incremental(self):
+        index = self.index()
+        index.update()
+        self.assertEqual(index.update(), 0)
+        self.commit('kidney/model.cellml', 'Kidney model',
+                    'Dan <d@example.com>')
+        index = self.index()
+        self.assertEqual(index.search('kidney'), ([], None))
+        self.assertEqual(index.update(), 1)
+        self.assertEqual(index.search('kidney'), ([4], None))
+
+        # changesets indexed that are no longer there are indexed again.
+        conn = sqlite3.connect(index.path)
+        conn.execute("UPDATE meta SET value = ? WHERE key = 'last'",
+                     ('0' * 40,))
+        conn.commit()
+        conn.close()
+        self.assertEqual(index.update(), 5)
+        self.assertEqual(index.search('model'), ([4, 3, 2, 1, 0], None))
+
+    def test_read_only(self):
+        self.index().update()
+        # another connection holding the write lock does not block
+        # opening the index, or searching it while it is up to date.
+        conn = sqlite3.connect(self.index().path, isolation_level=None)
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            index = self.index()
+            index._connect = lambda: sqlite3.connect(index.path, timeout=0,
+                                                     isolation_level=None)
+            self.assertEqual(index.update(), 0)
+            self.assertEqual(index.search('liver'), ([2], None))
+        finally:
+            conn.execute('ROLLBACK')
+            conn.close()
+
+    def test_updated(self):
+        search.updated(self.repodir)
+        self.assertEqual(self.index().update(), 0)
+        # failures are logged.
+        search.updated(join(self.testdir, 'nosuchrepo'))
+
+
+class LikeLogIndexTestCase(LogIndexTestCase):
+
+    fts = False
+
+    def test_like(self):
+        index = self.index()
+        self.assertFalse(index.fts)
+        index.update()
+        # not taken as wildcards.
+        self.assertEqual(index.search('100%'), ([2], None))
+        self.assertEqual(index.search('100_'), ([], None))
+        self.assertEqual(index.search('ixed'), ([1], None))
+
+
+class StorageSearchTestCase(TestCase):
+
+    def test_search_log(self):
+        storage = MercurialStorage(self.workspace)
+        entries, cursor = storage.search_log('added user3')
+        self.assertEqual(cursor, None)
+        self.assertEqual([e['node'] for e in entries],
+                         [self.revs[3], self.revs[2]])
+        self.assertEqual(entries[0]['files'], [self.nested_name])
+        self.assertEqual(entries[0]['email'], '3@example.com')
+        self.assertEqual(entries[0]['date'][:10], self.date)
+
+        entries, cursor = storage.search_log('added', 3)
+        self.assertEqual(len(entries), 3)
+        entries, cursor = storage.search_log('added', 3, cursor)
+        self.assertEqual([e['node'] for e in entries], [self.revs[0]])
+        self.assertEqual(cursor, None)
+
+    def test_sync(self):
+        utility = MercurialStorageUtility()
+        utility.sync(self.simple2, join(self.testdir, 'simple1'))
+        # indexed as the changesets were pulled.
+        index = LogIndex(Storage(self.simple2.path)._repo)
+        self.assertEqual(index.update(), 0)
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(LogIndexTestCase))
+    suite.addTest(makeSuite(LikeLogIndexTestCase))
+    suite.addTest(makeSuite(StorageSearchTestCase))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main()
@@ -435,6 +435,84 @@ class StorageTestCase(TestCase):
                           self.nested_name + 'asdf')
         self.assertRaises(PathNotFoundError, storage.listdir, 'nested/not')
 
+    def test_520_walk(self):
+        storage = MercurialStorage(self.workspace)
+        result = list(storage.walk(''))
+        self.assertEqual([(i['permissions'], i['file']) for i in result], [
+            ('-rw-r--r--', 'file1'),
+            ('-rw-r--r--', 'file2'),
+            ('-rw-r--r--', 'file3'),
+            ('drwxr-xr-x', 'nested'),
+            ('drwxr-xr-x', 'nested/deep'),
+            ('drwxr-xr-x', 'nested/deep/dir'),
+            ('-rw-r--r--', 'nested/deep/dir/file'),
+        ])
+        self.assertEqual(result[-1]['basename'], 'file')
+        self.assertEqual(result[-1]['size'], str(len(self.nested_file)))
+        self.assertEqual(result[-1]['contents'](), self.nested_file)
+
+    def test_521_walk_depth(self):
+        storage = MercurialStorage(self.workspace)
+        result = list(storage.walk('', 1))
+        # same entries as listdir, in path order.
+        answer = list(storage.listdir(''))
+        self.assertEqual(sorted(i['file'] for i in result),
+                         sorted(i['file'] for i in answer))
+        result = list(storage.walk('nested', 2))
+        self.assertEqual([i['file'] for i in result],
+                         ['nested/deep', 'nested/deep/dir'])
+        self.assertEqual(list(storage.walk('nested', 0)), [])
+
+    def test_522_walk_subrepo(self):
+        storage = MercurialStorage(self.pmr2hgtest)
+        storage.checkout(util.ARCHIVE_REVS[1])
+        result = list(storage.walk(''))
+        self.assertEqual([i['basename'] for i in result], [
+            '.hgsub', '.hgsubstate', 'README', 'ext', 'import1', 'file1'])
+        self.assertEqual(result[4]['permissions'], 'lrwxrwxrwx')
+        self.assertEqual(result[4]['fullpath'],
+            'http://models.example.com/w/import1/file/'
+            'ce679be0c07e30e81f93cc308ccdaab97b4da313')
+        self.assertEqual(len(list(storage.walk('', 1))), 5)
+
+    def test_523_walk_invalid_path(self):
+        storage = MercurialStorage(self.workspace)
+        self.assertRaises(PathNotDirError, storage.walk, 'file1')
+        self.assertRaises(PathNotFoundError, storage.walk, 'nested/not')
+
+    def test_530_changed_files(self):
+        storage = MercurialStorage(self.workspace)
+        storage.checkout(self.revs[2])
+        self.assertEqual(storage.changed_files(self.revs[0]), {
+            'added': [('file3', '')],
+            'removed': [],
+            'modified': [('file1', ''), ('file2', '')],
+        })
+        self.assertEqual(storage.changed_files(self.revs[3], self.revs[1]), {
+            'added': [],
+            'removed': [('file3', ''), (self.nested_name, '')],
+            'modified': [('file2', '')],
+        })
+
+    def test_540_diff(self):
+        storage = MercurialStorage(self.workspace)
+        diff = ''.join(storage.diff())
+        self.assertTrue(diff.startswith('diff --git a/%s b/%s\n' %
+                                        (self.nested_name, self.nested_name)))
+        diff = ''.join(storage.diff(self.revs[1], 'file2'))
+        self.assertEqual(diff, '')
+
+    def test_541_diffstat(self):
+        storage = MercurialStorage(self.workspace)
+        storage.checkout(self.revs[2])
+        result = storage.diffstat()
+        self.assertEqual([i['file'] for i in result['files']],
+                         ['file2', 'file3'])
+        self.assertEqual(result['files'][1]['added'],
+                         self.files[0].count('\n'))
+        self.assertEqual(result['added'],
+                         sum(i['added'] for i in result['files']))
+
     def test_600_pathinfo(self):
         storage = MercurialStorage(self.workspace)
         storage.checkout(self.revs[0])
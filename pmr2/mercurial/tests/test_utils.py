@@ -4,6 +4,8 @@ import shutil
 import os
 from os.path import dirname, join
 
+from mercurial import templatefilters
+
 from pmr2.app.workspace import exceptions
 
 from pmr2.mercurial import utils
@@ -142,10 +144,95 @@ class WebdirTestCase(unittest.TestCase):
         self.assertRaises(exceptions.SubrepoPathUnsupportedError,
             utils.match_subrepo, substate, 'fail/local/test')
 
+    def test_subrepo_trie_list(self):
+        trie = utils.SubrepoTrie(self.substate)
+        self.assertEqual(trie.list('/'),
+                         utils.list_subrepo(self.substate, '/'))
+        self.assertEqual(utils.list_subrepo(trie, '/nested/'),
+                         [('mod3', self.substate['nested/mod3'])])
+        # the directory of the path
+        self.assertEqual(trie.list('/nested/mod3'), trie.list('/nested/'))
+        self.assertEqual(trie.list('/missing/dir/'), [])
+        self.assertEqual(trie.list('nested/'), [])
+
+    def test_subrepo_trie_match(self):
+        substate = dict(self.substate)
+        substate['nested/mod3/inner'] = (
+            'http://models.example.com/inner', 'f0f0f', 'hg')
+        trie = utils.SubrepoTrie(substate)
+        # the subrepo closest to the root contains the path.
+        self.assertEqual(trie.match('nested/mod3/inner/file'),
+                         ('nested/mod3', substate['nested/mod3']))
+        self.assertEqual(trie.match('nested'), None)
+        self.assertEqual(trie.match('nested/mod3file'), None)
+        self.assertEqual(trie.match(''), None)
+        result = utils.match_subrepo(trie, 'mod1/').next()
+        self.assertEqual(result['path'], '')
+        self.assertRaises(exceptions.SubrepoPathUnsupportedError,
+            utils.match_subrepo, trie, 'fail')
+
+    def test_subrepo_trie_cached(self):
+        class Context(object):
+            def __init__(self, node, substate):
+                self._node = node
+                self.substate = substate
+            def node(self):
+                return self._node
+        trie = utils.subrepo_trie(Context('1' * 20, self.substate))
+        self.assertTrue(utils.subrepo_trie(Context('1' * 20, {})) is trie)
+        self.assertFalse(utils.subrepo_trie(Context('2' * 20, {})) is trie)
+        # the working directory is not cached.
+        working = utils.subrepo_trie(Context(None, self.substate))
+        self.assertFalse(utils.subrepo_trie(Context(None, {})) is working)
+
+
+class FilterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+        self.filters = dict(templatefilters.filters)
+        def counted(name):
+            func = templatefilters.filters[name]
+            def f(input):
+                self.calls.append((name, input))
+                return func(input)
+            return f
+        for name in ('isodate', 'person', 'age'):
+            templatefilters.filters[name] = counted(name)
+
+    def tearDown(self):
+        templatefilters.filters.clear()
+        templatefilters.filters.update(self.filters)
+
+    def test_memoized_filter(self):
+        person = utils.memoized_filter('person')
+        self.assertEqual(person('User <user@example.com>'), 'User')
+        self.assertEqual(person('User <user@example.com>'), 'User')
+        self.assertEqual(len(self.calls), 1)
+        # memoized per function.
+        utils.memoized_filter('person')('User <user@example.com>')
+        self.assertEqual(len(self.calls), 2)
+
+    def test_memoized_filter_age(self):
+        age = utils.memoized_filter('age')
+        age((0, 0))
+        age((0, 0))
+        self.assertEqual(len(self.calls), 2)
+
+    def test_memoized_filter_fallback(self):
+        self.assertEqual(utils.memoized_filter('nosuchfilter')('x'), 'x')
+        # failures return the input, like filter.
+        self.assertEqual(utils.memoized_filter('isodate')('bad'), 'bad')
+        # unhashable inputs are not memoized.
+        self.assertEqual(utils.memoized_filter('isodate')([0, 0]),
+                         utils.filter([0, 0], 'isodate'))
+
+
 def test_suite():
     from unittest import TestSuite, makeSuite
     suite = TestSuite()
     suite.addTest(makeSuite(WebdirTestCase))
+    suite.addTest(makeSuite(FilterTestCase))
     return suite
 
 if __name__ == '__main__':
@@ -0,0 +1,187 @@
+import unittest
+import tempfile
+import shutil
+import os
+from os.path import join
+
+from mercurial.localrepo import localrepository
+
+from pmr2.mercurial import *
+from pmr2.mercurial import watcher
+from pmr2.mercurial.watcher import Watcher
+
+
+def write(path, content):
+    f = open(path, 'w')
+    f.write(content)
+    f.close()
+
+
+class WatcherTestCase(unittest.TestCase):
+
+    def setUp(self):
+        if not watcher.available():
+            self.skipTest('inotify is not available')
+        self.testdir = tempfile.mkdtemp()
+        os.mkdir(join(self.testdir, 'dir'))
+        write(join(self.testdir, 'file1'), 'file1')
+        write(join(self.testdir, 'dir', 'file2'), 'file2')
+        self.watcher = Watcher(self.testdir)
+        for f in ('file1', 'dir/file2'):
+            self.watcher.update(f, 'entry', {'status': 'clean'})
+
+    def tearDown(self):
+        self.watcher.close()
+        shutil.rmtree(self.testdir)
+
+    def test_unchanged(self):
+        self.watcher.poll()
+        self.assertEqual(self.watcher.lookup('file1', 'entry'),
+                         {'status': 'clean'})
+        # a different dirstate entry
+        self.assertEqual(self.watcher.lookup('file1', 'other'), None)
+
+    def test_modified(self):
+        write(join(self.testdir, 'dir', 'file2'), 'changed')
+        self.watcher.poll()
+        self.assertEqual(self.watcher.lookup('dir/file2', 'entry'), None)
+        self.assertEqual(self.watcher.lookup('file1', 'entry'),
+                         {'status': 'clean'})
+
+    def test_new_directory(self):
+        os.makedirs(join(self.testdir, 'new', 'deeper'))
+        self.watcher.poll()
+        self.watcher.update('new/deeper/file3', 'entry', {})
+        write(join(self.testdir, 'new', 'deeper', 'file3'), 'file3')
+        self.watcher.poll()
+        self.assertEqual(self.watcher.lookup('new/deeper/file3', 'entry'),
+                         None)
+
+    def test_directory_moved(self):
+        os.rename(join(self.testdir, 'dir'), join(self.testdir, 'moved'))
+        self.watcher.poll()
+        self.assertEqual(self.watcher.lookup('dir/file2', 'entry'), None)
+        self.assertEqual(len(self.watcher), 1)
+
+    def test_hgignore(self):
+        write(join(self.testdir, '.hgignore'), 'syntax: glob\n*.o\n')
+        self.watcher.poll()
+        self.assertEqual(len(self.watcher), 0)
+
+    def test_closed(self):
+        self.watcher.close()
+        self.watcher.update('file1', 'entry', {})
+        self.assertEqual(self.watcher.lookup('file1', 'entry'), None)
+
+    def test_root_removed(self):
+        w = Watcher(join(self.testdir, 'dir'))
+        w.update('file2', 'entry', {})
+        shutil.rmtree(join(self.testdir, 'dir'))
+        w.poll()
+        # closed, rather than holding on to its inotify instance.
+        self.assertTrue(w.failed)
+        self.assertEqual(w._fd, None)
+        self.assertEqual(w.lookup('file2', 'entry'), None)
+
+
+class SandboxWatcherTestCase(unittest.TestCase):
+
+    def setUp(self):
+        if not watcher.available():
+            self.skipTest('inotify is not available')
+        self.testdir = tempfile.mkdtemp()
+        self.repodir = join(self.testdir, 'repodir')
+        Sandbox.create(self.repodir, True)
+        sandbox = Sandbox(self.repodir)
+        sandbox.add_file_content('file1', 'file1')
+        sandbox.add_file_content('file2', 'file2')
+        # so the dirstate entries written by the commit are final.
+        for f in ('file1', 'file2'):
+            os.utime(join(self.repodir, f), (86400, 86400))
+        sandbox.commit('added', 'user <user@example.com>')
+        watcher.configure(True)
+
+    def tearDown(self):
+        watcher.configure()
+        shutil.rmtree(self.testdir)
+
+    def status(self, **kw):
+        sandbox = Sandbox(self.repodir)
+        checked = []
+        status = localrepository.status
+        def counted(self, *a, **kw):
+            checked.extend(kw['match'].files())
+            return status(self, *a, **kw)
+        localrepository.status = counted
+        try:
+            result = sandbox.status(**kw).next()
+        finally:
+            localrepository.status = status
+        return dict((i['file'], i['status']) for i in result['fentries']()
+            ), sorted(checked)
+
+    def test_status(self):
+        result, checked = self.status()
+        self.assertEqual(result, {'file1': 'clean', 'file2': 'clean'})
+        self.assertEqual(checked, ['file1', 'file2'])
+
+        result, checked = self.status()
+        self.assertEqual(result, {'file1': 'clean', 'file2': 'clean'})
+        self.assertEqual(checked, [])
+
+        write(join(self.repodir, 'file2'), 'modified')
+        result, checked = self.status()
+        self.assertEqual(result, {'file1': 'clean', 'file2': 'modified'})
+        self.assertEqual(checked, ['file2'])
+
+        # leaving out the clean files still keeps their status.
+        result, checked = self.status(clean=False)
+        self.assertEqual(result, {'file2': 'modified'})
+        self.assertEqual(checked, [])
+
+        # the committed file has a new dirstate entry; others may also
+        # have their entries rewritten if they were written within the
+        # same second as the dirstate.
+        Sandbox(self.repodir).commit('modified', 'user <user@example.com>')
+        result, checked = self.status()
+        self.assertEqual(result, {'file1': 'clean', 'file2': 'clean'})
+        self.assertTrue('file2' in checked)
+
+    def test_limit(self):
+        watcher.configure(True, limit=2)
+        roots = [join(self.testdir, name) for name in 'abc']
+        for root in roots:
+            os.mkdir(root)
+        first = watcher.get(roots[0])
+        second = watcher.get(roots[1])
+        self.assertTrue(watcher.get(roots[0]) is first)
+        # the least recently used watcher is closed for the new one.
+        third = watcher.get(roots[2])
+        self.assertEqual(watcher._watchers.keys(), [roots[0], roots[2]])
+        self.assertTrue(second.failed)
+        self.assertFalse(first.failed)
+
+        # as is the watcher of a directory that is gone.
+        shutil.rmtree(roots[0])
+        self.assertFalse(watcher.get(roots[1]).failed)
+        self.assertEqual(watcher._watchers.keys(), [roots[2], roots[1]])
+        self.assertTrue(first.failed)
+        self.assertFalse(third.failed)
+
+    def test_disabled(self):
+        watcher.configure()
+        self.status()
+        result, checked = self.status()
+        self.assertEqual(checked, ['file1', 'file2'])
+        self.assertEqual(watcher.get(self.repodir), None)
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(WatcherTestCase))
+    suite.addTest(makeSuite(SandboxWatcherTestCase))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,10 @@
 import re
+from bisect import bisect_left
+from functools import partial
 from os.path import basename
+from os.path import join
 from cStringIO import StringIO
+from types import GeneratorType
 import zope.component
 
 from urlparse import parse_qsl
@@ -16,10 +20,59 @@ from pmr2.app.workspace.storage import StorageUtility
 from pmr2.app.workspace.storage import BaseStorage
 
 from pmr2.mercurial import backend
+from pmr2.mercurial import admission
+from pmr2.mercurial import coalesce
+from pmr2.mercurial import index
+from pmr2.mercurial import jobs
+from pmr2.mercurial import search
+from pmr2.mercurial.instrument import timed
+from pmr2.mercurial.profiler import profiled
+from pmr2.mercurial.records import DirEntry
+from pmr2.mercurial.records import lazy
+from pmr2.mercurial.records import resolve
 from pmr2.mercurial.utils import archive
 from pmr2.mercurial.utils import filter
+from pmr2.mercurial.utils import memoized_filter
 from pmr2.mercurial.utils import list_subrepo
 from pmr2.mercurial.utils import match_subrepo
+from pmr2.mercurial.utils import subrepo_trie
+
+
+def _protocol_tags(utility, context, request):
+    rp = zope.component.getUtility(IPMR2GlobalSettings).dirOf(context)
+    cmd = dict(parse_qsl(request.environ.get('QUERY_STRING', ''))).get('cmd')
+    return rp, cmd
+
+def _storage_tags(storage, *a, **kw):
+    return storage.storage._rpath, storage.rev
+
+def _sync_message(heads):
+    if heads == 0:
+        return 'No new changes found.'
+    return None
+
+def _jobs_db():
+    # the job queue defaults to a database within the repository root,
+    # which is only writable by the instance.
+    root = getattr(zope.component.getUtility(IPMR2GlobalSettings),
+                   'repo_root', None)
+    return root and join(root, '.pmr2.mercurial-jobs.db') or None
+
+def _filedate(date, fctx):
+    return date(fctx.date())
+
+def _filesize(fctx):
+    return str(fctx.size())
+
+def _materialize(entry):
+    # generators (and the templates within them) can only be consumed
+    # once.
+    result = {}
+    for k, v in entry.iteritems():
+        if isinstance(v, GeneratorType):
+            v = [list(i) if isinstance(i, GeneratorType) else i for i in v]
+        result[k] = v
+    return result
 
 
 class MercurialStorageUtility(StorageUtility):
@@ -32,6 +85,7 @@ class MercurialStorageUtility(StorageUtility):
         # This creates the mercurial workspace, and will fail if storage
         # already exists.
         backend.Storage.create(rp, ffa=True)
+        index.updated(rp)
 
     def acquireFrom(self, context):
         return MercurialStorage(context)
@@ -54,6 +108,7 @@ class MercurialStorageUtility(StorageUtility):
             result = 'cmd=' in qs
         return result
 
+    @profiled('MercurialStorageUtility.protocol', _protocol_tags)
     def protocol(self, context, request):
         storage = self.acquireFrom(context)
         # Assume WSGI compatible.
@@ -63,25 +118,63 @@ class MercurialStorageUtility(StorageUtility):
                 dict(parse_qsl(request.environ.get('QUERY_STRING', ''))).get(
                     'cmd') == 'unbundle'):
             event = Push(context)
+            index.updated(storage.storage._rpath)
+            search.updated(storage.storage._rpath)
         return ProtocolResult(raw_result, event)
 
     def syncIdentifier(self, context, identifier):
         # method is not protected.
         rp = zope.component.getUtility(IPMR2GlobalSettings).dirOf(context)
-        # use the sandbox class directly on the path
-        sandbox = backend.Sandbox(rp)
-        heads = sandbox.pull(identifier, update=False)
-        msg = None
-        result = heads > 0
-        if heads == 0:
-            msg = 'No new changes found.'
+        heads = jobs.sync(rp, identifier)
         # always successful, failure are exceptions
-        return True, msg
+        return True, _sync_message(heads)
 
     def syncWorkspace(self, context, source):
         remote = zope.component.getUtility(IPMR2GlobalSettings).dirOf(source)
         return self.syncIdentifier(context, remote)
 
+    def syncWorkspaces(self, pairs, processes=None):
+        """\
+        Sync many workspaces, each target from its source workspace given
+        as pairs, on a pool of processes.  Returns a list of dicts with
+        the target and source paths, the number of heads added, the error
+        and duration of each sync, in the order of pairs.
+        """
+
+        settings = zope.component.getUtility(IPMR2GlobalSettings)
+        return jobs.sync_many([(settings.dirOf(target), settings.dirOf(source))
+            for target, source in pairs], processes)
+
+    def syncIdentifierAsync(self, context, identifier):
+        """\
+        Queue the sync of the context from identifier, returns the id of
+        the job, which may be one already pending for the same sync.
+        """
+
+        rp = zope.component.getUtility(IPMR2GlobalSettings).dirOf(context)
+        return jobs.queue(_jobs_db()).submit(rp, identifier)
+
+    def syncWorkspaceAsync(self, context, source):
+        remote = zope.component.getUtility(IPMR2GlobalSettings).dirOf(source)
+        return self.syncIdentifierAsync(context, remote)
+
+    def syncStatus(self, job_id):
+        """\
+        Returns the status of a queued sync, as a dict with its state
+        (pending, running, done or failed), the times it was created,
+        started and finished, the number of new heads and the message,
+        or None if there is no such job.
+        """
+
+        result = jobs.queue(_jobs_db()).status(job_id)
+        if result is None:
+            return None
+        result['heads'] = result.pop('result')
+        result['message'] = result['error']
+        if result['state'] == jobs.DONE:
+            result['message'] = _sync_message(result['heads'])
+        return result
+
 
 class MercurialStorage(BaseStorage):
 
@@ -129,14 +222,22 @@ class MercurialStorage(BaseStorage):
     def shortrev(self):
         return filter(self.rev, 'short')
 
+    @timed('MercurialStorage.hg_archive')
+    @profiled('MercurialStorage.hg_archive', _storage_tags)
     def hg_archive(self, prefix, format):
+        # identical archives requested concurrently are only built once.
+        key = (self.storage._rpath, self.rev, 'archive', prefix, format)
+        return coalesce.do(key, self._hg_archive, prefix, format)
+
+    def _hg_archive(self, prefix, format):
         dest = StringIO()
         repo = self.storage.repo
         decode = True
         matchfn = None
         mtime = None
-        archival.archive(repo, dest, self.rev, format,
-                         decode, matchfn, prefix, mtime)
+        with admission.limit('archive'):
+            archival.archive(repo, dest, self.rev, format,
+                             decode, matchfn, prefix, mtime)
         return dest.getvalue()
 
     def archive_zip(self):
@@ -165,11 +266,25 @@ class MercurialStorage(BaseStorage):
     # Unit tests would be useful here, even if this class will only
     # produce output for the browser classes.
 
+    def _entry(self, **kw):
+        """\
+        Returns the listing entry for the arguments of format, as a
+        compact record unless format is overridden.
+        """
+
+        if type(self).format.im_func is not BaseStorage.format.im_func:
+            return self.format(**resolve(kw))
+        return DirEntry(self, **kw)
+
+    @timed('MercurialStorage.file')
+    @profiled('MercurialStorage.file', _storage_tags)
     def file(self, path):
         # XXX see backend.Storage for why we need to pass self.rev and
         # why that should be unnecessary.
         return self.storage.file(self.rev, path)
 
+    @timed('MercurialStorage.fileinfo')
+    @profiled('MercurialStorage.fileinfo', _storage_tags)
     def fileinfo(self, path):
         data = self.storage.fileinfo(self.rev, path).next()
         ctx = self.storage._ctx
@@ -180,9 +295,117 @@ class MercurialStorage(BaseStorage):
         data['contents'] = lambda: self.file(data['file'])
         return self.format(**data)
 
+    @timed('MercurialStorage.annotate')
+    @profiled('MercurialStorage.annotate', _storage_tags)
+    def annotate(self, path):
+        """\
+        Returns the changeset (rev), author and date of the change that
+        last changed each line of the file at path, with the line.
+        """
+
+        date = memoized_filter(self.datefmtfilter)
+        result = self.storage.annotate(self.rev, path)
+        for entry in result:
+            entry['date'] = date(entry['date'])
+        return result
+
+    @timed('MercurialStorage.grep')
+    @profiled('MercurialStorage.grep', _storage_tags)
+    def grep(self, pattern, rev=None, path_prefix=None):
+        """\
+        Returns the lines of the text files of rev, or of the checked
+        out revision, matching the regular expression pattern, as
+        records of the file, lineno and line, optionally of the files
+        within path_prefix only.
+        """
+
+        if rev is None:
+            rev = self.rev
+        return list(self.storage.grep(pattern, rev, path_prefix))
+
     def files(self):
         return sorted(self.storage.raw_manifest(self.rev).keys())
 
+    @timed('MercurialStorage.changed_files')
+    @profiled('MercurialStorage.changed_files', _storage_tags)
+    def changed_files(self, rev_a, rev_b=None):
+        """\
+        Returns the files added, removed and modified from rev_a to
+        rev_b, or to the checked out revision, as a dict of sorted lists
+        of (path, flags).
+        """
+
+        if rev_b is None:
+            rev_b = self.rev
+        return self.storage.changed_files(rev_a, rev_b)
+
+    @timed('MercurialStorage.diff')
+    @profiled('MercurialStorage.diff', _storage_tags)
+    def diff(self, rev=None, path=None):
+        """\
+        Yields the chunks of the unified diff of the changeset rev, or of
+        the checked out revision, against its first parent, optionally
+        of the files within path only.
+        """
+
+        if rev is None:
+            rev = self.rev
+        return self.storage.diff(rev, path)
+
+    @timed('MercurialStorage.diffstat')
+    @profiled('MercurialStorage.diffstat', _storage_tags)
+    def diffstat(self, rev=None):
+        """\
+        Returns the lines added and removed in total and by file by the
+        changeset rev, or by the checked out revision.
+        """
+
+        if rev is None:
+            rev = self.rev
+        return self.storage.diffstat(rev)
+
+    def _file_entry(self, ctx, mf, full, date):
+        fctx = ctx.filectx(full, fileid=mf[full])
+        # the file revision is only read for the fields used.
+        return self._entry(**{
+            'permissions': '-rw-r--r--',
+            'contenttype': 'file',
+            'node': self.rev,
+            'date': lazy(_filedate, date, fctx),
+            'size': lazy(_filesize, fctx),
+            'path': full,
+            'desc': lazy(fctx.description),
+            # XXX if self.rev changes, this can result in inconsistency
+            'contents': partial(self.file, full),
+        })
+
+    def _subrepo_entry(self, name, path, state):
+        url, rev, repotype = state
+        if url is None:
+            # can't really link it anywhere...
+            p = path
+        else:
+            # XXX 'file' is specific to PMR2, bitbucket uses
+            # 'src' to access the human friendly view.
+            p = '%s/file/%s' % (url, rev)
+        result = self._entry(**{
+            'permissions': 'lrwxrwxrwx',
+            'contenttype': repotype,
+            'node': self.rev,
+            'date': '',
+            'size': '',
+            'path': p,
+            'desc': '',
+            'contents': '',  # XXX
+        })
+
+        # need to "fix" some values
+        result['basename'] = name  # name
+        result['fullpath'] = p  # full url
+        return result
+
+    @timed('MercurialStorage.listdir')
+    @profiled('MercurialStorage.listdir', _storage_tags)
     def listdir(self, path):
         """\
         Modification of the function
@@ -193,7 +416,6 @@ class MercurialStorage(BaseStorage):
         path = webutil.cleanpath(self.storage._repo, path)
         mf = ctx.manifest()
         node = ctx.node()
-        substate = ctx.substate
 
         def fullviewpath(base, node, file):
             # XXX this needs to be some kind of resolution method
@@ -232,12 +454,12 @@ class MercurialStorage(BaseStorage):
         if mf and not files and not dirs:
             raise PathNotFoundError('path not found: ' + path)
 
-        subrepos = list_subrepo(substate, abspath)
+        subrepos = list_subrepo(subrepo_trie(ctx), abspath)
 
         def listdir():
 
             if not path == '':
-                yield self.format(**{
+                yield self._entry(**{
                     'permissions': 'drwxr-xr-x',
                     'contenttype': None,
                     'node': self.rev,
@@ -250,31 +472,7 @@ class MercurialStorage(BaseStorage):
                 })
                 
             for n, v in sorted(subrepos):
-                p = ''
-                url, rev, repotype = v
-                if v[0] is None:
-                    # can't really link it anywhere...
-                    p = '%s%s' % (path, n)
-                else:
-                    # XXX 'file' is specific to PMR2, bitbucket uses
-                    # 'src' to access the human friendly view.
-                    p = '%s/file/%s' % (url, rev)
-                result = self.format(**{
-                    'permissions': 'lrwxrwxrwx',
-                    'contenttype': repotype,
-                    'node': self.rev,
-                    'date': '',
-                    'size': '',
-                    'path': p,
-                    'desc': '',
-                    'contents': '',  # XXX
-                    # 'emptydirs': '/'.join(emptydirs),
-                })
-                
-                # need to "fix" some values
-                result['basename'] = n  # name
-                result['fullpath'] = p  # full url
-                yield result
+                yield self._subrepo_entry(n, '%s%s' % (path, n), v)
 
             for d in sorted(dirs):
                 emptydirs = []
@@ -286,7 +484,7 @@ class MercurialStorage(BaseStorage):
                     h = v
 
                 p = '%s%s' % (path, d)
-                yield self.format(**{
+                yield self._entry(**{
                     'permissions': 'drwxr-xr-x',
                     'contenttype': 'folder',
                     'node': self.rev,
@@ -298,23 +496,114 @@ class MercurialStorage(BaseStorage):
                     # 'emptydirs': '/'.join(emptydirs),
                 })
 
+            date = memoized_filter(self.datefmtfilter)
             for f in sorted(files):
-                full = files[f]
-                fctx = ctx.filectx(full)
-                yield self.format(**{
-                    'permissions': '-rw-r--r--',
-                    'contenttype': 'file',
-                    'node': self.rev,
-                    'date': filter(fctx.date(), self.datefmtfilter),
-                    'size': str(fctx.size()),
-                    'path': full,
-                    'desc': fctx.description(),
-                    # XXX if self.rev changes, this can result in inconsistency
-                    'contents': lambda: self.file(p),
-                })
+                yield self._file_entry(ctx, mf, files[f], date)
 
         return listdir()
 
+    @timed('MercurialStorage.walk')
+    @profiled('MercurialStorage.walk', _storage_tags)
+    def walk(self, path='', depth=None):
+        """\
+        Yields the entries of all directories, files and subrepositories
+        within path, in a single pass over the manifest.
+
+        Entries are yielded in the order of their paths, with each
+        directory before its contents, and only the entries down to
+        depth levels below path if depth is given (so a depth of 1 gives
+        the entries of listdir).  Subrepositories are not descended into.
+        """
+
+        ctx = self.storage._ctx
+        path = webutil.cleanpath(self.storage._repo, path)
+        mf = ctx.manifest()
+
+        if path in mf:
+            raise PathNotDirError('path is dir: ' + path)
+
+        if path and path[-1] != "/":
+            path += "/"
+        l = len(path)
+
+        files = sorted(f for f in mf if f[:l] == path)
+        if mf and not files:
+            raise PathNotFoundError('path not found: ' + path)
+        substate = ctx.substate
+        subrepos = sorted((p, substate[p]) for p in substate
+                          if p[:l] == path and len(p) > l)
+
+        def walk():
+            if depth is not None and depth < 1:
+                return
+
+            date = memoized_filter(self.datefmtfilter)
+            stack = []  # the directories entered below path
+            i = j = 0
+            while i < len(files) or j < len(subrepos):
+                if j < len(subrepos) and (
+                        i == len(files) or subrepos[j][0] < files[i]):
+                    name, state = subrepos[j]
+                    j += 1
+                else:
+                    name, state = files[i], None
+                    i += 1
+
+                elements = name[l:].split('/')
+                dirs = elements[:-1]
+                k = 0
+                while k < len(stack) and k < len(dirs) and \
+                        stack[k] == dirs[k]:
+                    k += 1
+                del stack[k:]
+                for d in dirs[k:depth]:
+                    stack.append(d)
+                    yield self._entry(**{
+                        'permissions': 'drwxr-xr-x',
+                        'contenttype': 'folder',
+                        'node': self.rev,
+                        'date': '',
+                        'size': '',
+                        'path': path + '/'.join(stack),
+                        'desc': '',
+                        'contents': '',
+                    })
+
+                if depth is not None and len(dirs) >= depth:
+                    # skip the rest of the directory that is too deep;
+                    # '0' is the character that follows '/'.
+                    end = path + '/'.join(dirs[:depth]) + '0'
+                    i = bisect_left(files, end, i)
+                    j = bisect_left(subrepos, (end,), j)
+                    continue
+
+                if state is None:
+                    yield self._file_entry(ctx, mf, name, date)
+                else:
+                    yield self._subrepo_entry(elements[-1], name, state)
+
+        return walk()
+
+    @timed('MercurialStorage.search_log')
+    @profiled('MercurialStorage.search_log', _storage_tags)
+    def search_log(self, query, limit=20, cursor=None):
+        """\
+        Returns the changesets of the workspace with descriptions,
+        authors or touched paths matching every word of the query, newest
+        first, and the cursor to pass for the next page of up to limit
+        changesets (None if there are no more).
+        """
+
+        date = memoized_filter(self.datefmtfilter)
+        email = memoized_filter('email')
+        entries, cursor = self.storage.search_log(query, limit, cursor)
+        for entry in entries:
+            entry['date'] = date(entry['date'])
+            entry['email'] = email(entry['author'])
+        return entries, cursor
+
+    @timed('MercurialStorage.pathinfo')
+    @profiled('MercurialStorage.pathinfo', _storage_tags)
     def pathinfo(self, path):
 
         if path in self.files():
@@ -335,8 +624,7 @@ class MercurialStorage(BaseStorage):
         except PathNotFoundError:
             # attempt to look for subrepo
             ctx = self.storage._ctx
-            substate = ctx.substate
-            gen = match_subrepo(substate, path)
+            gen = match_subrepo(subrepo_trie(ctx), path)
             if not gen:
                 raise  # re-raise the PathNotFound
             keys = gen.next()
@@ -354,6 +642,8 @@ class MercurialStorage(BaseStorage):
             })
         return data
 
+    @timed('MercurialStorage.log')
+    @profiled('MercurialStorage.log', _storage_tags)
     def log(self, start, count, branch=None, shortlog=False):
         def buildnav(nav):
             # This is based on the navlist structure as expected by
@@ -376,9 +666,18 @@ class MercurialStorage(BaseStorage):
                 })
             return result
 
-        log = self.storage.log(rev=start, branch=branch, maxchanges=count,
-                               shortlog=shortlog)
-        results = log.next()
-        changenav = results['changenav'][0]
-        self._lastnav = buildnav(changenav)
-        return results['entries']()
+        def build():
+            log = self.storage.log(rev=start, branch=branch,
+                                   maxchanges=count, shortlog=shortlog)
+            results = log.next()
+            changenav = results['changenav'][0]
+            # entries are shared with coalesced requests, so the
+            # generators within them are turned into lists.
+            entries = [_materialize(e) for e in results['entries']()]
+            return buildnav(changenav), entries
+
+        node = self.storage._getctx(start).hex()
+        key = (self.storage._rpath, node, 'log', count, branch, shortlog)
+        nav, entries = coalesce.do(key, build)
+        self._lastnav = list(nav)
+        return iter([dict(e) for e in entries])
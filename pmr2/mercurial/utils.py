@@ -1,7 +1,14 @@
 import os
 import os.path
+import stat
+import shutil
+import tarfile
+import zipfile
+import tempfile
+import threading
 
-from mercurial import archival, templatefilters
+from mercurial import archival, templatefilters, util
+from pmr2.mercurial import index
 from pmr2.app.workspace.exceptions import SubrepoPathUnsupportedError
 
 _rstub = '.hg'
@@ -9,14 +16,25 @@ _rstub = '.hg'
 def webdir(path):
     """\
     Return a list of potentially valid repositores in `path`.
+
+    If the workspace index is enabled and path was indexed, the names
+    are read from the index instead.
     """
 
     if not isinstance(path, str):
         raise TypeError('path must be a str')
+    workspaces = index.get()
+    if workspaces is not None:
+        result = workspaces.names(path)
+        if result is not None:
+            return result
     paths = os.listdir(path)
     result = [i for i in paths if os.path.isdir(os.path.join(path, i, _rstub))]
     return result
 
+# filters with results that depend on when they are applied.
+_volatile_filters = frozenset(['age'])
+
 def filter(input, filter):
     """\
     Quick and dirty way to utilize the template filter to get dates.
@@ -27,64 +45,190 @@ def filter(input, filter):
     except:
         return input
 
+def _identity(input):
+    return input
+
+def memoized_filter(filter):
+    """\
+    Return a function that applies the template filter like `filter`,
+    formatting each distinct input only once.  Meant to be used for the
+    entries of a listing or a log, where identical dates and authors are
+    common.
+    """
+
+    func = templatefilters.filters.get(filter)
+    if func is None:
+        return _identity
+
+    def apply(input):
+        try:
+            return func(input)
+        except:
+            return input
+
+    if filter in _volatile_filters:
+        return apply
+
+    memo = {}
+    def memoized(input):
+        try:
+            return memo[input]
+        except KeyError:
+            result = memo[input] = apply(input)
+            return result
+        except TypeError:
+            # unhashable
+            return apply(input)
+    return memoized
+
 def tmpl(name, **kw):
     kw[''] = name
     yield kw
 
+def _subrepo_link(value):
+    return value[0].startswith('http://') or value[0].startswith('https://')
+
+
+class _SubrepoNode(object):
+
+    __slots__ = ('children', 'subrepos', 'key')
+
+    def __init__(self):
+        self.children = {}
+        # (name, key) of the subrepos directly within this directory.
+        self.subrepos = []
+        self.key = None
+
+
+class SubrepoTrie(object):
+    """\
+    Prefix tree over the paths of a substate dict, which finds the
+    subrepos within a directory and the subrepo containing a path in
+    time proportional to the depth of the path.
+    """
+
+    def __init__(self, substate):
+        self.substate = substate
+        self._root = _SubrepoNode()
+        for key in substate.keys():
+            node = parent = self._root
+            for fragment in key.split('/'):
+                parent = node
+                node = node.children.get(fragment)
+                if node is None:
+                    node = parent.children[fragment] = _SubrepoNode()
+            node.key = key
+            parent.subrepos.append((key.split('/')[-1], key))
+
+    def _find(self, fragments):
+        node = self._root
+        for fragment in fragments:
+            node = node.children.get(fragment)
+            if node is None:
+                return None
+        return node
+
+    def list(self, abspath):
+        """\
+        Return the name and the substate value of the subrepos within the
+        directory of abspath.
+        """
+
+        fragments = abspath.split('/')
+        if fragments[0] != '':
+            return []
+        node = self._find(fragments[1:-1])
+        if node is None:
+            return []
+        result = []
+        for name, key in node.subrepos:
+            ss = self.substate[key]
+            if not _subrepo_link(ss):
+                ss = (None, None,)
+            result.append((name, ss,))
+        return result
+
+    def match(self, path):
+        """\
+        Return the key and the substate value of the subrepo containing
+        path, or None.
+        """
+
+        node = self._root
+        for fragment in path.split('/'):
+            node = node.children.get(fragment)
+            if node is None:
+                return None
+            if node.key is not None:
+                return node.key, self.substate[node.key]
+        return None
+
+
+_subrepo_tries = util.lrucachedict(256)
+_subrepo_tries_lock = threading.Lock()
+
+def subrepo_trie(ctx):
+    """\
+    Return the `SubrepoTrie` for the substate of the changeset context,
+    cached by node as changesets are immutable.
+    """
+
+    node = ctx.node()
+    if node is None:
+        # working directory
+        return SubrepoTrie(ctx.substate)
+    _subrepo_tries_lock.acquire()
+    try:
+        if node in _subrepo_tries:
+            return _subrepo_tries[node]
+    finally:
+        _subrepo_tries_lock.release()
+    trie = SubrepoTrie(ctx.substate)
+    _subrepo_tries_lock.acquire()
+    try:
+        _subrepo_tries[node] = trie
+    finally:
+        _subrepo_tries_lock.release()
+    return trie
+
 def list_subrepo(substate, abspath):
     """
-    Given a substate dict (like result of context.substate) and the
-    abspath, return any subrepos that may be available in that abspath.
+    Given a substate dict (like result of context.substate) or its
+    `SubrepoTrie` and the abspath, return any subrepos that may be
+    available in that abspath.
     """
 
     if not substate:
         return []
-
-    fragments = abspath.split('/')
-    depth_wanted = len(fragments)
-    # prepending the empty string token as first element since the
-    # substate keys don't have a prepended '/'.
-    entries = [([''] + i.split('/'), i) for i in substate.keys()]
-    result = []
-    for key, value in entries:
-        if len(key) == depth_wanted and key[:-1] == fragments[:-1]:
-            ss = substate[value]
-            if not (ss[0].startswith('http://') or 
-                    ss[0].startswith('https://')):
-                ss = (None, None,)
-            result.append((key[-1], ss,))
-    return result
+    if not isinstance(substate, SubrepoTrie):
+        substate = SubrepoTrie(substate)
+    return substate.list(abspath)
     
 def match_subrepo(substate, path):
     """
-    Given a substate dict (like result of context.substate), match path,
-    return a structure that describes what might be done.
+    Given a substate dict (like result of context.substate) or its
+    `SubrepoTrie`, match path, return a structure that describes what
+    might be done.
     """
 
-    # try to resolve submodule before giving up.
-    for subrepokey, value in substate.iteritems():
-        # appending separator is safe because hg considers
-        # it as part of the subrepo.
-        # XXX are subrepo path separator represented 
-        # internally in hg as '/' under Windows, too?
-        subrepodir = subrepokey + '/'
-        # a request path with just the folder will be on its
-        # own.
-        if path == subrepokey or path.startswith(subrepodir):
-            # sanity check, make sure link is redirectable.
-            if not (value[0].startswith('http://') or
-                    value[0].startswith('https://')
-                ):  # <- sadface
-                raise SubrepoPathUnsupportedError(
-                    "subrepo path '%s' not supported" % value[0])
-            # all good, produce subrepo info structure.
-            newpath = path[len(subrepodir):]
-            result = tmpl('_subrepo', **{
-                'path': newpath,
-                'location': value[0],
-                'rev': value[1],
-            })
-            return result
+    if not isinstance(substate, SubrepoTrie):
+        substate = SubrepoTrie(substate)
+    match = substate.match(path)
+    if match is None:
+        return None
+    subrepokey, value = match
+    # sanity check, make sure link is redirectable.
+    if not _subrepo_link(value):
+        raise SubrepoPathUnsupportedError(
+            "subrepo path '%s' not supported" % value[0])
+    # all good, produce subrepo info structure.
+    newpath = path[len(subrepokey) + 1:]
+    result = tmpl('_subrepo', **{
+        'path': newpath,
+        'location': value[0],
+        'rev': value[1],
+    })
+    return result
 
 file_listings = ['manifest']
 
@@ -107,9 +251,11 @@ def add_aentries(d, datefmt='isodate'):
             i['file'] = i['path'][1:]
             i['permissions'] = 'drwxr-xr-x'
             yield i
+        date = memoized_filter(datefmt)
+        permissions = memoized_filter('permissions')
         for i in filelist():
-            i['date'] = filter(i['date'], datefmt)
-            i['permissions'] = filter(i['permissions'], 'permissions')
+            i['date'] = date(i['date'])
+            i['permissions'] = permissions(i['permissions'])
             yield i
 
     return tmpl(d[''],
@@ -132,3 +278,61 @@ def archive(workspace, dest, node, kind, decode=True, matchfn=None,
     # assuming workspace is our workspace object
     repo = workspace._repo
     archival.archive(repo, dest, node, kind, decode, matchfn, prefix, mtime)
+
+# archives read from a stream that cannot seek are spooled to a
+# temporary file, which is only kept in memory up to this size.
+_spool_size = 1 << 20
+
+def _seekable(fileobj):
+    try:
+        fileobj.seek(fileobj.tell())
+    except (AttributeError, IOError, OSError):
+        return False
+    return True
+
+def archive_entries(fileobj, kind=None):
+    """\
+    Iterate through the entries of a zip or tar archive read from
+    `fileobj`, without loading the entries into memory.
+
+    kind -
+        'zip' or 'tar' (for any tar compression); detected from the
+        content if None.
+
+    Yields tuples of name, mode and a file object for reading the
+    content of regular files, or None for other entries (directories
+    are skipped).
+    """
+
+    if kind is None or kind == 'zip':
+        if not _seekable(fileobj):
+            spool = tempfile.SpooledTemporaryFile(_spool_size)
+            shutil.copyfileobj(fileobj, spool)
+            spool.seek(0)
+            fileobj = spool
+        if kind is None:
+            start = fileobj.tell()
+            kind = fileobj.read(4) == 'PK\x03\x04' and 'zip' or 'tar'
+            fileobj.seek(start)
+
+    if kind == 'zip':
+        zf = zipfile.ZipFile(fileobj)
+        for info in zf.infolist():
+            if info.filename.endswith('/'):
+                continue
+            mode = info.external_attr >> 16
+            if mode and not stat.S_ISREG(mode):
+                yield info.filename, mode, None
+                continue
+            yield info.filename, mode or 0644, zf.open(info)
+    elif kind == 'tar':
+        tf = tarfile.open(fileobj=fileobj, mode='r|*')
+        for info in tf:
+            if info.isdir():
+                continue
+            if not info.isfile():
+                yield info.name, info.mode, None
+                continue
+            yield info.name, info.mode, tf.extractfile(info)
+    else:
+        raise ValueError('unsupported archive kind: %s' % kind)
@@ -0,0 +1,349 @@
+"""\
+Linux inotify based watcher for sandbox working directories.
+
+A watcher keeps the status of the files in a working directory that
+were found by `Sandbox.status`, and drops them as soon as the file
+system reports a change to the file, so only changed files have to be
+examined again.  The cached status of a file is also ignored once its
+dirstate entry changes (e.g. when it is added, removed or committed).
+
+Watching is off by default.  It is enabled with `configure()` or by
+setting the `PMR2_MERCURIAL_WATCH` environment variable to a non-empty
+value; it is silently unavailable on other platforms, and a watcher
+that can no longer track its directory (e.g. when running out of
+inotify watches, or once the directory is removed) is discarded.
+
+Each watcher holds an inotify instance, of which there are only a few
+per user (128 by default on Linux), so only the watchers of the most
+recently used directories are kept; the number is set with
+`configure()` or the `PMR2_MERCURIAL_WATCH_LIMIT` environment variable,
+and defaults to 64.
+"""
+
+import os
+import sys
+import errno
+import struct
+import threading
+import ctypes
+import ctypes.util
+from collections import OrderedDict
+from logging import getLogger
+
+__all__ = [
+    'Watcher',
+    'available',
+    'configure',
+    'get',
+    'close',
+]
+
+logger = getLogger('pmr2.mercurial.watcher')
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_CLOEXEC = 0x00080000
+IN_NONBLOCK = 0x00000800
+
+_mask = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+         IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF |
+         IN_MOVE_SELF | IN_ONLYDIR)
+
+_event = struct.Struct('iIII')
+
+_libc = None
+
+
+def _load():
+    global _libc
+    if _libc is None:
+        _libc = False
+        if sys.platform.startswith('linux'):
+            try:
+                libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                   use_errno=True)
+                libc.inotify_init1
+                libc.inotify_add_watch
+            except (OSError, AttributeError):
+                pass
+            else:
+                _libc = libc
+    return _libc
+
+def available():
+    """\
+    Whether inotify is available on this platform.
+    """
+
+    return bool(_load())
+
+
+class Watcher(object):
+    """\
+    Watches the working directory at `root` and caches the status of
+    the files within it until they change.
+    """
+
+    def __init__(self, root):
+        libc = _load()
+        if not libc:
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self.root = root
+        self.failed = False
+        self._lock = threading.Lock()
+        self._wds = {}
+        self._cache = {}
+        self._fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        try:
+            self._add_tree('')
+        except OSError:
+            self.close()
+            raise
+
+    def _add_watch(self, path):
+        wd = _libc.inotify_add_watch(self._fd,
+            os.path.join(self.root, path), _mask)
+        if wd < 0:
+            e = ctypes.get_errno()
+            if e in (errno.ENOENT, errno.ENOTDIR):
+                # gone before it could be watched.
+                return False
+            raise OSError(e, os.strerror(e))
+        self._wds[wd] = path
+        return True
+
+    def _add_tree(self, path):
+        """\
+        Watch the directory at path and everything within it, returns
+        the files found.
+        """
+
+        found = []
+        if not self._add_watch(path):
+            return found
+        try:
+            names = os.listdir(os.path.join(self.root, path))
+        except OSError:
+            return found
+        for name in names:
+            if not path and name == '.hg':
+                continue
+            sub = path and '%s/%s' % (path, name) or name
+            if os.path.isdir(os.path.join(self.root, sub)) and \
+                    not os.path.islink(os.path.join(self.root, sub)):
+                found.extend(self._add_tree(sub))
+            else:
+                found.append(sub)
+        return found
+
+    def _invalidate_tree(self, path):
+        prefix = path + '/'
+        for f in self._cache.keys():
+            if f.startswith(prefix):
+                del self._cache[f]
+
+    def _read(self):
+        try:
+            return os.read(self._fd, 65536)
+        except OSError, e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return ''
+            raise
+
+    def _process(self, data):
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _event.unpack_from(data, offset)
+            offset += _event.size
+            name = data[offset:offset + length].rstrip('\0')
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                # events were lost.
+                self._cache.clear()
+                continue
+            base = self._wds.get(wd)
+            if base == '' and mask & (IN_IGNORED | IN_DELETE_SELF |
+                                      IN_MOVE_SELF):
+                # the root itself is gone, there is nothing left to watch.
+                self._close()
+                return
+            if mask & IN_IGNORED:
+                self._wds.pop(wd, None)
+                continue
+            if base is None:
+                continue
+            path = base and name and '%s/%s' % (base, name) or base or name
+            if not base and name == '.hg':
+                continue
+            if path == '.hgignore':
+                # may change what is ignored anywhere.
+                self._cache.clear()
+            self._cache.pop(path, None)
+            if mask & IN_ISDIR:
+                self._invalidate_tree(path)
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    # files may have been created before the watch.
+                    for f in self._add_tree(path):
+                        self._cache.pop(f, None)
+
+    def poll(self):
+        """\
+        Process the changes reported since the last poll.
+        """
+
+        self._lock.acquire()
+        try:
+            if self.failed:
+                return
+            try:
+                while True:
+                    data = self._read()
+                    if not data:
+                        break
+                    self._process(data)
+                    if self.failed:
+                        break
+            except OSError, e:
+                logger.warning('watcher for %s failed: %s', self.root, e)
+                self._close()
+        finally:
+            self._lock.release()
+
+    def lookup(self, path, entry):
+        """\
+        Return the cached status of the file at path, if it was not
+        changed since and its dirstate entry is still `entry`.
+        """
+
+        self._lock.acquire()
+        try:
+            value = self._cache.get(path)
+            if value is None or value[0] != entry:
+                return None
+            return dict(value[1])
+        finally:
+            self._lock.release()
+
+    def update(self, path, entry, status):
+        """\
+        Cache the status of the file at path, for its dirstate entry.
+        """
+
+        self._lock.acquire()
+        try:
+            if not self.failed:
+                self._cache[path] = (entry, dict(status))
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def _close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        self.failed = True
+        self._cache.clear()
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            self._close()
+        finally:
+            self._lock.release()
+
+
+class _config:
+    enabled = bool(os.environ.get('PMR2_MERCURIAL_WATCH'))
+    limit = int(os.environ.get('PMR2_MERCURIAL_WATCH_LIMIT', 64))
+
+
+# the watchers by root, least recently used first.
+_watchers = OrderedDict()
+_watchers_lock = threading.Lock()
+
+
+def configure(enabled=False, limit=64):
+    """\
+    Enable or disable watching, keeping at most limit watchers;
+    disabling closes all watchers.
+    """
+
+    _config.enabled = enabled
+    _config.limit = limit
+    if not enabled:
+        close()
+
+def _prune(limit):
+    # drop the watchers that failed or whose directory is gone, then
+    # the least recently used ones down to limit.
+    for r, w in _watchers.items():
+        if w.failed or not os.path.isdir(r):
+            del _watchers[r]
+            w.close()
+    while _watchers and len(_watchers) > limit:
+        r, w = _watchers.popitem(last=False)
+        w.close()
+
+def get(root):
+    """\
+    Return the watcher for the working directory at root, starting one
+    if needed.  Returns None if watching is disabled or unavailable.
+    """
+
+    if not _config.enabled or not available():
+        return None
+    _watchers_lock.acquire()
+    try:
+        w = _watchers.pop(root, None)
+        if w is not None and w.failed:
+            w.close()
+            w = None
+        if w is None:
+            if _config.limit < 1:
+                return None
+            _prune(_config.limit - 1)
+            try:
+                w = Watcher(root)
+            except OSError, e:
+                logger.warning('cannot watch %s: %s', root, e)
+                return None
+        _watchers[root] = w
+        return w
+    finally:
+        _watchers_lock.release()
+
+def close(root=None):
+    """\
+    Close the watcher for root, or all watchers.
+    """
+
+    _watchers_lock.acquire()
+    try:
+        if root is None:
+            roots = _watchers.keys()
+        else:
+            roots = [root]
+        for r in roots:
+            w = _watchers.pop(r, None)
+            if w is not None:
+                w.close()
+    finally:
+        _watchers_lock.release()